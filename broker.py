@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""Helpers shared by the coordinator and the workers to talk to the message
+broker
+"""
+import amqpstorm
+import threading
+import time
+# Local files
+import codec
+
+
+PERSISTENT = {'delivery_mode': 2}
+# Unacknowledged messages held by a reader, it settles them in halves
+DEFAULT_PREFETCH = 2000
+# A reader gives up if no message arrives in this many seconds
+DEFAULT_READ_TIMEOUT = 10
+
+
+class BatchPublisher(object):
+    """Publishes messages into a queue in windows. Each window is sent inside
+    an AMQP transaction, so when publish returns the broker has taken
+    ownership of every message in it. The connection is kept open between
+    windows and reopened if the broker drops it
+    """
+
+    def __init__(self, url, queue_name, retries=3, manager=None):
+        """Constructor
+
+        Args:
+            url (str): The URL for the broker, including user/password
+            queue_name (str): The queue where the messages will be published
+            retries (int): How many times a window is published again on a
+            fresh connection before giving up
+            manager (ConnectionManager): If given, the channel is opened in
+            the connection shared by the manager instead of a new one
+        """
+        self._url = url
+        self._queue = queue_name
+        self._retries = retries
+        self._manager = manager
+        self._connection = None
+        self._channel = None
+
+    def _connect(self):
+        """Opens the connection and a transactional channel, if needed
+        """
+        if self._channel is not None and self._channel.is_open:
+            return
+        self.close()
+        if self._manager is not None:
+            connection = self._manager.connection()
+        else:
+            self._connection = amqpstorm.UriConnection(self._url)
+            connection = self._connection
+        self._channel = connection.channel(rpc_timeout=120)
+        self._channel.queue.declare(self._queue, durable=True)
+        self._channel.tx.select()
+
+    def publish(self, bodies, properties=None):
+        """Publishes a window of messages and waits for the broker to commit
+        them. If the commit fails, the whole window is published again on a
+        new channel (the messages may be delivered more than once)
+
+        Args:
+            bodies (list): The bodies of the messages
+            properties (dict): The AMQP properties, persistent by default
+
+        Raises:
+            AMQPError: When the window couldn't be committed after retrying
+        """
+        if properties is None:
+            properties = PERSISTENT
+        for attempt in range(self._retries + 1):
+            try:
+                self._connect()
+                for body in bodies:
+                    self._channel.basic.publish(body, self._queue,
+                                                exchange='',
+                                                properties=dict(properties))
+                self._channel.tx.commit()
+                return
+            except amqpstorm.AMQPError:
+                self.close()
+                if attempt == self._retries:
+                    raise
+
+    def close(self):
+        """Closes the channel and, if it owns it, the connection. Any
+        uncommitted message is discarded
+        """
+        if self._channel is not None:
+            try:
+                self._channel.close()
+            except amqpstorm.AMQPError:
+                pass
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except amqpstorm.AMQPError:
+                pass
+        self._connection = None
+        self._channel = None
+
+
+class ConnectionManager(object):
+    """Keeps a single connection to the broker for the whole process and
+    hands each thread its own persistent channel on it. If the broker drops
+    the connection, it's opened again the next time a thread needs it
+    """
+
+    def __init__(self, url):
+        """Constructor
+
+        Args:
+            url (str): The URL for the broker, including user/password
+        """
+        self._url = url
+        self._lock = threading.Lock()
+        self._connection = None
+        self._local = threading.local()
+        self._publishers = []
+
+    def connection(self):
+        """Returns the shared connection, opening it if needed
+
+        Returns:
+            UriConnection: An open connection
+        """
+        with self._lock:
+            if self._connection is None or not self._connection.is_open:
+                self._connection = amqpstorm.UriConnection(self._url)
+            return self._connection
+
+    def publisher(self, queue_name):
+        """Returns the BatchPublisher of the calling thread for a queue
+
+        Args:
+            queue_name (str): The queue where the messages will be published
+
+        Returns:
+            BatchPublisher: A publisher that is reused by this thread
+        """
+        publishers = getattr(self._local, 'publishers', None)
+        if publishers is None:
+            publishers = self._local.publishers = {}
+        if queue_name not in publishers:
+            publisher = BatchPublisher(self._url, queue_name, manager=self)
+            publishers[queue_name] = publisher
+            with self._lock:
+                self._publishers.append(publisher)
+        return publishers[queue_name]
+
+    def close(self):
+        """Closes every channel and the shared connection
+        """
+        with self._lock:
+            publishers, self._publishers = self._publishers, []
+            connection, self._connection = self._connection, None
+        for publisher in publishers:
+            publisher.close()
+        if connection is not None:
+            try:
+                connection.close()
+            except amqpstorm.AMQPError:
+                pass
+
+
+def iter_messages(url, queue_name, delete=False, prefetch=DEFAULT_PREFETCH,
+                  timeout=DEFAULT_READ_TIMEOUT):
+    """Reads every message that is in a queue when the reader starts. The
+    messages are pushed by the broker (basic.consume) and settled in
+    batches, so only `prefetch` of them are held at a time.
+
+    Without delete, each batch is published again at the tail of the queue
+    and acknowledged in the same transaction, so the queue ends with the
+    same messages in the same order. (Requeueing with nack would put them
+    back at the head, where they would be delivered again.)
+
+    Args:
+        url (str): The URL for the broker, including user/password
+        queue_name (str): The name of the queue
+        delete (bool): Remove the messages from the queue
+        prefetch (int): Maximum number of unsettled messages
+        timeout (float): Stop if no message arrives in this many seconds,
+        e.g. when another consumer empties the queue
+
+    Yields:
+        str: The body of each message
+    """
+    connection = amqpstorm.UriConnection(url)
+    channel = connection.channel(rpc_timeout=120)
+    count = channel.queue.declare(queue_name, durable=True)['message_count']
+    batch = max(1, prefetch // 2)
+    pending = []
+    last_tag = None
+
+    def settle():
+        if last_tag is None:
+            return
+        if not delete:
+            for body, properties in pending:
+                channel.basic.publish(body, queue_name, exchange='',
+                                      properties=properties)
+        channel.basic.ack(last_tag, multiple=True)
+        if not delete:
+            channel.tx.commit()
+        del pending[:]
+
+    try:
+        if not delete:
+            channel.tx.select()
+        channel.basic.qos(prefetch)
+        channel.basic.consume(queue=queue_name, no_ack=False)
+        received = 0
+        last_message = time.time()
+        while received < count:
+            for message in channel.build_inbound_messages(
+                    break_on_empty=True):
+                received += 1
+                last_tag = message.delivery_tag
+                last_message = time.time()
+                if not delete:
+                    pending.append((message.body, message.properties))
+                yield message.body
+                if received % batch == 0:
+                    settle()
+                    last_tag = None
+                if received >= count:
+                    break
+            if time.time() - last_message > timeout:
+                break
+            time.sleep(0.01)
+        settle()
+    finally:
+        connection.close()
+
+
+def peek_messages(url, queue_name):
+    """Reads every message in a small queue, e.g. the templates, and leaves
+    them there. They are taken with basic.get and requeued at once when the
+    queue is empty, so there is no waiting for deliveries
+
+    Args:
+        url (str): The URL for the broker, including user/password
+        queue_name (str): The name of the queue
+
+    Returns:
+        list: The bodies of the messages
+    """
+    connection = amqpstorm.UriConnection(url)
+    try:
+        channel = connection.channel(rpc_timeout=120)
+        channel.queue.declare(queue_name, durable=True)
+        bodies = []
+        last_tag = None
+        while True:
+            message = channel.basic.get(queue_name, no_ack=False)
+            if message is None:
+                break
+            bodies.append(message.body)
+            last_tag = message.delivery_tag
+        if last_tag is not None:
+            channel.basic.nack(last_tag, multiple=True, requeue=True)
+        return bodies
+    finally:
+        connection.close()
+
+
+def iter_results(url, queue_name, delete=False, prefetch=DEFAULT_PREFETCH,
+                 timeout=DEFAULT_READ_TIMEOUT):
+    """Reads the results in a queue, see iter_messages. Both the JSON and the
+    packed messages are understood, see codec.decode_results
+
+    Yields:
+        dict: Each non empty result
+    """
+    for body in iter_messages(url, queue_name, delete, prefetch, timeout):
+        for result in codec.decode_results(body):
+            if any(result):  # Avoid empty json objects
+                yield result
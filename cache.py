@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""Content addressed cache of task results. A task is identified by the
+hash of its command, arguments and external data, so the same simulation
+from another sweep (or a previous run of the same one) is not executed again
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+log = logging.getLogger(__name__)
+# An eviction leaves the cache at this fraction of its limits, so the
+# folder isn't listed again on every put once it's full
+LOW_WATER = 0.9
+
+
+def task_key(command, arguments, external_data):
+    """Computes the key of a task in the cache
+
+    Args:
+        command (str): The command of the task
+        arguments (str): Its arguments, before the {edf} substitution
+        external_data (str): The contents of its external data file
+
+    Returns:
+        str: Hexadecimal SHA-256 digest
+    """
+    content = json.dumps([command, arguments, external_data])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def row_id(names, values):
+    """Computes a task id from its parameters instead of its position, so a
+    task keeps its id when the sweep is published again, reordered or with
+    rows added. Identical rows get the same id
+
+    Args:
+        names (list): The names of the parameters
+        values (list): The values of the row
+
+    Returns:
+        str: 16 hexadecimal digits of a SHA-1 digest
+    """
+    content = ''.join('{0}={1}\n'.format(name, value)
+                      for name, value in zip(names, values))
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()[:16]
+
+
+class ResultCache(object):
+    """Stores the results of each task in a file named after its key in a
+    local folder, which can be shared by several processes. The least
+    recently used entries are evicted when the limits are exceeded
+    """
+
+    def __init__(self, folder, max_entries=None, max_bytes=None,
+                 max_age=None):
+        """Constructor
+
+        Args:
+            folder (str): Where the entries are stored, created if needed
+            max_entries (int): Maximum number of entries, no limit if None
+            max_bytes (int): Maximum size of all the entries, no limit if None
+            max_age (float): Entries not used in this many seconds are
+            discarded, they never expire if None
+        """
+        self._folder = folder
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        entries = self._entries()
+        self._count = len(entries)
+        self._bytes = sum(size for _, size, _ in entries)
+
+    @staticmethod
+    def from_config(cfg):
+        """Creates the cache described in the [cache] section
+
+        Args:
+            cfg (RawConfigParser): The configuration reader
+
+        Returns:
+            ResultCache: A new instance, None if the cache isn't enabled
+        """
+        folder = cfg.get('cache', 'folder', fallback=None)
+        if not folder:
+            return None
+        max_entries = cfg.getint('cache', 'max_entries', fallback=0)
+        max_size = cfg.getfloat('cache', 'max_size_mb', fallback=0)
+        max_age = cfg.getfloat('cache', 'max_age_days', fallback=0)
+        return ResultCache(folder, max_entries or None,
+                           int(max_size * 1024 * 1024) or None,
+                           max_age * 24 * 3600 or None)
+
+    def _path(self, key):
+        return os.path.join(self._folder, key + '.json')
+
+    def _entries(self):
+        """Lists the stored entries
+
+        Returns:
+            list: A (path, size, mtime) tuple per entry
+        """
+        entries = []
+        for name in os.listdir(self._folder):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self._folder, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # Evicted by another process
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def get(self, key, task_id=None):
+        """Looks up the results of a task
+
+        Args:
+            key (str): The key of the task, see task_key
+            task_id (object): If given, it replaces the task_id in the
+            results, which belongs to the task that computed them
+
+        Returns:
+            list: The JSON formatted results, None if they aren't cached
+        """
+        path = self._path(key)
+        try:
+            if self._max_age and \
+                    time.time() - os.stat(path).st_mtime > self._max_age:
+                self._remove(path)
+                return None
+            with open(path, 'r') as entry:
+                results = json.load(entry)
+            # The modification time orders the entries for the eviction
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        if task_id is not None:
+            results = [json.dumps(dict(json.loads(r), task_id=task_id))
+                       for r in results]
+        return results
+
+    def put(self, key, results):
+        """Stores the results of a task
+
+        Args:
+            key (str): The key of the task, see task_key
+            results (list): Its JSON formatted results
+        """
+        path = self._path(key)
+        content = json.dumps(results)
+        try:
+            previous = os.stat(path).st_size
+        except FileNotFoundError:
+            previous = None
+        with tempfile.NamedTemporaryFile('w', dir=self._folder,
+                                         suffix='.tmp', delete=False) as new:
+            new.write(content)
+        os.replace(new.name, path)
+        with self._lock:
+            if previous is None:
+                self._count += 1
+            self._bytes += len(content) - (previous or 0)
+            exceeded = (self._max_entries and
+                        self._count > self._max_entries) or \
+                       (self._max_bytes and self._bytes > self._max_bytes)
+            if exceeded:
+                self._evict()
+
+    def _remove(self, path):
+        try:
+            size = os.stat(path).st_size
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._count -= 1
+            self._bytes -= size
+
+    def _evict(self):
+        """Removes the least recently used entries until the cache is at
+        LOW_WATER of its limits. The totals are recomputed from the folder,
+        as other processes may have changed it
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self._count = len(entries)
+        self._bytes = sum(size for _, size, _ in entries)
+        max_entries = int((self._max_entries or 0) * LOW_WATER)
+        max_bytes = int((self._max_bytes or 0) * LOW_WATER)
+        for path, size, _ in entries:
+            if (not self._max_entries or self._count <= max_entries) \
+                    and (not self._max_bytes or self._bytes <= max_bytes):
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._count -= 1
+            self._bytes -= size
+        log.debug('Cache with %d entries, %d bytes', self._count, self._bytes)
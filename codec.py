@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""Compact encoding of the messages. The fields shared by the tasks of
+a sweep (command, arguments, folder and the names of the parameters) form a
+template, published once to its own queue; each message only carries the id,
+the values of the parameters and the fields that change, optionally
+compressed with zlib. Task decodes both this format and the legacy JSON.
+
+The results can be packed too: every result of a publish window goes in a
+single compressed message, grouped by schema (their metric names) with the
+values stored by column in binary. decode_results reads both formats
+"""
+import hashlib
+import json
+import struct
+import threading
+import time
+import zlib
+
+# Fields of a task stored in the template
+TEMPLATE_FIELDS = ('command', 'arguments', 'external_data_folder')
+# Also stored in the template when the task has them
+OPTIONAL_FIELDS = ('batch_arguments',)
+# First byte of a zlib stream with the default window
+ZLIB_HEADER = 0x78
+# Prefix of the packed results, JSON never starts like this
+RESULTS_MAGIC = b'DXR1'
+RESULT_ENCODINGS = ('json', 'packed')
+# Layout of the columns of packed results: 64 bit integers, doubles, or
+# any other value as a JSON array
+INTEGER, FLOAT, OTHER = 'q', 'd', 'j'
+# Reads of the templates queue again when a template is still missing:
+# while another worker reads it, its messages are hidden from the rest
+TEMPLATE_RETRIES = 3
+TEMPLATE_RETRY_WAIT = 0.2
+
+
+class UnknownTemplate(KeyError):
+    """A compact message refers to a template that couldn't be found
+    """
+
+
+def template_queue(queue_name):
+    """Returns the name of the queue with the templates of a tasks queue
+    """
+    return queue_name + '_templates'
+
+
+def split_external_data(external_data):
+    """Splits the external data written by the task creators
+
+    Args:
+        external_data (str): name=value lines
+
+    Returns:
+        tuple: The names and the values, None if the data can't be rebuilt
+        exactly from them
+    """
+    names = []
+    values = []
+    for line in external_data.split('\n')[:-1]:
+        name, separator, value = line.partition('=')
+        if not separator:
+            return None
+        names.append(name)
+        values.append(value)
+    if join_external_data(names, values) != external_data:
+        return None
+    return names, values
+
+
+def join_external_data(names, values):
+    """Inverse of split_external_data
+    """
+    return ''.join('{0}={1}\n'.format(name, value)
+                   for name, value in zip(names, values))
+
+
+class Encoder(object):
+    """Encodes the tasks of a coordinator. A new template is made whenever a
+    task doesn't match the previous ones
+    """
+
+    def __init__(self, compress=False, on_template=None, known=()):
+        """Constructor
+
+        Args:
+            compress (bool): Compress every message with zlib
+            on_template (callable): Called with the id and the template the
+            first time each template is used, before its first message is
+            returned; e.g. to publish it
+            known (iterable): Ids of the templates already published, they
+            are never passed to on_template
+        """
+        self._compress = compress
+        self._on_template = on_template
+        self._known = set(known)
+
+    def encode(self, task):
+        """Encodes a task
+
+        Args:
+            task (dict): The task, as made by the task creators
+
+        Returns:
+            bytes: The body of the message. Legacy JSON if the task doesn't
+            fit in a template
+        """
+        split = split_external_data(task.get('external_data', ''))
+        if split is None or 'id' not in task or \
+                any(field not in task for field in TEMPLATE_FIELDS):
+            return json.dumps(task).encode('utf-8')
+        names, values = split
+        template = {field: task[field] for field in
+                    TEMPLATE_FIELDS + OPTIONAL_FIELDS if field in task}
+        template['names'] = names
+        content = json.dumps(template, sort_keys=True).encode('utf-8')
+        template_id = hashlib.sha1(content).hexdigest()[:16]
+        if template_id not in self._known:
+            if self._on_template is not None:
+                self._on_template(template_id, template)
+            self._known.add(template_id)
+        extra = {name: value for name, value in task.items()
+                 if name not in template and
+                 name not in ('id', 'external_data')}
+        message = [template_id, task['id'], values]
+        if extra:
+            message.append(extra)
+        body = json.dumps(message, separators=(',', ':')).encode('utf-8')
+        if self._compress:
+            body = zlib.compress(body)
+        return body
+
+
+def decode(body, templates=None):
+    """Decodes a task message in any of the formats
+
+    Args:
+        body (str or bytes): The body of the message
+        templates (TemplateCache): Where the templates are looked up
+
+    Returns:
+        dict: The task
+
+    Raises:
+        UnknownTemplate: If the template of a compact message isn't found
+    """
+    if isinstance(body, bytes):
+        if body[:1] == bytes([ZLIB_HEADER]):
+            body = zlib.decompress(body)
+        body = body.decode('utf-8')
+    decoded = json.loads(body)
+    if isinstance(decoded, dict):
+        return decoded
+    if templates is None:
+        raise UnknownTemplate(decoded[0])
+    template = templates.get(decoded[0])
+    task = {field: value for field, value in template.items()
+            if field != 'names'}
+    task['id'] = decoded[1]
+    task['external_data'] = join_external_data(template['names'], decoded[2])
+    if len(decoded) > 3:
+        task.update(decoded[3])
+    return task
+
+
+class TemplateCache(object):
+    """Thread safe store of the templates known by a worker. When a message
+    refers to an unknown template, the templates queue is read again
+    """
+
+    def __init__(self, reader=None, retries=TEMPLATE_RETRIES,
+                 retry_wait=TEMPLATE_RETRY_WAIT):
+        """Constructor
+
+        Args:
+            reader (callable): Returns the bodies of the messages in the
+            templates queue without removing them, e.g. broker.peek_messages.
+            If None, only the templates added to this cache are known
+            retries (int): Reads again when a template is still missing
+            retry_wait (float): Seconds between them
+        """
+        self._reader = reader
+        self._retries = retries
+        self._retry_wait = retry_wait
+        self._lock = threading.Lock()
+        # Only one thread reads the queue, the others wait for it
+        self._refresh_lock = threading.Lock()
+        self._templates = {}
+
+    def add(self, body):
+        """Adds a template
+
+        Args:
+            body (str or bytes): A message of the templates queue
+        """
+        record = json.loads(body)
+        with self._lock:
+            self._templates[record['id']] = record['template']
+
+    def get(self, template_id):
+        """Returns a template
+
+        Args:
+            template_id (str): The id in the message
+
+        Returns:
+            dict: The template
+
+        Raises:
+            UnknownTemplate: If it isn't in the templates queue either
+        """
+        template = self._templates.get(template_id)
+        if template is None and self._reader is not None:
+            with self._refresh_lock:
+                # It may have been read while this thread was waiting
+                template = self._templates.get(template_id)
+                attempt = 0
+                while template is None and attempt <= self._retries:
+                    if attempt:
+                        time.sleep(self._retry_wait)
+                    self._read()
+                    template = self._templates.get(template_id)
+                    attempt += 1
+        if template is None:
+            raise UnknownTemplate(template_id)
+        return template
+
+    def __contains__(self, template_id):
+        return template_id in self._templates
+
+    def ids(self):
+        """Returns the ids of the known templates
+        """
+        with self._lock:
+            return set(self._templates)
+
+    def refresh(self):
+        """Reads every template in the templates queue
+        """
+        with self._refresh_lock:
+            self._read()
+
+    def _read(self):
+        for body in self._reader():
+            self.add(body)
+
+
+def publish_template(publisher, template_id, template):
+    """Publishes a template, it's committed when this returns
+
+    Args:
+        publisher (BatchPublisher): Publishes into the templates queue
+        template_id (str): Its id
+        template (dict): The template
+    """
+    publisher.publish([json.dumps({'id': template_id,
+                                   'template': template})])
+
+
+def _column_type(values):
+    # Mixed ints and floats stay in JSON, as doubles the ints would come
+    # back as floats and lose their digits beyond 2 ** 53
+    if all(type(v) is int for v in values):
+        if all(-2 ** 63 <= v < 2 ** 63 for v in values):
+            return INTEGER
+        return OTHER
+    if all(type(v) is float for v in values):
+        return FLOAT
+    return OTHER
+
+
+def schema_id(names):
+    """Identifies the metric names of a result
+
+    Args:
+        names (list): The names, in the order of the result
+
+    Returns:
+        str: The id
+    """
+    content = json.dumps(names).encode('utf-8')
+    return hashlib.sha1(content).hexdigest()[:16]
+
+
+def pack_results(results):
+    """Packs results in a single message
+
+    Args:
+        results (list): JSON formatted strings, or dicts
+
+    Returns:
+        bytes: The body of the message
+    """
+    groups = {}
+    for result in results:
+        if not isinstance(result, dict):
+            result = json.loads(result)
+        groups.setdefault(tuple(result), []).append(result)
+    header = []
+    columns = []
+    for names, rows in groups.items():
+        types = ''
+        for name in names:
+            values = [row[name] for row in rows]
+            kind = _column_type(values)
+            types += kind
+            if kind == OTHER:
+                data = json.dumps(values, separators=(',', ':'))
+                data = data.encode('utf-8')
+                columns.append(struct.pack('<I', len(data)) + data)
+            else:
+                columns.append(struct.pack('<{0}{1}'.format(len(values),
+                                                             kind), *values))
+        header.append({'schema': schema_id(list(names)), 'names': names,
+                       'types': types, 'rows': len(rows)})
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    payload = b''.join([struct.pack('<I', len(header)), header] + columns)
+    return RESULTS_MAGIC + zlib.compress(payload)
+
+
+def _unpack_results(body):
+    payload = zlib.decompress(body[len(RESULTS_MAGIC):])
+    size, = struct.unpack_from('<I', payload)
+    offset = 4 + size
+    results = []
+    for group in json.loads(payload[4:offset].decode('utf-8')):
+        rows = group['rows']
+        columns = []
+        for kind in group['types']:
+            if kind == OTHER:
+                size, = struct.unpack_from('<I', payload, offset)
+                data = payload[offset + 4:offset + 4 + size]
+                columns.append(json.loads(data.decode('utf-8')))
+                offset += 4 + size
+            else:
+                layout = '<{0}{1}'.format(rows, kind)
+                columns.append(struct.unpack_from(layout, payload, offset))
+                offset += struct.calcsize(layout)
+        names = group['names']
+        results.extend(dict(zip(names, values)) for values in zip(*columns))
+    return results
+
+
+def decode_results(body):
+    """Decodes a message of the results queue in any of the formats
+
+    Args:
+        body (str or bytes): The body of the message
+
+    Returns:
+        list: The results, as dicts
+    """
+    if isinstance(body, str):
+        if not body.startswith(RESULTS_MAGIC.decode('ascii')):
+            return [json.loads(body)]
+        # The client decoded the binary body because it was valid UTF-8
+        body = body.encode('utf-8')
+    if body.startswith(RESULTS_MAGIC):
+        return _unpack_results(body)
+    return [json.loads(body.decode('utf-8'))]
+
+
+def result_encoder(encoding):
+    """Returns the function that turns the results of a publish window into
+    the bodies of the messages
+
+    Args:
+        encoding (str): One of RESULT_ENCODINGS. json publishes each result
+        as is, packed all of them in a single message
+
+    Returns:
+        callable: Receives and returns a list
+
+    Raises:
+        ValueError: If the encoding is unknown
+    """
+    if encoding not in RESULT_ENCODINGS:
+        raise ValueError('Unknown result_encoding: {0}'.format(encoding))
+    if encoding == 'json':
+        return list
+
+    def pack(results):
+        return [pack_results(results)] if results else []
+    return pack
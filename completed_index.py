@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Index of the tasks already completed by a worker, used to skip the tasks
+that the broker delivers again (e.g. after a lost acknowledgement)
+"""
+import json
+import os
+import threading
+
+
+class CompletedIndex(object):
+    """Thread safe set of task ids. The ids are kept in memory for constant
+    time lookups and, if a path is given, appended to a file so the index
+    survives a restart of the worker
+    """
+
+    def __init__(self, path=None, read_only=False):
+        """Constructor, loads the ids already stored in path
+
+        Args:
+            path (str): The file where the ids are stored, one JSON value per
+            line. If None, the index only lives in memory
+            read_only (bool): Only load the file, e.g. the index of a worker
+            that may still be writing it; the new ids stay in memory
+        """
+        self._lock = threading.Lock()
+        self._ids = set()
+        self._file = None
+        if path:
+            if os.path.exists(path):
+                self._load(path, read_only)
+            if not read_only:
+                self._file = open(path, 'a')
+
+    def _load(self, path, read_only=False):
+        """Reads the stored ids. A last line cut by a crash is removed from
+        the file, it could be a prefix of another id
+        """
+        with open(path, 'rb') as stored:
+            content = stored.read()
+        end = content.rfind(b'\n') + 1
+        for line in content[:end].decode('utf-8').split('\n'):
+            line = line.strip()
+            if line:
+                self._ids.add(line)
+        if end < len(content) and not read_only:
+            with open(path, 'r+b') as stored:
+                stored.truncate(end)
+                stored.flush()
+                os.fsync(stored.fileno())
+
+    @staticmethod
+    def _key(task_id):
+        # JSON keeps 1 and '1' apart, as they are different ids in a task
+        return json.dumps(task_id)
+
+    def add(self, task_id):
+        """Marks a task as completed
+
+        Args:
+            task_id (object): The id of the task
+        """
+        self.add_all([task_id])
+
+    def add_all(self, task_ids):
+        """Marks several tasks as completed, with a single write to the file
+
+        Args:
+            task_ids (iterable): The ids of the tasks
+        """
+        with self._lock:
+            keys = []
+            for task_id in task_ids:
+                key = self._key(task_id)
+                if key not in self._ids:
+                    self._ids.add(key)
+                    keys.append(key)
+            if self._file is not None and keys:
+                self._file.write(''.join(key + '\n' for key in keys))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def __contains__(self, task_id):
+        return self._key(task_id) in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def close(self):
+        """Closes the file of the index
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -5,16 +5,28 @@
 # @Last Modified by:   Jairo Sanchez
 # @Last Modified time: 2018-04-11 19:56:44
 
-import amqpstorm
 import argparse
 import configparser
+import functools
 import os
 import sys
 import json
 import csv
+import queue
+import threading
+import time
+# Local files
+import broker
+import cache
+import codec
+import completed_index
+import ordering
+import sweep
 
 
 DEFAULT_CONFIG_FILE = './disexec.config'
+DEFAULT_PUBLISH_CHANNELS = 4
+DEFAULT_PUBLISH_WINDOW = 500
 
 
 class TaskCreator(object):
@@ -29,6 +41,16 @@ class TaskCreator(object):
         objects representing the tasks"""
         raise NotImplementedError('Implement this method in inherited class')
 
+    def iter_tasks(self):
+        """Lazily yields the tasks to be posted. The default implementation
+        wraps create_tasks, override it to avoid holding every task in memory
+
+        Yields:
+            dict: A task, ready to be serialized as JSON
+        """
+        for jsondesc in self.create_tasks():
+            yield json.loads(jsondesc)
+
 
 class ParamsInExternalFileCreator(TaskCreator):
 
@@ -58,34 +80,111 @@ class ParamsInExternalFileCreator(TaskCreator):
         Returns:
             list: List of JSON formatted strings
         """
-        json_tasks = []
-        names, values = self.read_csv_parameters(self._csv)
-        index = 0
-        for datatask in values:
+        return [json.dumps(task) for task in self.iter_tasks()]
+
+    def iter_tasks(self):
+        """Creates the tasks one at a time while the CSV file is read, so only
+        the current row is kept in memory
+
+        Yields:
+            dict: The task for each row of the CSV file
+        """
+        names, values = self.iter_rows()
+        build = self.task_builder(names)
+        for index, datatask in values:
+            yield build(index, datatask)
+
+    def task_builder(self, names):
+        """Returns the function that creates each task from a row, with the
+        settings of the [task] section
+
+        Args:
+            names (list): The names of the parameters in the rows
+
+        Returns:
+            callable: Receives the id of the task and the values of the row,
+            returns the task as a dict
+        """
+        # Folder where all the external_data files will be written, if not
+        # present, then it will use a temp folder
+        folder = self._config.get('task', 'external_folder')
+        # The command to execute in each worker, be aware of the $PATH
+        # in all of the workers
+        command = self._config.get('task', 'command')
+        # Extra arguments or flags in the command
+        arguments = self._config.get('task', 'arguments')
+        # Arguments with {edf_list} to run several tasks at once, see
+        # task.TaskGroup
+        batch_arguments = self._config.get('task', 'batch_arguments',
+                                           fallback=None)
+        # Cores needed by each task, for all of them or from a column
+        cores = self._config.getint('task', 'cores', fallback=None)
+        cores_column = self._config.get('task', 'cores_column', fallback=None)
+        if cores_column:
+            cores_position = names.index(cores_column)
+        row_ids = uses_row_ids(self._config)
+
+        def build(index, datatask):
             task = {}
             # A unique id, it'll be used as a filename (if external_data)
-            task['id'] = index
+            task['id'] = cache.row_id(names, datatask) if row_ids else index
             # The contents of this var will be written to a file and passed
             # to the command
-            sim_config = ''
-            for idx in range(len(datatask)):
-                sim_config = sim_config + '{0}={1}\n'.format(names[idx],
-                                                             datatask[idx])
-            task['external_data'] = sim_config
-            # Folder where all the external_data files will be written, if not
-            # present, then it will use a temp folder
-            task['external_data_folder'] = self._config.get('task',
-                                                            'external_folder')
-            # The command to execute in each worker, be aware of the $PATH
-            # in all of the workers
-            task['command'] = self._config.get('task', 'command')
-            # Extra arguments or flags in the command
-            task['arguments'] = self._config.get('task', 'arguments')
-
-            json_tasks.append(json.dumps(task))
-            index = index + 1
-
-        return json_tasks
+            task['external_data'] = ''.join('{0}={1}\n'.format(name, value)
+                                            for name, value in zip(names,
+                                                                   datatask))
+            task['external_data_folder'] = folder
+            task['command'] = command
+            task['arguments'] = arguments
+            if batch_arguments:
+                task['batch_arguments'] = batch_arguments
+            if cores_column:
+                task['cores'] = int(datatask[cores_position])
+            elif cores is not None:
+                task['cores'] = cores
+            return task
+        return build
+
+    def iter_rows(self):
+        """Reads the rows of the CSV file in the order set by [coordinator]
+        order: as they are in the file (csv, the default) or the most
+        expensive first (longest_first). The cost of a row is read from the
+        cost_column, or predicted from the runtimes of the tasks in the
+        history (CSV files from results_to_csv, separated by commas)
+
+        Returns:
+            tuple: List with the names of columns in the first field, followed
+            by an iterator over (index, row) tuples, index being the position
+            of the row in the file
+
+        Raises:
+            ValueError: If the order is unknown or has no source of costs
+        """
+        order = self._config.get('coordinator', 'order', fallback='csv')
+        if order == 'csv':
+            names, values = self.iter_csv_parameters(self._csv)
+            return names, enumerate(values)
+        if order != 'longest_first':
+            raise ValueError('Unknown order: {0}'.format(order))
+
+        column = self._config.get('coordinator', 'cost_column', fallback=None)
+        history = self._config.get('coordinator', 'history', fallback=None)
+        if column:
+            def cost_factory(names):
+                return ordering.column_cost(names, column)
+        elif history:
+            # By default the history comes from a previous run of this sweep
+            params = self._config.get('coordinator', 'history_csvfile',
+                                      fallback=self._csv)
+            results = [name.strip() for name in history.split(',')]
+
+            def cost_factory(names):
+                model = ordering.CostModel.from_history(
+                    names, results, params, uses_row_ids(self._config))
+                return model.predict
+        else:
+            raise ValueError('longest_first needs a cost_column or a history')
+        return ordering.longest_first(self._csv, cost_factory)
 
     def read_csv_parameters(self, csvfile):
         """Parses a csv file into two lists, one with the parameter names and
@@ -110,6 +209,86 @@ class ParamsInExternalFileCreator(TaskCreator):
         values = fields[1:]
         return col_names, values
 
+    def iter_csv_parameters(self, csvfile):
+        """Streaming version of read_csv_parameters, the rows are read from
+        the file only when they are requested
+
+        Args:
+            csvfile (str): The path to the CSV file to be parsed
+
+        Returns:
+            tuple: List with the names of columns in the first field, followed
+            by an iterator over the lists for each row
+        """
+        the_file = open(csvfile, 'r')
+        param_reader = csv.reader(the_file)
+        col_names = next(param_reader)
+
+        def rows():
+            with the_file:
+                for row in param_reader:
+                    yield row
+
+        return col_names, rows()
+
+
+class SweepCreator(ParamsInExternalFileCreator):
+    """Task creator for compact sweeps. A cell of the CSV file can be a list
+    {a;b;c} or a range {start:stop:step}, and the parameters in the [sweep]
+    section of [coordinator] sweepfile are combined with every row. Each
+    combination is a task, at a position in the order of the expansion (the
+    last parameter changes the fastest), which is also its id unless
+    task_ids = row. [coordinator] shard = first:last publishes only the
+    tasks at those positions, so several coordinators can share one sweep
+    """
+
+    def iter_tasks(self):
+        """Expands the sweep while the tasks are published
+
+        Yields:
+            dict: The task for each combination in the shard
+
+        Raises:
+            ValueError: If an order other than csv is requested, the sweep
+            is always published in the order of the expansion
+        """
+        order = self._config.get('coordinator', 'order', fallback='csv')
+        if order != 'csv':
+            raise ValueError('SweepCreator does not support order = '
+                             '{0}'.format(order))
+        names = []
+        rows = [[]]
+        if self._csv:
+            names, rows = self.iter_csv_parameters(self._csv)
+        extra_names = []
+        extra = []
+        sweepfile = self._config.get('coordinator', 'sweepfile',
+                                     fallback=None)
+        if sweepfile:
+            extra_names, extra = sweep.read_sweep_file(sweepfile)
+        first, last = sweep.parse_shard(
+            self._config.get('coordinator', 'shard', fallback=':'))
+        build = self.task_builder(names + extra_names)
+        for index, values in sweep.expand(rows, extra, first, last):
+            yield build(index, values)
+
+
+def uses_row_ids(config):
+    """Reads [coordinator] task_ids: position (the default) numbers the tasks
+    in the order they're created, row derives each id from its parameters
+    (see cache.row_id)
+
+    Returns:
+        bool: True for row
+
+    Raises:
+        ValueError: If the value is unknown
+    """
+    task_ids = config.get('coordinator', 'task_ids', fallback='position')
+    if task_ids not in ('position', 'row'):
+        raise ValueError('Unknown task_ids: {0}'.format(task_ids))
+    return task_ids == 'row'
+
 
 def exit_with_error(why, code):
     """Terminates execution of this program
@@ -122,29 +301,423 @@ def exit_with_error(why, code):
     exit(code)
 
 
-def start(config):
+class ProgressCounter(object):
+    """Thread safe counter of the published tasks. It reports the progress
+    on the console at most once per interval, instead of once per message
+    """
+
+    def __init__(self, interval=1.0):
+        """Constructor
+
+        Args:
+            interval (float): Minimum seconds between two reports
+        """
+        self.total = 0
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._last = self._start
+
+    def add(self, count):
+        """Adds count to the published tasks and reports if it's time to
+
+        Args:
+            count (int): How many tasks were just published
+        """
+        with self._lock:
+            self.total += count
+            now = time.time()
+            if now - self._last >= self._interval:
+                self._last = now
+                self._report(now)
+
+    def done(self):
+        """Reports the final count
+        """
+        with self._lock:
+            self._report(time.time())
+        print()
+
+    def _report(self, now):
+        elapsed = max(now - self._start, 1e-9)
+        print('\rPublished {0} tasks ({1:.0f} msg/s)'
+              .format(self.total, self.total / elapsed), end='', flush=True)
+
+
+def _producer(url, queue_name, pending, window, progress, errors,
+              on_commit=None):
+    """Producer thread for publish_fast. Takes the serialized tasks from
+    pending and publishes them in windows of the given size
+
+    Args:
+        url (str): The URL for the queue, including user/password
+        queue_name (str): The name of the queue
+        pending (Queue): Where the tasks are read from, None means stop
+        window (int): Number of messages committed at once
+        progress (ProgressCounter): The shared counter
+        errors (list): Any exception that stops this producer is added here
+        on_commit (callable): See publish_fast
+    """
+    publisher = broker.BatchPublisher(url, queue_name)
+    batch = []
+    try:
+        while True:
+            body = pending.get()
+            if body is not None:
+                batch.append(body)
+            if batch and (body is None or len(batch) >= window):
+                if on_commit is None:
+                    publisher.publish(batch)
+                else:
+                    publisher.publish([item[1] for item in batch])
+                    on_commit([item[0] for item in batch])
+                progress.add(len(batch))
+                batch = []
+            if body is None:
+                break
+    except Exception as ex:
+        errors.append(ex)
+    finally:
+        publisher.close()
+
+
+def _put(pending, item, producers):
+    """Puts item in pending without blocking forever if the producers died
+
+    Returns:
+        bool: False if there is no producer left to take the item
+    """
+    while True:
+        try:
+            pending.put(item, timeout=1)
+            return True
+        except queue.Full:
+            if not any(thread.is_alive() for thread in producers):
+                return False
+
+
+def publish_fast(tasks, url, queue_name,
+                 channels=DEFAULT_PUBLISH_CHANNELS,
+                 window=DEFAULT_PUBLISH_WINDOW, on_commit=None):
+    """Publishes the tasks from several producer threads, each one with its
+    own connection. Every window of messages is committed before the next
+    one is sent, so a failure in the broker is detected and the window is
+    published again instead of silently losing tasks
+
+    Args:
+        tasks (iterable): The serialized tasks
+        url (str): The URL for the queue, including user/password
+        queue_name (str): The name of the queue
+        channels (int): Number of producer threads
+        window (int): Number of messages committed at once
+        on_commit (callable): If given, tasks are (task_id, body) pairs and
+        it's called with the ids of each window once it's committed, from
+        the producer threads
+
+    Returns:
+        int: The number of published tasks
+
+    Raises:
+        AMQPError: If any window couldn't be published
+    """
+    pending = queue.Queue(maxsize=channels * window)
+    progress = ProgressCounter()
+    errors = []
+    producers = []
+    for i in range(channels):
+        thread = threading.Thread(target=_producer,
+                                  args=(url, queue_name, pending, window,
+                                        progress, errors, on_commit))
+        thread.setName('producer-{}'.format(i))
+        thread.start()
+        producers.append(thread)
+
+    try:
+        for body in tasks:
+            if errors or not _put(pending, body, producers):
+                break
+    finally:
+        for _ in producers:
+            if not _put(pending, None, producers):
+                break
+        for thread in producers:
+            thread.join()
+        progress.done()
+
+    if errors:
+        raise errors[0]
+    return progress.total
+
+
+def answer_cached(tasks, result_cache, publisher,
+                  window=DEFAULT_PUBLISH_WINDOW, encode=list, on_commit=None):
+    """Publishes the cached results of the tasks that were already computed
+    and passes the rest through
+
+    Args:
+        tasks (iterable): The tasks, as dicts
+        result_cache (ResultCache): Where the results are looked up
+        publisher (BatchPublisher): Publishes into the results queue
+        window (int): Number of results committed at once
+        encode (callable): Makes the messages of a window of results, see
+        codec.result_encoder
+        on_commit (callable): Called with the ids of the answered tasks once
+        their results are committed, e.g. to checkpoint them
+
+    Yields:
+        dict: The tasks not found in the cache
+    """
+    batch = []
+    answered = []
+    hits = 0
+    for task in tasks:
+        key = cache.task_key(task['command'], task['arguments'],
+                             task['external_data'])
+        results = result_cache.get(key, task['id'])
+        if results is None:
+            yield task
+            continue
+        hits += 1
+        batch.extend(results)
+        answered.append(task['id'])
+        if len(batch) >= window:
+            _commit_answers(publisher, encode(batch), answered, on_commit)
+            batch = []
+            answered = []
+    if answered:
+        _commit_answers(publisher, encode(batch), answered, on_commit)
+    print('{0} tasks answered from the cache'.format(hits))
+
+
+def _commit_answers(publisher, bodies, task_ids, on_commit):
+    if bodies:
+        publisher.publish(bodies)
+    if on_commit is not None:
+        on_commit(task_ids)
+
+
+def open_results_indexes(config):
+    """Opens the [coordinator] results_index files, the index_file of the
+    workers, without modifying them
+
+    Args:
+        config (RawConfigParser): The configuration reader
+
+    Returns:
+        list: A CompletedIndex per file, the missing ones are skipped
+    """
+    paths = config.get('coordinator', 'results_index', fallback='')
+    indexes = []
+    for path in (path.strip() for path in paths.split(',')):
+        if not path:
+            continue
+        if not os.path.isfile(path):
+            print('No results index in {0}'.format(path))
+            continue
+        indexes.append(completed_index.CompletedIndex(path, read_only=True))
+    return indexes
+
+
+def missing_tasks(tasks, indexes):
+    """Passes through the tasks without their results
+
+    Args:
+        tasks (iterable): The tasks, as dicts
+        indexes (list): The CompletedIndex of each worker, see
+        open_results_indexes
+
+    Yields:
+        dict: The tasks not completed by any worker
+    """
+    complete = 0
+    for task in tasks:
+        # The same key as Task.done_key, a task of another sweep with the
+        # same id doesn't match
+        key = [task['id'], cache.task_key(task['command'], task['arguments'],
+                                          task['external_data'])]
+        if any(key in index for index in indexes):
+            complete += 1
+            continue
+        yield task
+    print('{0} tasks already have their results'.format(complete))
+
+
+def unpublished_tasks(tasks, checkpoint):
+    """Passes through the tasks not published yet
+
+    Args:
+        tasks (iterable): The tasks, as dicts
+        checkpoint (CompletedIndex): The ids of the published tasks
+
+    Yields:
+        dict: The tasks whose id isn't in the checkpoint
+    """
+    published = 0
+    for task in tasks:
+        if task['id'] in checkpoint:
+            published += 1
+            continue
+        yield task
+    print('{0} tasks were already published'.format(published))
+
+
+def open_checkpoint(config, resume=False, keep=False):
+    """Opens the [coordinator] checkpoint, the file with the ids of the tasks
+    committed to the queue. Unless resuming or keeping it, it's emptied first
+
+    Args:
+        config (RawConfigParser): The configuration reader
+        resume (bool): Keep the ids of the previous run, to skip them
+        keep (bool): Keep the ids of the previous run, e.g. when the
+        missing tasks of a run are published again
+
+    Returns:
+        CompletedIndex: The checkpoint, None if there is no such file
+
+    Raises:
+        ValueError: If resume is requested without a checkpoint
+    """
+    path = config.get('coordinator', 'checkpoint', fallback=None)
+    if not path:
+        if resume:
+            raise ValueError('Resuming needs a [coordinator] checkpoint')
+        return None
+    if not (resume or keep) and os.path.exists(path):
+        os.remove(path)
+    return completed_index.CompletedIndex(path)
+
+
+def stamp(task):
+    """Records in the task the moment it's published, the workers use it to
+    measure how long it waited in the queue
+
+    Args:
+        task (dict): The task
+
+    Returns:
+        dict: The same task
+    """
+    task['published'] = time.time()
+    return task
+
+
+def task_encoder(config, url, queue_name):
+    """Returns the function that makes the body of each task message, see
+    [coordinator] encoding
+
+    Args:
+        config (RawConfigParser): The configuration reader
+        url (str): The URL for the broker, including user/password
+        queue_name (str): The tasks queue
+
+    Returns:
+        tuple: The function, and the publisher of the templates (None with
+        the json encoding) to be closed when done
+    """
+    encoding = config.get('coordinator', 'encoding', fallback='json')
+    if encoding == 'json':
+        return json.dumps, None
+    if encoding != 'compact':
+        raise ValueError('Unknown encoding: {0}'.format(encoding))
+    templates_queue = codec.template_queue(queue_name)
+    # The templates of previous runs are still in the queue, they aren't
+    # published again
+    published = codec.TemplateCache(functools.partial(
+        broker.peek_messages, url, templates_queue))
+    published.refresh()
+    templates = broker.BatchPublisher(url, templates_queue)
+
+    def on_template(template_id, template):
+        # Committed before any task that refers to it is published
+        codec.publish_template(templates, template_id, template)
+
+    encoder = codec.Encoder(config.getboolean('coordinator', 'compress',
+                                              fallback=False),
+                            on_template, published.ids())
+    return encoder.encode, templates
+
+
+def _commit_tasks(publisher, batch, on_commit):
+    # The checkpoint only gets the tasks the broker has committed
+    publisher.publish([body for _, body in batch])
+    if on_commit is not None:
+        on_commit([task_id for task_id, _ in batch])
+
+
+def start(config, fast=False, resume=False, missing=False, verbose=False):
     """Creates the TaskCreator object specified in the configuration file
     calls it and push the tasks to the Message queue
 
     Args:
         config (RawConfigParser): The configuration reader
+        fast (bool): Publish with several producers, showing only a progress
+        counter instead of every task
+        resume (bool): Skip the tasks in the [coordinator] checkpoint, i.e.
+        continue a run that was interrupted
+        missing (bool): Publish only the tasks not completed according to
+        the [coordinator] results_index files
+        verbose (bool): Without fast, print every task published
     """
     task_creator = config.get('coordinator', 'taskcreator')
-    csv_file = config.get('coordinator', 'csvfile')
+    csv_file = config.get('coordinator', 'csvfile', fallback=None)
     url = config.get('coordinator', 'queue_url')
     queue_name = config.get('general', 'queue_name')
 
     creator_class = getattr(sys.modules[__name__], task_creator)
     creator = creator_class(csv_file, config)
-    tasks = creator.create_tasks()
-    connection = amqpstorm.UriConnection(url)
-    channel = connection.channel(rpc_timeout=120)
-    channel.queue.declare(queue_name, durable=True)
-    for task in tasks:
-        print('Pushing into queue:\n{0}'.format(task))
-        channel.basic.publish(task, queue_name, exchange='',
-                              properties={'delivery_mode': 2})
-    connection.close()
+    # Tasks are created while they are published, never all at once
+    tasks = creator.iter_tasks()
+    if missing:
+        tasks = missing_tasks(tasks, open_results_indexes(config))
+    checkpoint = open_checkpoint(config, resume, keep=missing)
+    if resume:
+        tasks = unpublished_tasks(tasks, checkpoint)
+    on_commit = None
+    if checkpoint is not None:
+        on_commit = checkpoint.add_all
+    result_cache = cache.ResultCache.from_config(config)
+    results = None
+    if result_cache is not None:
+        results = broker.BatchPublisher(url, config.get('general',
+                                                        'results_queue_name'))
+        pack = codec.result_encoder(config.get('general', 'result_encoding',
+                                               fallback='json'))
+        tasks = answer_cached(tasks, result_cache, results, encode=pack,
+                              on_commit=on_commit)
+    encode, templates = task_encoder(config, url, queue_name)
+    tasks = ((task['id'], encode(stamp(task))) for task in tasks)
+    window = config.getint('coordinator', 'publish_window',
+                           fallback=DEFAULT_PUBLISH_WINDOW)
+    try:
+        if fast:
+            channels = config.getint('coordinator', 'publish_channels',
+                                     fallback=DEFAULT_PUBLISH_CHANNELS)
+            if on_commit is None:
+                tasks = (body for _, body in tasks)
+            publish_fast(tasks, url, queue_name, channels, window, on_commit)
+            return
+
+        publisher = broker.BatchPublisher(url, queue_name)
+        batch = []
+        try:
+            for task_id, task in tasks:
+                if verbose:
+                    print('Pushing into queue:\n{0}'.format(task))
+                batch.append((task_id, task))
+                if len(batch) >= window:
+                    _commit_tasks(publisher, batch, on_commit)
+                    batch = []
+            if batch:
+                _commit_tasks(publisher, batch, on_commit)
+        finally:
+            publisher.close()
+    finally:
+        if results is not None:
+            results.close()
+        if templates is not None:
+            templates.close()
+        if checkpoint is not None:
+            checkpoint.close()
 
 
 def main():
@@ -156,6 +729,23 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', help='Load the configuration file',
                         type=str)
+    parser.add_argument('-f', '--fast', action='store_true', default=False,
+                        help='Publish in committed windows from several \
+                              producers, showing only a progress counter')
+    parser.add_argument('-s', '--shard', type=str,
+                        help='Publish only the tasks at positions FIRST to \
+                              LAST - 1 of the sweep (SweepCreator), \
+                              overrides [coordinator] shard')
+    parser.add_argument('-r', '--resume', action='store_true', default=False,
+                        help='Skip the tasks already published according to \
+                              [coordinator] checkpoint')
+    parser.add_argument('-m', '--missing', action='store_true',
+                        default=False,
+                        help='Publish only the tasks not completed \
+                              according to [coordinator] results_index')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        default=False,
+                        help='Print every task published (without --fast)')
     args = parser.parse_args()
     config_file = DEFAULT_CONFIG_FILE
     if args.config:
@@ -170,7 +760,9 @@ def main():
     except Exception as e:
         exit_with_error(e, 1)
 
-    start(cfg)
+    if args.shard:
+        cfg.set('coordinator', 'shard', args.shard)
+    start(cfg, args.fast, args.resume, args.missing, args.verbose)
 
 
 if __name__ == '__main__':
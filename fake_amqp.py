@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+"""In-process stand-in for the subset of amqpstorm used by disexec. It keeps
+the queues in memory, so the coordinator and the workers can be exercised
+(and benchmarked) without a RabbitMQ server. Install it before importing the
+modules under test:
+
+    sys.modules['amqpstorm'] = fake_amqp
+
+Attributes:
+    BROKER (Broker): The broker shared by every connection in this process
+"""
+import collections
+import datetime
+import threading
+import time
+import uuid
+
+
+class AMQPError(IOError):
+    pass
+
+
+class AMQPConnectionError(AMQPError):
+    pass
+
+
+class AMQPChannelError(AMQPError):
+    pass
+
+
+class AMQPMessageError(AMQPChannelError):
+    pass
+
+
+class AMQPInvalidArgument(AMQPError):
+    pass
+
+
+class Broker(object):
+    """The in-memory queues. Every synchronous operation (the ones that wait
+    for a reply from a real server) sleeps `latency` seconds to simulate the
+    round trip
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Condition()
+        self.queues = {}
+
+    def reset(self, latency=None):
+        """Drops every queue, optionally changing the simulated latency
+        """
+        with self.lock:
+            self.queues = {}
+        if latency is not None:
+            self.latency = latency
+
+    def round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def declare(self, name):
+        with self.lock:
+            return self.queues.setdefault(name, collections.deque())
+
+    def push(self, name, messages):
+        with self.lock:
+            self.declare(name).extend(messages)
+            self.lock.notify_all()
+
+    def requeue(self, name, message):
+        with self.lock:
+            self.declare(name).appendleft(message)
+            self.lock.notify_all()
+
+    def pop(self, name):
+        with self.lock:
+            queue = self.declare(name)
+            if queue:
+                return queue.popleft()
+            return None
+
+    def count(self, name):
+        with self.lock:
+            return len(self.declare(name))
+
+
+BROKER = Broker()
+
+
+class UriConnection(object):
+
+    def __init__(self, uri, lazy=False):
+        self._uri = uri
+        self._channels = []
+        self.is_open = True
+        BROKER.round_trip()
+
+    def channel(self, rpc_timeout=60, lazy=False):
+        if not self.is_open:
+            raise AMQPConnectionError('connection closed')
+        channel = Channel(self)
+        self._channels.append(channel)
+        return channel
+
+    def close(self):
+        for channel in self._channels:
+            channel.close()
+        self.is_open = False
+
+    @property
+    def is_closed(self):
+        return not self.is_open
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Channel(object):
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._lock = threading.RLock()
+        self._next_tag = 0
+        self._unacked = {}
+        self._tx_buffer = None
+        self._prefetch = 0
+        self._consumers = collections.OrderedDict()
+        self._callbacks = {}
+        self.is_open = True
+        self.basic = _Basic(self)
+        self.queue = _Queue(self)
+        self.tx = _Tx(self)
+
+    @property
+    def is_closed(self):
+        return not self.is_open
+
+    def check_for_errors(self):
+        if not self.is_open or not self._connection.is_open:
+            raise AMQPChannelError('channel closed')
+
+    @property
+    def consumer_tags(self):
+        return list(self._consumers)
+
+    def confirm_deliveries(self):
+        self._confirming = True
+
+    def _fetch(self):
+        """Takes the next message for the consumers of this channel, as long
+        as the prefetch count allows it
+        """
+        with self._lock:
+            if self._prefetch and len(self._unacked) >= self._prefetch:
+                return None
+            consumers = list(self._consumers.items())
+        for tag, (queue_name, no_ack) in consumers:
+            message = BROKER.pop(queue_name)
+            if message is None:
+                continue
+            message.consumer_tag = tag
+            if no_ack:
+                message._bind(self, 0)
+                return message
+            return self._deliver(queue_name, message)
+        return None
+
+    def build_inbound_messages(self, break_on_empty=False, to_tuple=False,
+                               auto_decode=True):
+        self.check_for_errors()
+        while self.is_open:
+            message = self._fetch()
+            if message is None:
+                if break_on_empty:
+                    break
+                self.check_for_errors()
+                time.sleep(0.01)
+                continue
+            yield message
+
+    def process_data_events(self, to_tuple=False, auto_decode=True):
+        if not self._consumers:
+            raise AMQPChannelError('no consumer callback defined')
+        for message in self.build_inbound_messages(break_on_empty=True):
+            callback = self._callbacks.get(message.consumer_tag)
+            if callback is not None:
+                callback(message)
+
+    def start_consuming(self, to_tuple=False, auto_decode=True):
+        while self.is_open:
+            self.process_data_events()
+            if self._consumers:
+                time.sleep(0.01)
+                continue
+            break
+
+    def stop_consuming(self):
+        for tag in self.consumer_tags:
+            self.basic.cancel(tag)
+
+    def close(self):
+        if not self.is_open:
+            return
+        self.is_open = False
+        # The server requeues whatever this channel didn't acknowledge
+        with self._lock:
+            unacked = sorted(self._unacked.items(), reverse=True)
+            self._unacked = {}
+        for _, (queue_name, message) in unacked:
+            message._redelivered = True
+            BROKER.requeue(queue_name, message)
+
+    def _deliver(self, queue_name, message):
+        with self._lock:
+            self._next_tag += 1
+            message._bind(self, self._next_tag)
+            self._unacked[self._next_tag] = (queue_name, message)
+        return message
+
+    def _settle(self, delivery_tag, multiple, requeue):
+        with self._lock:
+            if multiple:
+                tags = [t for t in self._unacked if t <= delivery_tag]
+            else:
+                tags = [delivery_tag]
+            settled = [(t, self._unacked.pop(t)) for t in tags
+                       if t in self._unacked]
+        if requeue is None:
+            return
+        for _, (queue_name, message) in sorted(settled, reverse=True):
+            message._redelivered = True
+            if requeue:
+                BROKER.requeue(queue_name, message)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _Basic(object):
+
+    def __init__(self, channel):
+        self._channel = channel
+
+    def qos(self, prefetch_count=0, prefetch_size=0, global_=False):
+        self._channel.check_for_errors()
+        BROKER.round_trip()
+        self._channel._prefetch = prefetch_count
+
+    def consume(self, callback=None, queue='', consumer_tag='',
+                exclusive=False, no_ack=False, no_local=False, arguments=None):
+        self._channel.check_for_errors()
+        BROKER.round_trip()
+        tag = consumer_tag or str(uuid.uuid4())
+        self._channel._consumers[tag] = (queue, no_ack)
+        self._channel._callbacks[tag] = callback
+        return tag
+
+    def cancel(self, consumer_tag=''):
+        self._channel.check_for_errors()
+        BROKER.round_trip()
+        self._channel._consumers.pop(consumer_tag, None)
+        self._channel._callbacks.pop(consumer_tag, None)
+
+    def publish(self, body, routing_key, exchange='', properties=None,
+                mandatory=False, immediate=False):
+        self._channel.check_for_errors()
+        message = Message(None, body=body, properties=dict(properties or {}))
+        if self._channel._tx_buffer is not None:
+            self._channel._tx_buffer.append((routing_key, message))
+        else:
+            BROKER.push(routing_key, [message])
+        if getattr(self._channel, '_confirming', False):
+            BROKER.round_trip()
+            return True
+
+    def get(self, queue='', no_ack=False, to_dict=False, auto_decode=True):
+        self._channel.check_for_errors()
+        BROKER.round_trip()
+        message = BROKER.pop(queue)
+        if message is None or no_ack:
+            return message
+        return self._channel._deliver(queue, message)
+
+    def ack(self, delivery_tag=0, multiple=False):
+        self._channel.check_for_errors()
+        self._channel._settle(delivery_tag, multiple, None)
+
+    def nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self._channel.check_for_errors()
+        self._channel._settle(delivery_tag, multiple, requeue)
+
+    def reject(self, delivery_tag=0, requeue=True):
+        self.nack(delivery_tag, requeue=requeue)
+
+
+class _Queue(object):
+
+    def __init__(self, channel):
+        self._channel = channel
+
+    def declare(self, queue='', passive=False, durable=False,
+                exclusive=False, auto_delete=False, arguments=None):
+        self._channel.check_for_errors()
+        BROKER.round_trip()
+        return {'queue': queue, 'message_count': BROKER.count(queue),
+                'consumer_count': 0}
+
+    def purge(self, queue):
+        self._channel.check_for_errors()
+        BROKER.round_trip()
+        with BROKER.lock:
+            count = len(BROKER.declare(queue))
+            BROKER.declare(queue).clear()
+        return {'message_count': count}
+
+
+class _Tx(object):
+
+    def __init__(self, channel):
+        self._channel = channel
+
+    def select(self):
+        self._channel.check_for_errors()
+        BROKER.round_trip()
+        self._channel._tx_buffer = []
+
+    def commit(self):
+        self._channel.check_for_errors()
+        BROKER.round_trip()
+        pending = self._channel._tx_buffer or []
+        self._channel._tx_buffer = []
+        by_queue = collections.OrderedDict()
+        for routing_key, message in pending:
+            by_queue.setdefault(routing_key, []).append(message)
+        for routing_key, messages in by_queue.items():
+            BROKER.push(routing_key, messages)
+
+    def rollback(self):
+        self._channel.check_for_errors()
+        BROKER.round_trip()
+        self._channel._tx_buffer = []
+
+
+class Message(object):
+
+    def __init__(self, channel, auto_decode=True, body=None, properties=None):
+        self._channel = channel
+        self._body = body
+        self.properties = properties or {}
+        self.delivery_tag = None
+        self.consumer_tag = None
+        self._redelivered = False
+
+    @staticmethod
+    def create(channel, body, properties=None):
+        properties = dict(properties or {})
+        properties.setdefault('message_id', str(uuid.uuid4()))
+        properties.setdefault('timestamp', datetime.datetime.utcnow())
+        return Message(channel, body=body, properties=properties)
+
+    def _bind(self, channel, delivery_tag):
+        self._channel = channel
+        self.delivery_tag = delivery_tag
+
+    @property
+    def body(self):
+        return self._body
+
+    @property
+    def channel(self):
+        return self._channel
+
+    @property
+    def redelivered(self):
+        return self._redelivered
+
+    def ack(self):
+        self._channel.basic.ack(self.delivery_tag)
+
+    def nack(self, requeue=True):
+        self._channel.basic.nack(self.delivery_tag, requeue=requeue)
+
+    def reject(self, requeue=True):
+        self._channel.basic.reject(self.delivery_tag, requeue=requeue)
+
+    def publish(self, routing_key, exchange='', mandatory=False,
+                immediate=False):
+        return self._channel.basic.publish(self._body, routing_key, exchange,
+                                           self.properties, mandatory,
+                                           immediate)
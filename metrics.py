@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""Latency histograms of the phases of the tasks executed by a worker,
+written periodically to a file in the Prometheus text format (e.g. for the
+textfile collector of node_exporter)
+"""
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the buckets, in seconds. From the parsing of a report to
+# the longest simulations
+DEFAULT_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800,
+                   3600, 7200, 14400, 43200, 86400)
+DEFAULT_INTERVAL = 15
+METRIC = 'disexec_task_phase_seconds'
+
+
+class Histogram(object):
+    """Cumulative histogram with fixed buckets, like the Prometheus one
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Adds a value
+
+        Args:
+            value (float): The observed value
+        """
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def lines(self, name, labels):
+        """Returns the samples of this histogram in the text format
+
+        Args:
+            name (str): The name of the metric
+            labels (str): The labels, formatted as 'a="x",b="y"'
+
+        Returns:
+            list: The lines
+        """
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('{0}_bucket{{{1},le="{2}"}} {3}'
+                         .format(name, labels, bound, cumulative))
+        lines.append('{0}_bucket{{{1},le="+Inf"}} {2}'
+                     .format(name, labels, self.count))
+        lines.append('{0}_sum{{{1}}} {2}'.format(name, labels, self.sum))
+        lines.append('{0}_count{{{1}}} {2}'.format(name, labels, self.count))
+        return lines
+
+
+class PhaseMetrics(object):
+    """Thread safe histograms of the duration of each phase of the tasks:
+    queue, prepare, run, parse and publish. If a path is given, they're
+    written to it every interval seconds and when closed
+    """
+
+    def __init__(self, path=None, interval=DEFAULT_INTERVAL,
+                 buckets=DEFAULT_BUCKETS):
+        """Constructor
+
+        Args:
+            path (str): The file for the Prometheus text format, replaced on
+            every write. Nothing is written if None
+            interval (float): Seconds between two writes
+            buckets (tuple): Upper bounds of the buckets, in seconds
+        """
+        self._path = path
+        self._interval = interval
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._stop = threading.Event()
+        self._thread = None
+        if path:
+            self._thread = threading.Thread(target=self._run, name='metrics')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def observe(self, phase, seconds):
+        """Records the duration of a phase
+
+        Args:
+            phase (str): The name of the phase
+            seconds (float): Its duration
+        """
+        with self._lock:
+            histogram = self._histograms.get(phase)
+            if histogram is None:
+                histogram = Histogram(self._buckets)
+                self._histograms[phase] = histogram
+            histogram.observe(seconds)
+
+    def observe_all(self, timings):
+        """Records several phases at once
+
+        Args:
+            timings (dict): The seconds taken by each phase
+        """
+        for phase, seconds in timings.items():
+            self.observe(phase, seconds)
+
+    def render(self):
+        """Formats the histograms
+
+        Returns:
+            str: The metrics in the Prometheus text format
+        """
+        lines = ['# HELP {0} Duration of each phase of the tasks'
+                 .format(METRIC),
+                 '# TYPE {0} histogram'.format(METRIC)]
+        with self._lock:
+            for phase in sorted(self._histograms):
+                lines.extend(self._histograms[phase].lines(
+                    METRIC, 'phase="{0}"'.format(phase)))
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """Replaces the file atomically, so it's never read half written
+        """
+        temporary = self._path + '.tmp'
+        with open(temporary, 'w') as output:
+            output.write(self.render())
+        os.replace(temporary, self._path)
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self.write()
+            except OSError as ex:
+                log.error('Unable to write the metrics: %s', ex)
+
+    def close(self):
+        """Stops the periodic writes, writing the final values
+        """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.write()
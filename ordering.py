@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""Orders the rows of a sweep so the most expensive simulations are
+published first. Otherwise the long ones found at the end of the CSV file
+keep a few cores busy while the rest of the cluster is idle
+"""
+import csv
+import datetime
+import math
+# Local files
+import cache
+import parser
+
+# Regularization of the least squares fit, keeps it solvable when a
+# parameter is constant in the history
+RIDGE = 1e-6
+
+
+def parse_time(text):
+    """Parses the timestamps written by Task.result
+
+    Args:
+        text (str): A datetime in ISO 8601 format
+
+    Returns:
+        datetime: The parsed value
+    """
+    for layout in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(text, layout)
+        except ValueError:
+            pass
+    raise ValueError('Invalid timestamp: {0}'.format(text))
+
+
+def load_runtimes(results_files):
+    """Reads the runtime of each task from CSV files made by results_to_csv
+
+    Args:
+        results_files (list): The paths of the CSV files
+
+    Returns:
+        dict: The seconds taken by each task, by task_id (as a string)
+    """
+    runtimes = {}
+    for filename in results_files:
+        with open(filename, 'r') as results:
+            for result in csv.DictReader(results):
+                try:
+                    started = parse_time(result['execution_started'])
+                    finished = parse_time(result['execution_finished'])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                seconds = (finished - started).total_seconds()
+                task_id = result['task_id']
+                runtimes[task_id] = max(seconds, runtimes.get(task_id, 0))
+    return runtimes
+
+
+def _solve(matrix, vector):
+    """Solves a small linear system with Gaussian elimination
+    """
+    size = len(vector)
+    rows = [list(matrix[i]) + [vector[i]] for i in range(size)]
+    for column in range(size):
+        pivot = max(range(column, size), key=lambda r: abs(rows[r][column]))
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        if rows[column][column] == 0:
+            continue
+        for r in range(column + 1, size):
+            factor = rows[r][column] / rows[column][column]
+            for c in range(column, size + 1):
+                rows[r][c] -= factor * rows[column][c]
+    solution = [0.0] * size
+    for r in reversed(range(size)):
+        if rows[r][r] == 0:
+            continue
+        known = sum(rows[r][c] * solution[c] for c in range(r + 1, size))
+        solution[r] = (rows[r][size] - known) / rows[r][r]
+    return solution
+
+
+class CostModel(object):
+    """Least squares fit of the runtime of a task over the numeric
+    parameters of its CSV row, and their squares
+    """
+
+    def __init__(self, names):
+        """Constructor
+
+        Args:
+            names (list): The names of the columns of the CSV file
+        """
+        self._names = names
+        self._columns = []
+        self._means = []
+        self._scales = []
+        self._weights = None
+
+    def _numbers(self, row):
+        """Returns the numeric values of the fitted columns of a row, the
+        mean of the history where a value is missing
+        """
+        values = []
+        for column, mean in zip(self._columns, self._means):
+            try:
+                values.append(float(row[column]))
+            except (IndexError, ValueError):
+                values.append(mean)
+        return values
+
+    def _features(self, row):
+        features = [1.0]
+        for value, mean, scale in zip(self._numbers(row), self._means,
+                                      self._scales):
+            value = (value - mean) / scale
+            features.extend((value, value * value))
+        return features
+
+    def fit(self, rows, runtimes):
+        """Fits the model
+
+        Args:
+            rows (list): The CSV rows of the tasks in the history
+            runtimes (list): The seconds taken by each one
+        """
+        self._columns = []
+        for column in range(len(self._names)):
+            values = [parser.parse_value(row[column]) for row in rows
+                      if column < len(row)]
+            if values and all(isinstance(v, (int, float)) for v in values):
+                self._columns.append(column)
+        self._means = [0.0] * len(self._columns)
+        self._scales = [1.0] * len(self._columns)
+        samples = [self._numbers(row) for row in rows]
+        for i in range(len(self._columns)):
+            column = [sample[i] for sample in samples]
+            mean = sum(column) / len(column)
+            deviation = math.sqrt(sum((v - mean) ** 2 for v in column) /
+                                  len(column))
+            self._means[i] = mean
+            self._scales[i] = deviation or 1.0
+
+        features = [self._features(row) for row in rows]
+        size = len(features[0])
+        normal = [[sum(f[i] * f[j] for f in features) for j in range(size)]
+                  for i in range(size)]
+        for i in range(size):
+            normal[i][i] += RIDGE * len(rows)
+        target = [sum(f[i] * y for f, y in zip(features, runtimes))
+                  for i in range(size)]
+        self._weights = _solve(normal, target)
+
+    def predict(self, row):
+        """Estimates the runtime of a task
+
+        Args:
+            row (list): Its CSV row
+
+        Returns:
+            float: The estimated seconds
+        """
+        return sum(w * f for w, f in zip(self._weights, self._features(row)))
+
+    @staticmethod
+    def from_history(names, results_files, params_file, row_ids=False):
+        """Fits a model with the results of a previous execution
+
+        Args:
+            names (list): The columns of the CSV file to be ordered
+            results_files (list): The results of the previous execution,
+            written by results_to_csv
+            params_file (str): The CSV file of the previous execution, the
+            task_id of each result is a row of it
+            row_ids (bool): The task ids were made by cache.row_id instead
+            of being the position of the rows
+
+        Returns:
+            CostModel: The fitted model
+
+        Raises:
+            ValueError: If no result belongs to a row of params_file
+        """
+        runtimes = load_runtimes(results_files)
+        rows = []
+        seconds = []
+        with open(params_file, 'r') as params:
+            reader = csv.reader(params)
+            history_names = next(reader)
+            for index, row in enumerate(reader):
+                task_id = str(index)
+                if row_ids:
+                    task_id = cache.row_id(history_names, row)
+                if task_id in runtimes:
+                    # The columns are matched by name with the new sweep
+                    values = dict(zip(history_names, row))
+                    rows.append([values.get(name, '') for name in names])
+                    seconds.append(runtimes[task_id])
+        if not rows:
+            raise ValueError('No results match the rows of {0}'
+                             .format(params_file))
+        model = CostModel(names)
+        model.fit(rows, seconds)
+        return model
+
+
+def column_cost(names, column):
+    """Returns a cost function that reads a column of the row
+
+    Args:
+        names (list): The columns of the CSV file
+        column (str): The name of the column with the cost
+
+    Raises:
+        ValueError: If there is no such column
+    """
+    position = names.index(column)
+
+    def cost(row):
+        try:
+            return float(row[position])
+        except (IndexError, ValueError):
+            return 0.0
+    return cost
+
+
+def longest_first(csvfile, cost_factory):
+    """Reads the rows of a CSV file in decreasing order of cost. Only the
+    offset and the cost of each row are kept in memory, so every row must
+    be in a single line
+
+    Args:
+        csvfile (str): The path to the CSV file
+        cost_factory (callable): Receives the column names and returns a
+        function that estimates the cost of a row
+
+    Returns:
+        tuple: The list of column names, followed by an iterator over
+        (index, row) tuples, the index is the position of the row in the file
+    """
+    offsets = []
+    costs = []
+    with open(csvfile, 'rb') as the_file:
+        names = next(csv.reader([the_file.readline().decode('utf-8')]))
+        cost = cost_factory(names)
+        offset = the_file.tell()
+        for line in the_file:
+            offsets.append(offset)
+            offset += len(line)
+            costs.append(cost(next(csv.reader([line.decode('utf-8')]), [])))
+    # Stable, ties keep the order of the file
+    order = sorted(range(len(offsets)), key=costs.__getitem__, reverse=True)
+    del costs
+
+    def rows():
+        with open(csvfile, 'rb') as the_file:
+            for index in order:
+                the_file.seek(offsets[index])
+                line = the_file.readline().decode('utf-8')
+                yield index, next(csv.reader([line]), [])
+
+    return names, rows()
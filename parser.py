@@ -6,6 +6,16 @@
 # @Last Modified time: 2018-07-07 12:44:46
 import re
 import os
+import multiprocessing
+
+SCENARIO_REGEX = re.compile('.*scenario (.*)')
+# Integers and floats (only if there is a decimal part) in a single match
+NUMBER_REGEX = re.compile(r'^[+-]?\d+([.]\d+)?$')
+FILENAME_REGEX = re.compile(r'(.*)_(.*)Router_(\d+)n_\[(\d+)\]ttl_' +
+                            r'\[(\d+)\]s_seed\[(.*)\]_\[(\d+)M\]_' +
+                            r'\[(.*)\]_w\[(\d+)\]_MetricsReport.txt')
+# Number of files parsed by each process of parse_many at a time
+PARSE_CHUNK = 256
 
 
 class Parser(object):
@@ -46,60 +56,134 @@ class MessageStatsReportParser(Parser):
         if self._dict:
             return self._dict
         self._dict = {}
-        if os.path.exists(self._file):
-            with open(self._file, 'r') as report:
-                first_line = True
-                for line in report:
-                    if first_line:
-                        self._dict['id'] = re.compile('.*scenario (.*)')\
-                                             .match(line).groups()[0]
-                        self._dict['scenario'] = re.compile('.*scenario (.*)')\
-                                                   .match(line).groups()[0]
-                        first_line = False
-                        continue
-                    fields = line.strip().split(':')
-                    self._dict[fields[0]] = self._parse_value(fields[1])
-        else:
+        if not os.path.exists(self._file):
             raise FileNotFoundError('The provided path doesn\'t exists:{0}'
                                     .format(self._file))
-        return self._dict.update(self._parse_filename())
+        with open(self._file, 'r') as report:
+            scenario = SCENARIO_REGEX.match(report.readline()).groups()[0]
+            self._dict['id'] = scenario
+            self._dict['scenario'] = scenario
+            for line in report:
+                name, separator, value = line.strip().partition(':')
+                if separator:
+                    self._dict[name] = parse_value(value)
+        self._dict.update(self._parse_filename())
+        return self._dict
 
     def _parse_filename(self):
-        fn = os.path.basename(self._file)
-        filename_regex = re.compile('(.*)_(.*)Router_(\d+)n_\[(\d+)\]ttl_' +
-                                    '\[(\d+)\]s_seed\[(.*)\]_\[(\d+)M\]_' +
-                                    '\[(.*)\]_w\[(\d+)\]_MetricsReport.txt')
-        print('Matching ' + fn)
-        match = re.match(filename_regex, fn)
-        print(match)
-        if match:
-            return {'mobility': match.groups()[0],
-                    'router': match.groups()[1],
-                    'nodes': match.groups()[2],
-                    'ttl': match.groups()[3],
-                    'seed': match.groups()[5],
-                    'buffer_size': match.groups()[6],
-                    'message_interval': match.groups()[7],
-                    'exp_weight': match.groups()[8]}
+        """Extracts the parameters of the experiment encoded in the name of
+        the report file
+
+        Returns:
+            dict: The parameters, empty if the name doesn't follow the format
+        """
+        match = FILENAME_REGEX.match(os.path.basename(self._file))
+        if not match:
+            return {}
+        groups = match.groups()
+        return {'mobility': groups[0],
+                'router': groups[1],
+                'nodes': groups[2],
+                'ttl': groups[3],
+                'seed': groups[5],
+                'buffer_size': groups[6],
+                'message_interval': groups[7],
+                'exp_weight': groups[8]}
 
     def _parse_value(self, value_string):
-        """Tries to parse :value_string: guessing the data type
+        return parse_value(value_string)
 
-        Args:
-            value_string (str): The string representation to parse
 
-        Returns:
-            object: The value in the corresponding type (str, float, int)
-        """
-        integer = re.compile('^[+-]?\d+$')
-        floatno = re.compile('^[+-]?[\d]+[.][\d]+$')
-        value = None
-        value_string = value_string.strip()
-        if integer.match(value_string):
-            value = int(value_string)
-        else:
-            if floatno.match(value_string):
-                value = float(value_string)
+def parse_value(value_string):
+    """Tries to parse :value_string: guessing the data type
+
+    Args:
+        value_string (str): The string representation to parse
+
+    Returns:
+        object: The value in the corresponding type (str, float, int)
+    """
+    value_string = value_string.strip()
+    match = NUMBER_REGEX.match(value_string)
+    if match is None:
+        return value_string
+    if match.group(1) is None:
+        return int(value_string)
+    return float(value_string)
+
+
+def _parse_chunk(paths):
+    """Parses some report files into columns, executed by each process of
+    parse_many
+
+    Args:
+        paths (list): The paths to the report files
+
+    Returns:
+        dict: For each field, the list with its value in each file. None
+        where a file doesn't have the field
+    """
+    columns = {}
+    for row, path in enumerate(paths):
+        result = MessageStatsReportParser(path).get_results()
+        for name, value in result.items():
+            if name not in columns:
+                columns[name] = [None] * row
+            columns[name].append(value)
+        if len(result) < len(columns):
+            for column in columns.values():
+                if len(column) == row:
+                    column.append(None)
+    return columns
+
+
+def parse_many(paths, processes=None, as_numpy=False):
+    """Parses many report files in parallel into a columnar structure, which
+    is much more compact than one dict per file
+
+    Args:
+        paths (iterable): The paths to the report files
+        processes (int): Number of processes, the number of CPUs if None.
+        With 1 the files are parsed in the calling process
+        as_numpy (bool): Convert each column to a NumPy array (requires
+        NumPy). Numeric columns get a numeric dtype
+
+    Returns:
+        dict: For each field, the list (or array) with its value in each
+        file, in the same order as paths
+    """
+    paths = list(paths)
+    chunks = [paths[i:i + PARSE_CHUNK]
+              for i in range(0, len(paths), PARSE_CHUNK)]
+    if processes == 1:
+        parsed = map(_parse_chunk, chunks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes)
+        parsed = pool.imap(_parse_chunk, chunks)
+
+    columns = {}
+    rows = 0
+    try:
+        for chunk, partial in zip(chunks, parsed):
+            for name, values in partial.items():
+                if name not in columns:
+                    columns[name] = [None] * rows
+                columns[name].extend(values)
+            rows += len(chunk)
+            for column in columns.values():
+                if len(column) < rows:
+                    column.extend([None] * (rows - len(column)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if as_numpy:
+        import numpy
+        for name, values in columns.items():
+            if all(isinstance(v, (int, float)) for v in values):
+                columns[name] = numpy.array(values)
             else:
-                value = value_string
-        return value
+                columns[name] = numpy.array(values, dtype=object)
+    return columns
@@ -4,12 +4,16 @@
 # @Last Modified by:   Jairo Sanchez
 # @Last Modified time: 2018-04-11 19:43:47
 import csv
-import amqpstorm
+import broker
 import configparser
 import argparse
-import os
+import hashlib
 import json
+import os
 import logging
+import shutil
+import tempfile
+import parser
 
 
 DEFAULT_CONFIG_FILE = './disexec.config'
@@ -40,37 +44,212 @@ def get_results(url, queue, delete):
     Returns:
         list: List of dictionaries
     """
-    connection = amqpstorm.UriConnection(url)
-    channel = connection.channel()
-    channel.queue.declare(queue, durable=True)
-    received = []
-    while True:
-        msg = channel.basic.get(queue=queue, no_ack=False)
-        if msg is None:
-            break
-        result = json.loads(msg.body)
-        if any(result):  # Avoid empty json objects
-            received.append(json.loads(msg.body))
-        if delete:
-            msg.ack()
-    connection.close()
+    received = list(broker.iter_results(url, queue, delete))
     LOG.debug('Got %d elements', len(received))
     return received
 
 
-def persist_results(results, filename):
-    """Writes the content of results as a CSV file
+def result_key(result):
+    """Identifies a result by its content, used by the incremental export
 
     Args:
-        results (list of dict): The results to persist
-        filename (str): The path for the newly created csv file
+        result (dict): A result
+
+    Returns:
+        str: A digest of the result
+    """
+    content = json.dumps(result, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+
+def load_checkpoint(filename):
+    """Reads the keys of the results already exported
+
+    Args:
+        filename (str): The checkpoint file, one key per line
+
+    Returns:
+        set: The keys, empty if the file doesn't exist
+    """
+    if not os.path.exists(filename):
+        return set()
+    with open(filename, 'r') as checkpoint:
+        return set(line.strip() for line in checkpoint if line.strip())
+
+
+def read_header(filename):
+    """Returns the header of an existing CSV file, empty if there is none
+    """
+    if not os.path.exists(filename):
+        return []
+    with open(filename, 'r') as existing:
+        return next(csv.reader(existing), [])
+
+
+def persist_results(results, filename, checkpoint=None):
+    """Writes the results as a CSV file while they are read. The header is
+    the union of the fields of every result, in the order they appear.
+
+    Args:
+        results (iterable of dict): The results to persist
+        filename (str): The path for the csv file
+        checkpoint (str): If given, the results listed in this file are
+        skipped, the new ones are appended to the CSV file (extending its
+        header if needed) and then added to the checkpoint
+
+    Returns:
+        int: The number of rows written
     """
-    header = results[0].keys()
-    LOG.debug('Header: %s', header)
-    with open(filename, 'w') as output:
-        writer = csv.DictWriter(output, fieldnames=header)
+    exported = set()
+    header = []
+    if checkpoint:
+        exported = load_checkpoint(checkpoint)
+        header = read_header(filename)
+    previous = list(header)
+    folder = os.path.dirname(os.path.abspath(filename))
+    # The rows wait in a spool file until the complete header is known
+    with tempfile.TemporaryFile('w+', dir=folder) as spool, \
+            tempfile.TemporaryFile('w+', dir=folder) as new_keys:
+        rows = 0
+        columns = set(header)
+        for result in results:
+            if checkpoint:
+                key = result_key(result)
+                if key in exported:
+                    continue
+                exported.add(key)
+                new_keys.write(key + '\n')
+            for name in result:
+                if name not in columns:
+                    columns.add(name)
+                    header.append(name)
+            spool.write(json.dumps(result) + '\n')
+            rows += 1
+        LOG.debug('Header: %s', header)
+        spool.seek(0)
+
+        if previous and header != previous:
+            # New fields, the existing rows are written again with them
+            extend_header(filename, header)
+        mode = 'a' if previous else 'w'
+        with open(filename, mode) as output:
+            writer = csv.DictWriter(output, fieldnames=header)
+            if not previous:
+                writer.writeheader()
+            for line in spool:
+                writer.writerow(json.loads(line))
+
+        if checkpoint:
+            new_keys.seek(0)
+            with open(checkpoint, 'a') as stored:
+                shutil.copyfileobj(new_keys, stored)
+    LOG.debug('Wrote %d rows', rows)
+    return rows
+
+
+def extend_header(filename, header):
+    """Rewrites a CSV file with a wider header, the new fields are empty
+
+    Args:
+        filename (str): The CSV file
+        header (list): The new header, it must start with the current one
+    """
+    folder = os.path.dirname(os.path.abspath(filename))
+    with open(filename, 'r') as existing, \
+            tempfile.NamedTemporaryFile('w', dir=folder, delete=False) as new:
+        writer = csv.DictWriter(new, fieldnames=header)
         writer.writeheader()
-        writer.writerows(results)
+        for row in csv.DictReader(existing):
+            writer.writerow(row)
+    os.replace(new.name, filename)
+
+
+def csv_columns(filename):
+    """Reads a CSV file written by persist_results and infers the type of
+    each column
+
+    Args:
+        filename (str): The CSV file
+
+    Returns:
+        tuple: The number of rows, and for each column a (name, kind, size)
+        tuple; kind is 'i', 'f' or 'U' and size the longest string
+    """
+    with open(filename, 'r') as source:
+        reader = csv.reader(source)
+        header = next(reader)
+        kinds = [None] * len(header)
+        sizes = [1] * len(header)
+        missing = [False] * len(header)
+        rows = 0
+        for row in reader:
+            rows += 1
+            for i, cell in enumerate(row):
+                sizes[i] = max(sizes[i], len(cell))
+                if cell == '':
+                    missing[i] = True
+                    continue
+                if kinds[i] == 'U':
+                    continue
+                value = parser.parse_value(cell)
+                if isinstance(value, int):
+                    kinds[i] = kinds[i] or 'i'
+                elif isinstance(value, float):
+                    kinds[i] = 'f'
+                else:
+                    kinds[i] = 'U'
+    columns = []
+    for name, kind, size, empty in zip(header, kinds, sizes, missing):
+        if kind == 'i' and empty:
+            # Missing values are stored as NaN
+            kind = 'f'
+        columns.append((name, kind or 'U', size))
+    return rows, columns
+
+
+def persist_columnar(filename, destination):
+    """Converts the CSV file with the results into a columnar format that
+    can be memory mapped. If destination ends with .arrow, an Arrow IPC file
+    is written (requires pyarrow); otherwise destination is a folder with a
+    NumPy .npy file per column (requires numpy), to be opened with
+    numpy.load(path, mmap_mode='r')
+
+    Args:
+        filename (str): The CSV file
+        destination (str): The .arrow file or the folder for the .npy files
+    """
+    if destination.endswith('.arrow'):
+        import pyarrow.csv
+        import pyarrow.ipc
+        table = pyarrow.csv.read_csv(filename)
+        with pyarrow.ipc.new_file(destination, table.schema) as writer:
+            writer.write_table(table)
+        return
+
+    import numpy
+    rows, columns = csv_columns(filename)
+    os.makedirs(destination, exist_ok=True)
+    dtypes = {'i': numpy.int64, 'f': numpy.float64}
+    arrays = []
+    for name, kind, size in columns:
+        dtype = dtypes.get(kind, '<U{0}'.format(size))
+        path = os.path.join(destination, '{0}.npy'.format(name))
+        arrays.append(numpy.lib.format.open_memmap(path, mode='w+',
+                                                   dtype=dtype,
+                                                   shape=(rows,)))
+    with open(filename, 'r') as source:
+        reader = csv.reader(source)
+        next(reader)
+        for row, cells in enumerate(reader):
+            for array, (_, kind, _), cell in zip(arrays, columns, cells):
+                if kind == 'U':
+                    array[row] = cell
+                elif cell == '':
+                    array[row] = numpy.nan
+                else:
+                    array[row] = parser.parse_value(cell)
+    for array in arrays:
+        array.flush()
 
 
 def main():
@@ -84,6 +263,14 @@ def main():
                         help='Write the results to this file')
     parser.add_argument('-d', '--delete', default=False, action='store_true',
                         help='Deletes the data from the queue')
+    parser.add_argument('-i', '--incremental', default=False,
+                        action='store_true',
+                        help='Append only the results not exported before, \
+                              they are tracked in OUTPUT.checkpoint')
+    parser.add_argument('--columnar', type=str,
+                        help='Also write the results in a columnar format: \
+                              an Arrow file (*.arrow) or a folder of .npy \
+                              files')
     args = parser.parse_args()
 
     config_file = DEFAULT_CONFIG_FILE
@@ -100,11 +287,16 @@ def main():
     except Exception as e:
         exit_with_error(e, 2)
 
-    results = get_results(cfg.get('worker', 'queue_url'),
-                          cfg.get('general', 'results_queue_name'),
-                          args.delete)
+    results = broker.iter_results(cfg.get('worker', 'queue_url'),
+                                  cfg.get('general', 'results_queue_name'),
+                                  args.delete)
+    checkpoint = None
+    if args.incremental:
+        checkpoint = args.output + '.checkpoint'
 
-    persist_results(results, args.output)
+    persist_results(results, args.output, checkpoint)
+    if args.columnar:
+        persist_columnar(args.output, args.columnar)
 
 
 if __name__ == '__main__':
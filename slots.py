@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Assignment of the cores of a worker to the tasks that run in it. Each
+task takes as many cores as it declares, and its subprocess can be pinned
+to them so it doesn't migrate between cores or oversubscribe the machine
+"""
+import collections
+import glob
+import logging
+import os
+import re
+import threading
+
+log = logging.getLogger(__name__)
+
+NODE_CPULIST = '/sys/devices/system/node/node*/cpulist'
+
+
+def available_cpus():
+    """Returns the CPUs this process is allowed to run on
+
+    Returns:
+        list: The CPU numbers, in increasing order
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def parse_cpulist(text):
+    """Parses a Linux CPU list, e.g. '0-3,8,10-11'
+
+    Args:
+        text (str): The list
+
+    Returns:
+        list: The CPU numbers
+    """
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def numa_nodes():
+    """Reads the NUMA topology of the machine
+
+    Returns:
+        dict: The node of each CPU, empty if it's unknown
+    """
+    nodes = {}
+    for path in glob.glob(NODE_CPULIST):
+        node = int(re.search(r'node(\d+)', path).group(1))
+        with open(path, 'r') as cpulist:
+            for cpu in parse_cpulist(cpulist.read()):
+                nodes[cpu] = node
+    return nodes
+
+
+class CoreSlots(object):
+    """Thread safe pool of cores. The requests are served in arrival order,
+    so a task that needs many cores isn't starved by the small ones. The
+    cores of a request are taken from a single NUMA node when possible
+    """
+
+    def __init__(self, count=None, cpus=None, nodes=None):
+        """Constructor
+
+        Args:
+            count (int): How many cores to use, all the available if None
+            cpus (list): The cores to use, see available_cpus by default
+            nodes (dict): The NUMA node of each core, see numa_nodes by
+            default
+        """
+        if cpus is None:
+            cpus = available_cpus()
+        if count is not None:
+            cpus = cpus[:count]
+        if nodes is None:
+            nodes = numa_nodes()
+        self._nodes = {cpu: nodes.get(cpu, 0) for cpu in cpus}
+        self._free = set(cpus)
+        self._size = len(cpus)
+        self._waiting = collections.deque()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return self._size
+
+    def acquire(self, count):
+        """Waits until count cores are free and takes them
+
+        Args:
+            count (int): Number of cores, at most the size of the pool
+
+        Returns:
+            list: The cores taken, to be given back with release
+        """
+        if count > self._size:
+            log.warning('A task needs %d cores, only %d available', count,
+                        self._size)
+        count = max(1, min(count, self._size))
+        ticket = object()
+        with self._cond:
+            self._waiting.append(ticket)
+            while self._waiting[0] is not ticket or len(self._free) < count:
+                self._cond.wait()
+            self._waiting.popleft()
+            cpus = self._choose(count)
+            self._free.difference_update(cpus)
+            # The next request may fit in what is left
+            self._cond.notify_all()
+        return cpus
+
+    def _choose(self, count):
+        """Picks count free cores, from the node with the fewest free cores
+        that can hold them all, so the larger free blocks are kept
+        """
+        by_node = collections.defaultdict(list)
+        for cpu in sorted(self._free):
+            by_node[self._nodes[cpu]].append(cpu)
+        fitting = [cpus for cpus in by_node.values() if len(cpus) >= count]
+        if fitting:
+            return min(fitting, key=len)[:count]
+        chosen = []
+        for cpus in sorted(by_node.values(), key=len, reverse=True):
+            chosen.extend(cpus[:count - len(chosen)])
+            if len(chosen) == count:
+                break
+        return chosen
+
+    def release(self, cpus):
+        """Gives back the cores taken by acquire
+
+        Args:
+            cpus (list): The cores
+        """
+        with self._cond:
+            self._free.update(cpus)
+            self._cond.notify_all()
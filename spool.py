@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""Local, append-only storage for the results of the finished tasks. The
+worker threads only write to a file, a background thread publishes the
+results to the broker and discards them once the broker committed them
+"""
+import collections
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+
+log = logging.getLogger(__name__)
+
+# Results published in a single transaction
+DEFAULT_BATCH = 500
+# Seconds between attempts while the broker is unreachable
+RETRY_WAIT = 5
+# The file is rewritten with the pending entries once it reaches this size
+COMPACT_SIZE = 16 * 1024 * 1024
+# The sequence number at the start of an entry
+TORN_SEQ = re.compile(rb'^\{"seq": (\d+)')
+
+
+class ResultSpool(object):
+    """Disk backed queue of results. Each entry is a JSON line with the id of
+    the task and its results; a line {"done": seq} marks every entry up to seq
+    as published. The entries not published survive a restart of the worker
+    and are sent when the spool is opened again
+    """
+
+    def __init__(self, path, publish, batch=DEFAULT_BATCH,
+                 retry_wait=RETRY_WAIT):
+        """Constructor, loads the pending entries and starts the publisher
+
+        Args:
+            path (str): The spool file
+            publish (callable): Receives a list of results and returns once
+            the broker committed them, raises an exception otherwise
+            batch (int): Maximum number of results per call to publish
+            retry_wait (float): Seconds to wait after a failed publish
+        """
+        self._path = path
+        self._publish = publish
+        self._batch = batch
+        self._retry_wait = retry_wait
+        self._cond = threading.Condition()
+        self._pending = collections.deque()
+        self._closing = False
+        self._seq = 0
+        self._load()
+        self._file = open(path, 'a')
+        if self._pending:
+            log.info('%d tasks with results not published yet',
+                     len(self._pending))
+        self._thread = threading.Thread(target=self._run, name='spool')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _load(self):
+        """Reads the entries that weren't published before the last exit. A
+        last line cut by a crash is removed from the file, so the next entry
+        starts on a line of its own
+        """
+        if not os.path.exists(self._path):
+            return
+        entries = []
+        done = 0
+        with open(self._path, 'rb') as stored:
+            content = stored.read()
+        end = content.rfind(b'\n') + 1
+        for line in content[:end].splitlines():
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                log.warning('Skipping a corrupt line in %s', self._path)
+                continue
+            if 'done' in record:
+                done = max(done, record['done'])
+            else:
+                entries.append(record)
+                self._seq = max(self._seq, record['seq'])
+        if end < len(content):
+            # Its task was never acked, it will be delivered again
+            log.warning('Discarding an incomplete entry at the end of %s',
+                        self._path)
+            torn = TORN_SEQ.match(content[end:])
+            if torn:
+                # Its number is not given to the next entry
+                self._seq = max(self._seq, int(torn.group(1)))
+            with open(self._path, 'r+b') as stored:
+                stored.truncate(end)
+                stored.flush()
+                os.fsync(stored.fileno())
+        self._pending.extend(e for e in entries if e['seq'] > done)
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def append(self, task_id, results):
+        """Stores the results of a task. When this returns they're on disk
+
+        Args:
+            task_id (object): The id of the task
+            results (list): The JSON formatted results
+        """
+        with self._cond:
+            self._seq += 1
+            entry = {'seq': self._seq, 'task': task_id, 'results': results}
+            self._write(entry)
+            self._pending.append(entry)
+            self._cond.notify()
+
+    def __len__(self):
+        """Number of tasks whose results are waiting to be published
+        """
+        with self._cond:
+            return len(self._pending)
+
+    def _next_batch(self):
+        """Waits for entries and returns the first ones, up to the batch size
+        in results. They stay pending until _mark_done
+
+        Returns:
+            list: The entries, empty when the spool is closing
+        """
+        with self._cond:
+            while not self._pending and not self._closing:
+                self._cond.wait()
+            entries = []
+            count = 0
+            for entry in self._pending:
+                if entries and count + len(entry['results']) > self._batch:
+                    break
+                entries.append(entry)
+                count += len(entry['results'])
+            return entries
+
+    def _mark_done(self, entries):
+        """Records that the entries were published and drops them
+        """
+        with self._cond:
+            for _ in entries:
+                self._pending.popleft()
+            if not self._pending:
+                self._file.seek(0)
+                self._file.truncate()
+            elif self._file.tell() > COMPACT_SIZE:
+                self._compact()
+            else:
+                self._write({'done': entries[-1]['seq']})
+
+    def _compact(self):
+        """Rewrites the file with the pending entries only
+        """
+        self._file.close()
+        temporary = self._path + '.tmp'
+        with open(temporary, 'w') as compacted:
+            for entry in self._pending:
+                compacted.write(json.dumps(entry) + '\n')
+            compacted.flush()
+            os.fsync(compacted.fileno())
+        os.replace(temporary, self._path)
+        self._file = open(self._path, 'a')
+
+    def _run(self):
+        """Publisher thread
+        """
+        while True:
+            entries = self._next_batch()
+            if not entries:
+                break
+            results = list(itertools.chain.from_iterable(
+                e['results'] for e in entries))
+            try:
+                if results:
+                    self._publish(results)
+            except Exception as ex:
+                log.error('Unable to publish the results: %s', ex)
+                with self._cond:
+                    if self._closing:
+                        # They will be published when the spool is reopened
+                        break
+                    self._cond.wait(self._retry_wait)
+                continue
+            self._mark_done(entries)
+            log.debug('Published the results of %d tasks', len(entries))
+
+    def close(self):
+        """Publishes the pending results, unless the broker is unreachable,
+        and closes the file
+        """
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+        with self._cond:
+            if self._pending:
+                log.warning('%d tasks with results not published, they '
+                            'stay in %s', len(self._pending), self._path)
+            self._file.close()
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""Compact definition of parameter sweeps. Instead of writing every
+combination in the CSV file, a value can be a list {a;b;c} or a range
+{start:stop:step} (stop included), and the cartesian product of all of them
+is expanded lazily, in a deterministic order
+"""
+import configparser
+import re
+
+CELL_REGEX = re.compile(r'^\{(.*)\}$')
+# Decimals kept when the values of a range are floats
+RANGE_DIGITS = 10
+
+
+class Axis(object):
+    """The values a parameter takes in a sweep, computed on demand
+    """
+
+    def __init__(self, values=None, start=None, step=None, count=None):
+        self._values = values
+        self._start = start
+        self._step = step
+        self._count = count
+
+    @staticmethod
+    def parse(text):
+        """Parses the definition of the values of a parameter
+
+        Args:
+            text (str): 'a;b;c' for a list, 'start:stop:step' for a range
+            (step is 1 if omitted) or any other string for a single value.
+            [a;b] is a single value too, it's the syntax of ONE for the runs
+            of a batch
+
+        Returns:
+            Axis: The values
+
+        Raises:
+            ValueError: If the step of a range isn't positive
+        """
+        text = text.strip()
+        if text.startswith('[') and text.endswith(']'):
+            return Axis(values=[text])
+        if ';' in text:
+            return Axis(values=[v.strip() for v in text.split(';')])
+        parts = text.split(':')
+        if len(parts) not in (2, 3):
+            return Axis(values=[text])
+        try:
+            numbers = [_number(part) for part in parts]
+        except ValueError:
+            return Axis(values=[text])
+        start, stop = numbers[:2]
+        step = numbers[2] if len(numbers) == 3 else 1
+        if step <= 0:
+            raise ValueError('The step must be positive: {0}'.format(text))
+        # The small margin keeps the stop when it's reached with rounding
+        count = int((stop - start) / step + 1e-9) + 1
+        return Axis(start=start, step=step, count=max(count, 0))
+
+    def __len__(self):
+        if self._values is not None:
+            return len(self._values)
+        return self._count
+
+    def __getitem__(self, index):
+        if self._values is not None:
+            return self._values[index]
+        if not 0 <= index < self._count:
+            # Ends the iteration of the values
+            raise IndexError('Axis index out of range: {0}'.format(index))
+        value = self._start + index * self._step
+        if isinstance(value, float):
+            return repr(round(value, RANGE_DIGITS))
+        return str(value)
+
+
+def _number(text):
+    text = text.strip()
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def parse_cell(cell):
+    """Parses a cell of the CSV file
+
+    Args:
+        cell (str): The cell, {...} for a list or a range
+
+    Returns:
+        Axis: The values of the cell, a single one if it isn't a sweep
+    """
+    match = CELL_REGEX.match(cell.strip())
+    if match is None:
+        return Axis(values=[cell])
+    return Axis.parse(match.group(1))
+
+
+def read_sweep_file(filename, section='sweep'):
+    """Reads the parameters of an INI file, each one with the syntax of
+    Axis.parse. The names keep their case, unlike in the configuration
+
+    Args:
+        filename (str): The path of the file
+        section (str): The section with the parameters
+
+    Returns:
+        tuple: The names, and the Axis of each one
+    """
+    reader = configparser.RawConfigParser()
+    reader.optionxform = str
+    if not reader.read(filename):
+        raise FileNotFoundError('Sweep file not found: {0}'.format(filename))
+    names = list(reader.options(section))
+    return names, [Axis.parse(reader.get(section, name)) for name in names]
+
+
+def decode(position, axes):
+    """Returns the combination at a position of the product of the axes,
+    the last axis changes the fastest (like itertools.product)
+
+    Args:
+        position (int): The position in the product
+        axes (list): The Axis objects
+
+    Returns:
+        list: The index in each axis
+    """
+    indexes = [0] * len(axes)
+    for i in reversed(range(len(axes))):
+        position, indexes[i] = divmod(position, len(axes[i]))
+    return indexes
+
+
+def iter_product(axes, first=0, last=None):
+    """Iterates over a range of the cartesian product of the axes without
+    going through the combinations before it
+
+    Args:
+        axes (list): The Axis objects
+        first (int): Position of the first combination
+        last (int): Position after the last one, the end if None
+
+    Yields:
+        list: The values of each combination
+    """
+    total = size(axes)
+    last = total if last is None else min(last, total)
+    if first >= last:
+        return
+    indexes = decode(first, axes)
+    for _ in range(last - first):
+        yield [axis[i] for axis, i in zip(axes, indexes)]
+        # Increments the mixed radix number
+        for i in reversed(range(len(axes))):
+            indexes[i] += 1
+            if indexes[i] < len(axes[i]):
+                break
+            indexes[i] = 0
+
+
+def size(axes):
+    """Returns the number of combinations of the axes
+    """
+    total = 1
+    for axis in axes:
+        total *= len(axis)
+    return total
+
+
+def expand(rows, extra=(), first=0, last=None):
+    """Expands the rows of a sweep, each row into the product of its cells
+    and the extra axes. The combinations are numbered consecutively across
+    the rows, and only those in [first, last) are generated
+
+    Args:
+        rows (iterable): The rows of the CSV file, lists of cells
+        extra (list): Axes appended to every row, e.g. from a sweep file
+        first (int): Position of the first combination
+        last (int): Position after the last one, the end if None
+
+    Yields:
+        tuple: The position and the values of each combination
+    """
+    offset = 0
+    for row in rows:
+        axes = [parse_cell(cell) for cell in row] + list(extra)
+        count = size(axes)
+        if offset + count > first:
+            start = max(first - offset, 0)
+            stop = None if last is None else last - offset
+            for position, values in enumerate(iter_product(axes, start, stop),
+                                              offset + start):
+                yield position, values
+        offset += count
+        if last is not None and offset >= last:
+            break
+
+
+def parse_shard(text):
+    """Parses a range of positions, 'first:last' (last excluded, it can be
+    left empty to reach the end)
+
+    Args:
+        text (str): The range
+
+    Returns:
+        tuple: first and last, None if there is no last
+    """
+    first, _, last = text.partition(':')
+    return int(first or 0), int(last) if last.strip() else None
+
@@ -3,14 +3,248 @@
 # @Date:   2018-03-01 16:06:35
 # @Last Modified by:   Jairo Sánchez
 # @Last Modified time: 2018-05-08 16:02:03
+import asyncio
+import gzip
 import json
+import logging
 import os
 import tempfile
+import threading
 import subprocess
 import parser
 import re
+import cache
+import codec
 import datetime
 import platform
+import time
+
+# How much of the end of STDOUT and STDERR is kept in memory for each task
+DEFAULT_CAPTURE_LIMIT = 64 * 1024
+# Longer lines of STDOUT aren't scanned for report announcements
+MAX_LINE = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+# How the external data reaches the command: a file in external_data_folder,
+# an anonymous file in memory or its standard input
+DELIVERIES = ('file', 'memfd', 'stdin')
+# The external data folders already created by this process
+_FOLDERS = set()
+
+log = logging.getLogger(__name__)
+
+
+def config_delivery(cfg):
+    """Reads [worker] config_delivery, memfd falls back to stdin where the
+    platform doesn't have it
+
+    Args:
+        cfg (RawConfigParser): The configuration reader
+
+    Returns:
+        str: One of DELIVERIES
+
+    Raises:
+        ValueError: If the delivery is unknown
+    """
+    delivery = cfg.get('worker', 'config_delivery', fallback='file')
+    if delivery == 'memfd' and not hasattr(os, 'memfd_create'):
+        log.warning('memfd_create is not available, using stdin')
+        delivery = 'stdin'
+    if delivery not in DELIVERIES:
+        raise ValueError('Unknown config_delivery: {0}'.format(delivery))
+    return delivery
+
+
+class OutputCapture(object):
+    """Consumes the output of a subprocess as it is produced. Only the last
+    bytes of each stream are kept in memory, the report files announced in
+    STDOUT are collected on the fly and, optionally, the complete streams are
+    written to compressed log files
+    """
+    REPORT = re.compile(b'^Running simulation \'(.*)\'$')
+
+    def __init__(self, limit=DEFAULT_CAPTURE_LIMIT, log_prefix=None):
+        """Constructor
+
+        Args:
+            limit (int): Bytes kept from the end of each stream, none if 0
+            log_prefix (str): If given, the streams are also written to
+            log_prefix.stdout.gz and log_prefix.stderr.gz
+        """
+        self._limit = limit
+        self._tails = {'stdout': bytearray(), 'stderr': bytearray()}
+        self._logs = {}
+        if log_prefix:
+            for stream in self._tails:
+                self._logs[stream] = gzip.open('{0}.{1}.gz'.format(log_prefix,
+                                                                   stream),
+                                               'wb')
+        self._partial = bytearray()
+        self._overflow = False
+        self.reports = []
+
+    def write(self, stream, data):
+        """Adds a chunk of the output of the subprocess. Each stream must be
+        written by a single thread
+
+        Args:
+            stream (str): Either 'stdout' or 'stderr'
+            data (bytes): The chunk as it was read from the pipe
+        """
+        if self._limit > 0:
+            tail = self._tails[stream]
+            tail += data
+            # Trimming only when twice the limit is reached keeps it amortized
+            if len(tail) > 2 * self._limit:
+                del tail[:-self._limit]
+        if stream in self._logs:
+            self._logs[stream].write(data)
+        if stream == 'stdout':
+            self._scan(data)
+
+    def _scan(self, data):
+        """Looks for the report files in the complete lines of STDOUT
+        """
+        self._partial += data
+        lines = self._partial.split(b'\n')
+        self._partial = lines.pop()
+        for line in lines:
+            if self._overflow:
+                # The end of a line too long to be a report announcement
+                self._overflow = False
+                continue
+            self._match(line)
+        if len(self._partial) > MAX_LINE:
+            self._partial = bytearray()
+            self._overflow = True
+
+    def _match(self, line):
+        match = self.REPORT.match(line.rstrip(b'\r'))
+        if match:
+            filename = match.groups()[0].decode('utf-8')
+            self.reports.append(filename + '_MetricsReport.txt')
+
+    def close(self):
+        """Processes the last line and closes the log files
+        """
+        if self._partial and not self._overflow:
+            self._match(self._partial)
+        self._partial = bytearray()
+        for log in self._logs.values():
+            log.close()
+
+    def stdout(self):
+        """Returns the end of STDOUT
+
+        Returns:
+            bytes: The last bytes written to STDOUT
+        """
+        return self._tail('stdout')
+
+    def stderr(self):
+        """Returns the end of STDERR
+
+        Returns:
+            bytes: The last bytes written to STDERR
+        """
+        return self._tail('stderr')
+
+    def _tail(self, stream):
+        if self._limit <= 0:
+            return b''
+        return bytes(self._tails[stream][-self._limit:])
+
+
+def _pump(pipe, capture, stream):
+    """Copies a pipe of a subprocess into the capture until it's closed
+    """
+    for data in iter(lambda: pipe.read1(CHUNK_SIZE), b''):
+        capture.write(stream, data)
+
+
+def _pin(pid, cpus):
+    """Pins a running subprocess to cpus, the threads and processes it
+    starts afterwards inherit it. Done from the parent because a preexec_fn
+    isn't safe in a process with threads
+
+    Args:
+        pid (int): The id of the subprocess
+        cpus (list): The cores, nothing is done if None or if the platform
+        can't do it
+    """
+    if not cpus or not hasattr(os, 'sched_setaffinity'):
+        return
+    try:
+        os.sched_setaffinity(pid, cpus)
+    except ProcessLookupError:
+        # It already finished
+        pass
+
+
+def _run_process(cmd, capture, stdin=None, pass_fds=(), cpus=None):
+    """Runs a command in the folder of the executable, copying its output
+    into the capture while it runs
+
+    Args:
+        cmd (list): The executable and its arguments
+        capture (OutputCapture): Receives STDOUT and STDERR
+        stdin (bytes): Written to the standard input, inherited if None
+        pass_fds (tuple): Descriptors kept open in the subprocess
+        cpus (list): If given, the subprocess is pinned to these cores
+
+    Returns:
+        int: The exit status code
+    """
+    # The standard input is inherited unless it carries the data
+    stdin_pipe = None if stdin is None else subprocess.PIPE
+    process = subprocess.Popen(cmd,
+                               cwd=os.path.dirname(cmd[0]),
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               stdin=stdin_pipe,
+                               pass_fds=pass_fds)
+    _pin(process.pid, cpus)
+    threads = [threading.Thread(target=_pump,
+                                args=(process.stderr, capture, 'stderr'))]
+    if stdin is not None:
+        threads.append(threading.Thread(target=_feed,
+                                        args=(process.stdin, stdin)))
+    for thread in threads:
+        thread.start()
+    _pump(process.stdout, capture, 'stdout')
+    for thread in threads:
+        thread.join()
+    return process.wait()
+
+
+def _feed(pipe, data):
+    """Writes the external data to the standard input of the subprocess
+    """
+    try:
+        pipe.write(data)
+        pipe.close()
+    except BrokenPipeError:
+        # The command doesn't read all of it
+        pass
+
+
+async def _feed_async(writer, data):
+    try:
+        writer.write(data)
+        await writer.drain()
+        writer.close()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+
+
+async def _pump_async(reader, capture, stream):
+    """Same as _pump for the StreamReader of an asyncio subprocess
+    """
+    while True:
+        data = await reader.read(CHUNK_SIZE)
+        if not data:
+            break
+        capture.write(stream, data)
 
 
 class Task(object):
@@ -18,21 +252,39 @@ class Task(object):
     necessary for the execution in a worker
     """
 
-    def __init__(self, jsondesc):
-        """Creates a Task object from a JSON string (also see from_file)
+    def __init__(self, jsondesc, templates=None):
+        """Creates a Task object from a message (also see from_file)
 
         Args:
-            jsondesc (str): A JSON string that contains the serialized data
+            jsondesc (str or bytes): A JSON string that contains the
+            serialized data, or a compact message (see codec)
+            templates (TemplateCache): The templates of the compact messages
+
+        Raises:
+            UnknownTemplate: If the template of a compact message isn't found
         """
-        self._data = json.loads(jsondesc)
+        self._data = codec.decode(jsondesc, templates)
         self._folderpath = None
         self._tempfolder = None
         self._arguments = ''
+        # The path of the external data given to the command as {edf}
+        self._edf = None
+        self._config_fd = None
+        self._stdin = None
         self._stdout = None
         self._stderr = None
+        self._reports = []
         self._assigned = datetime.datetime.utcnow()
         self._started = None
         self._finished = None
+        # Seconds taken by each phase of the lifecycle
+        self._timings = {}
+        # Number of tasks run by the same invocation, see TaskGroup
+        self._group = 1
+        published = self._data.get('published')
+        if published is not None:
+            # The clocks of the coordinator and the worker must be in sync
+            self._timings['queue'] = max(0.0, time.time() - published)
         pass
 
     @staticmethod
@@ -50,26 +302,55 @@ class Task(object):
             content = json.load(jsonFile)
         return Task(json.dumps(content))
 
-    def prepare(self):
+    def prepare(self, delivery='file'):
         """The first phase of the lifecycle. This is executed previous to the
         main phase. It's used for the execution of relevant subtasks e.g.:
         creation of config files, download of dataset, version checks etc.
+
+        Args:
+            delivery (str): How the external data is given to the command,
+            see DELIVERIES. With memfd and stdin nothing is written to disk,
+            {edf} is /proc/self/fd/N or /dev/stdin
+
+        Raises:
+            ValueError: If the delivery is unknown
         """
+        if delivery not in DELIVERIES:
+            raise ValueError('Unknown delivery: {0}'.format(delivery))
+        if delivery == 'memfd':
+            data = self._data['external_data'].encode('utf-8')
+            self._config_fd = os.memfd_create(
+                '{0}.txt'.format(self._data['id']))
+            written = 0
+            while written < len(data):
+                written += os.write(self._config_fd, data[written:])
+            # The descriptor keeps its number in the subprocess (pass_fds)
+            self._edf = '/proc/self/fd/{0}'.format(self._config_fd)
+            self._arguments = self._data['arguments'].format(edf=self._edf)
+            return
+        if delivery == 'stdin':
+            self._stdin = self._data['external_data'].encode('utf-8')
+            self._edf = '/dev/stdin'
+            self._arguments = self._data['arguments'].format(edf=self._edf)
+            return
+
         if self._data['external_data_folder']:
-            if not os.path.exists(self._data['external_data_folder']):
-                os.makedirs(self._data['external_data_folder'])
-            self._folderpath = self._data['external_data_folder']
+            folder = self._data['external_data_folder']
+            if folder not in _FOLDERS:
+                os.makedirs(folder, exist_ok=True)
+                _FOLDERS.add(folder)
+            self._folderpath = folder
         # TODO: Manage the exception if it can't create the directory
         else:
             self._tempfolder = tempfile.TemporaryDirectory()
             self._folderpath = self._tempfolder.name
 
-        external_data = os.path.join(self._folderpath,
-                                     str(self._data['id']) + '.txt')
-        with open(external_data, 'w') as fp:
+        self._edf = os.path.join(self._folderpath,
+                                 str(self._data['id']) + '.txt')
+        with open(self._edf, 'w') as fp:
             fp.writelines(self._data['external_data'])
 
-        self._arguments = self._data['arguments'].format(edf=external_data)
+        self._arguments = self._data['arguments'].format(edf=self._edf)
         pass
 
     def clean(self):
@@ -78,31 +359,129 @@ class Task(object):
         """
         if self._tempfolder:
             self._tempfolder.cleanup()
+        if self._config_fd is not None:
+            os.close(self._config_fd)
+            self._config_fd = None
         pass
 
-    def run(self):
+    def _capture(self, log_folder, capture_limit):
+        """Creates the OutputCapture for an execution of this task
+        """
+        log_prefix = None
+        if log_folder:
+            log_prefix = os.path.join(log_folder, str(self._data['id']))
+        return OutputCapture(capture_limit, log_prefix)
+
+    def _captured(self, capture):
+        """Keeps what the OutputCapture got from the finished subprocess
+        """
+        capture.close()
+        self._stdout = capture.stdout()
+        self._stderr = capture.stderr()
+        self._reports = capture.reports
+
+    def _pass_fds(self):
+        if self._config_fd is None:
+            return ()
+        return (self._config_fd,)
+
+    def _stdin_pipe(self, pipe):
+        # The standard input is inherited unless it carries the data
+        if self._stdin is None:
+            return None
+        return pipe
+
+    def run(self, log_folder=None, capture_limit=DEFAULT_CAPTURE_LIMIT,
+            cpus=None, delivery='file'):
         """The main phase of this task, this is where the hevy lifting is done.
+        The output is processed while the subprocess runs, only its last bytes
+        are kept in memory
+
+        Args:
+            log_folder (str): If given, the complete STDOUT and STDERR are
+            written (compressed) to <id>.stdout.gz and <id>.stderr.gz there
+            capture_limit (int): Bytes kept from the end of each stream
+            cpus (list): If given, the subprocess (and every thread or
+            process it starts) runs only on these cores
+            delivery (str): How the external data is given, see prepare
 
         Returns:
             int: The exit status code of the given subprocess
         """
-        self.prepare()
-        self._started = datetime.datetime.utcnow()
-        cmd = [self._data['command'], ] + self._arguments.split(sep=' ')
-        process = subprocess.Popen(cmd,
-                                   cwd=os.path.dirname(self._data['command']),
-                                   stdout=subprocess.PIPE)
-        self._stdout, self._stderr = process.communicate()
-        result = process.returncode
-        self._finished = datetime.datetime.utcnow()
-        self.clean()
+        begin = time.perf_counter()
+        self._group = 1
+        # The memfd and the temporary folder are released even if the
+        # command can't be started
+        try:
+            self.prepare(delivery)
+            self._timings['prepare'] = time.perf_counter() - begin
+            self._started = datetime.datetime.utcnow()
+            cmd = [self._data['command'], ] + self._arguments.split(sep=' ')
+            capture = self._capture(log_folder, capture_limit)
+            try:
+                result = _run_process(cmd, capture, self._stdin,
+                                      self._pass_fds(), cpus)
+            finally:
+                self._finished = datetime.datetime.utcnow()
+                self._timings['run'] = (self._finished -
+                                        self._started).total_seconds()
+                self._captured(capture)
+        finally:
+            self.clean()
+        return result
+
+    async def run_async(self, log_folder=None,
+                        capture_limit=DEFAULT_CAPTURE_LIMIT, cpus=None,
+                        delivery='file'):
+        """Same as run, but the subprocess is supervised by the running
+        asyncio event loop instead of blocking a thread until it finishes
+
+        Args:
+            log_folder (str): See run
+            capture_limit (int): Bytes kept from the end of each stream
+            cpus (list): See run
+            delivery (str): See run
+
+        Returns:
+            int: The exit status code of the given subprocess
+        """
+        begin = time.perf_counter()
+        self._group = 1
+        try:
+            self.prepare(delivery)
+            self._timings['prepare'] = time.perf_counter() - begin
+            self._started = datetime.datetime.utcnow()
+            cmd = [self._data['command'], ] + self._arguments.split(sep=' ')
+            capture = self._capture(log_folder, capture_limit)
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    cwd=os.path.dirname(self._data['command']),
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    stdin=self._stdin_pipe(asyncio.subprocess.PIPE),
+                    pass_fds=self._pass_fds())
+                _pin(process.pid, cpus)
+                pumps = [_pump_async(process.stdout, capture, 'stdout'),
+                         _pump_async(process.stderr, capture, 'stderr')]
+                if self._stdin is not None:
+                    pumps.append(_feed_async(process.stdin, self._stdin))
+                await asyncio.gather(*pumps)
+                result = await process.wait()
+            finally:
+                self._finished = datetime.datetime.utcnow()
+                self._timings['run'] = (self._finished -
+                                        self._started).total_seconds()
+                self._captured(capture)
+        finally:
+            self.clean()
         return result
 
     def get_stdout(self):
         """Returns the output produced by the subprocess in STDOUT
 
         Returns:
-            str: The complete output
+            bytes: The end of the output, see run
         """
         return self._stdout
 
@@ -110,47 +489,119 @@ class Task(object):
         """Returns the output produced by the subprocess in STDERR
 
         Returns:
-            str: The contents of STDERR in the subprocess
+            bytes: The end of the contents of STDERR in the subprocess
         """
         return self._stderr
 
-    def result(self):
+    def result(self, executor=None):
         """This function opens the result file and reads its contents formatted
         as JSON. Modify according to your needs
 
+        Args:
+            executor (Executor): If given, the parsing is submitted to it
+            (e.g. a ProcessPoolExecutor) and a future is returned instead
+
         Returns:
             list: List of JSON formatted strings. As the command could have had
             multiple executions and/or multiple output files, the list groups
-            all the results.
-        """        
-        output = self._stdout.decode('utf-8')
-        pattern = re.compile('^Running simulation \'(.*)\'$')
-        files = []
-        results = []
-        metrics = {}
-        for line in output.split('\n'):
-            if pattern.match(line):
-                filename = pattern.match(line).groups()[0]
-                filename += '_MetricsReport.txt'
-                files.append(filename)
-        pattern = re.compile('^[ ]*Report.reportDir[ ]*=[ ]*(.*)$')
-        dirname = ''
-        for config in self._data['external_data'].split('\n'):
-            if pattern.match(config):
-                dirname = pattern.match(config).groups()[0]
-                break
+            all the results. A Future that resolves to it if executor is set.
+        """
         task_data = {'task_id': self._data['id'],
                      'execution_assigned': self._assigned.isoformat(),
                      'execution_started': self._started.isoformat(),
                      'execution_finished': self._finished.isoformat(),
                      'worker': platform.node()}
-        for file in files:
-            path = os.path.join(dirname, file)
-            metrics = parser.MessageStatsReportParser(path).get_results()
-            metrics.update(task_data)
-            results.append(json.dumps(metrics))
+        for phase, seconds in self._timings.items():
+            task_data['phase_' + phase] = seconds
+        if self._group > 1:
+            task_data['group_size'] = self._group
+        args = (self._reports, self._data['external_data'], task_data)
+        if executor is not None:
+            return executor.submit(extract_results, *args)
+        return extract_results(*args)
+
+    def cache_key(self):
+        """Identifies the computation done by this Task, see cache.task_key
+
+        Returns:
+            str: The key of this Task in a ResultCache
+        """
+        return cache.task_key(self._data['command'], self._data['arguments'],
+                              self._data['external_data'])
+
+    def done_key(self):
+        """Identifies this Task in a CompletedIndex. The id alone isn't
+        enough, the tasks of another sweep may have the same ids
+
+        Returns:
+            list: The id and the cache_key
+        """
+        return [self.get_id(), self.cache_key()]
+
+    def group_key(self):
+        """Identifies the tasks that can be run together by a TaskGroup: the
+        ones with the same command and batch_arguments
+
+        Returns:
+            tuple: The key, None if the task has no batch_arguments or no
+            Scenario.name (its reports couldn't be told apart)
+        """
+        if not self._data.get('batch_arguments'):
+            return None
+        if self.scenario_pattern() is None:
+            return None
+        return self._data['command'], self._data['batch_arguments']
+
+    def scenario_pattern(self):
+        """Returns a regex that matches the names of the scenarios run by
+        this Task: its Scenario.name with the parameters between %% replaced
+        by their values (any of them for a [a;b] list)
+
+        Returns:
+            Pattern: The compiled regex, None if there is no Scenario.name
+        """
+        values = {}
+        for line in self._data['external_data'].split('\n'):
+            name, separator, value = line.partition('=')
+            if separator:
+                values[name.strip()] = value.strip()
+        template = values.get('Scenario.name')
+        if template is None:
+            return None
+        pattern = ''
+        position = 0
+        for match in re.finditer('%%(.*?)%%', template):
+            pattern += re.escape(template[position:match.start()])
+            value = values.get(match.group(1))
+            if value is None:
+                pattern += '.*'
+            elif value.startswith('[') and value.endswith(']'):
+                pattern += '(?:{0})'.format('|'.join(
+                    re.escape(v.strip()) for v in value[1:-1].split(';')))
+            else:
+                pattern += re.escape(value)
+            position = match.end()
+        pattern += re.escape(template[position:])
+        return re.compile(pattern)
+
+    def cores(self):
+        """Returns the number of cores this Task needs, from its 'cores'
+        field (1 if it doesn't have one)
+
+        Returns:
+            int: The number of cores
+        """
+        return int(self._data.get('cores', 1))
 
-        return results
+    def timings(self):
+        """Returns the seconds taken by each phase done so far: queue (since
+        the coordinator published it, if it recorded the time), prepare and
+        run
+
+        Returns:
+            dict: The seconds by phase name
+        """
+        return dict(self._timings)
 
     def get_id(self):
         """Getter for the Task's id
@@ -169,3 +620,152 @@ class Task(object):
             str: The textual representation
         """
         return 'Data={0}\n'.format(self._data)
+
+
+class TaskGroup(object):
+    """Tasks with the same group_key run by a single invocation of their
+    command, so the startup of the simulator is paid once. Their external
+    data is given as {edf_list} in batch_arguments, separated by spaces.
+    Each report announced in the output must match the scenario_pattern of
+    exactly one task, and every task must get a report; otherwise the
+    reports can't be split and the group counts as failed
+    """
+
+    def __init__(self, tasks):
+        """Constructor
+
+        Args:
+            tasks (list): The Task objects, all with the same group_key
+        """
+        self.tasks = list(tasks)
+        # The reports of each task once run, None if they couldn't be split
+        self.assigned = None
+
+    def cores(self):
+        """Returns the cores needed by the largest task, see Task.cores
+        """
+        return max(work.cores() for work in self.tasks)
+
+    def split_reports(self, reports):
+        """Assigns the reports of the invocation to the tasks
+
+        Args:
+            reports (list): The report files, in the order they were
+            announced
+
+        Returns:
+            list: The reports of each task, None if a report matches no task
+            or several of them, or if a task gets no report
+        """
+        patterns = [work.scenario_pattern() for work in self.tasks]
+        if any(pattern is None for pattern in patterns):
+            return None
+        assigned = [[] for _ in self.tasks]
+        suffix = len('_MetricsReport.txt')
+        for report in reports:
+            name = report[:-suffix]
+            matching = [i for i, pattern in enumerate(patterns)
+                        if pattern.fullmatch(name)]
+            if len(matching) != 1:
+                return None
+            assigned[matching[0]].append(report)
+        if not all(assigned):
+            return None
+        return assigned
+
+    def run(self, log_folder=None, capture_limit=DEFAULT_CAPTURE_LIMIT,
+            cpus=None, delivery='file'):
+        """Runs every task in one subprocess, see Task.run. Each task gets
+        the output of the whole invocation and its share of the reports
+
+        Args:
+            log_folder (str): If given, the output is written to
+            <first id>-<last id>.stdout.gz and .stderr.gz there
+            capture_limit (int): Bytes kept from the end of each stream
+            cpus (list): See Task.run
+            delivery (str): See Task.prepare, stdin can't hold several files
+            so file is used instead
+
+        Returns:
+            int: The exit status code of the subprocess. Check assigned too,
+            it's None if the reports couldn't be split
+        """
+        if delivery == 'stdin':
+            delivery = 'file'
+        self.assigned = None
+        first = self.tasks[0]
+        begin = time.perf_counter()
+        for work in self.tasks:
+            work.prepare(delivery)
+        prepare = time.perf_counter() - begin
+        edf_list = ' '.join(work._edf for work in self.tasks)
+        arguments = first._data['batch_arguments'].format(edf_list=edf_list)
+        cmd = [first._data['command'], ] + arguments.split(sep=' ')
+        log_prefix = None
+        if log_folder:
+            log_prefix = os.path.join(log_folder, '{0}-{1}'.format(
+                first.get_id(), self.tasks[-1].get_id()))
+        capture = OutputCapture(capture_limit, log_prefix)
+        started = datetime.datetime.utcnow()
+        pass_fds = tuple(fd for work in self.tasks for fd in work._pass_fds())
+        try:
+            result = _run_process(cmd, capture, pass_fds=pass_fds,
+                                  cpus=cpus)
+        finally:
+            finished = datetime.datetime.utcnow()
+            capture.close()
+            for work in self.tasks:
+                work.clean()
+        self.assigned = self.split_reports(capture.reports)
+        reports = self.assigned or [[] for _ in self.tasks]
+        for work, assigned in zip(self.tasks, reports):
+            work._started = started
+            work._finished = finished
+            work._timings['prepare'] = prepare
+            work._timings['run'] = (finished - started).total_seconds()
+            work._stdout = capture.stdout()
+            work._stderr = capture.stderr()
+            work._reports = assigned
+            work._group = len(self.tasks)
+        return result
+
+    def timings(self):
+        """Returns the timings of the invocation, shared by every task
+        """
+        return self.tasks[0].timings()
+
+
+def extract_results(reports, external_data, task_data):
+    """Parses the report files announced in the output of a simulation. It's
+    a module level function so it can be sent to another process
+
+    Args:
+        reports (list): The names of the report files, see OutputCapture
+        external_data (str): The configuration given to the simulation
+        task_data (dict): Metadata of the task added to every result, with
+        the time taken to parse the reports as phase_parse
+
+    Returns:
+        list: List of JSON formatted strings, one for each report file
+    """
+    begin = time.perf_counter()
+    parsed = []
+    metrics = {}
+    pattern = re.compile('^[ ]*Report.reportDir[ ]*=[ ]*(.*)$')
+    dirname = ''
+    for config in external_data.split('\n'):
+        if pattern.match(config):
+            dirname = pattern.match(config).groups()[0]
+            break
+    for file in reports:
+        path = os.path.join(dirname, file)
+        metrics = parser.MessageStatsReportParser(path).get_results()
+        metrics.update(task_data)
+        parsed.append(metrics)
+
+    seconds = time.perf_counter() - begin
+    results = []
+    for metrics in parsed:
+        metrics['phase_parse'] = seconds
+        results.append(json.dumps(metrics))
+    return results
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+import os
+
+import cache
+
+
+def test_eviction_down_to_the_low_water_mark(tmp_path, monkeypatch):
+    result_cache = cache.ResultCache(str(tmp_path), max_entries=10)
+    listings = []
+    entries = result_cache._entries
+    monkeypatch.setattr(result_cache, '_entries',
+                        lambda: listings.append(1) or entries())
+    for number in range(11):
+        key = cache.task_key('cmd', '', str(number))
+        result_cache.put(key, ['{"n": %d}' % number])
+        os.utime(result_cache._path(key), (number, number))
+    assert len(listings) == 1
+    assert len(os.listdir(str(tmp_path))) == 9
+    assert result_cache.get(cache.task_key('cmd', '', '0')) is None
+    assert result_cache.get(cache.task_key('cmd', '', '10')) == ['{"n": 10}']
+    # There is room again, the next put doesn't list the folder
+    result_cache.put(cache.task_key('cmd', '', '11'), ['{}'])
+    assert len(listings) == 1
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+import codec
+
+
+def test_packed_results_round_trip():
+    results = [
+        {'name': 'a', 'sent': 3, 'ratio': 0.5, 'mixed': 1, 'big': 2 ** 53 + 1},
+        {'name': 'b', 'sent': -7, 'ratio': 2.0, 'mixed': 1.5,
+         'big': 2 ** 64},
+        {'name': 'c', 'sent': 0, 'ratio': float('inf'), 'mixed': 2 ** 60,
+         'big': None},
+    ]
+    decoded = codec.decode_results(codec.pack_results(results))
+    assert decoded == results
+    assert [type(row['mixed']) for row in decoded] == [int, float, int]
+
+
+def test_packed_results_keep_schemas_apart():
+    results = [json.dumps({'a': 1}), json.dumps({'b': 'x', 'c': True})]
+    assert codec.decode_results(codec.pack_results(results)) == \
+        [{'a': 1}, {'b': 'x', 'c': True}]
+
+
+def test_legacy_json_results():
+    assert codec.decode_results('{"a": 1}') == [{'a': 1}]
+    assert codec.decode_results(b'{"a": 1.5}') == [{'a': 1.5}]
+
+
+def test_template_cache_reads_again_while_templates_are_hidden():
+    body = json.dumps({'id': 't1', 'template': {'names': []}})
+    reads = []
+
+    def reader():
+        # The first read finds the queue empty, another worker holds them
+        reads.append(1)
+        return [body] if len(reads) > 1 else []
+    templates = codec.TemplateCache(reader, retry_wait=0)
+    assert templates.get('t1') == {'names': []}
+    assert len(reads) == 2
+
+
+def test_template_cache_gives_up_after_the_retries():
+    reads = []
+    templates = codec.TemplateCache(lambda: reads.append(1) or [],
+                                    retries=2, retry_wait=0)
+    with pytest.raises(codec.UnknownTemplate):
+        templates.get('t1')
+    assert len(reads) == 3
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import json
+
+import completed_index
+import task
+
+
+def make_task(task_id, external_data):
+    return task.Task(json.dumps({'id': task_id, 'command': '/bin/true',
+                                 'arguments': '{edf}',
+                                 'external_data_folder': '',
+                                 'external_data': external_data}))
+
+
+def test_same_id_in_another_sweep_is_not_done(tmp_path):
+    path = str(tmp_path / 'index')
+    index = completed_index.CompletedIndex(path)
+    index.add(make_task(0, 'Scenario.name=a\n').done_key())
+    index.close()
+    index = completed_index.CompletedIndex(path)
+    assert make_task(0, 'Scenario.name=a\n').done_key() in index
+    assert make_task(0, 'Scenario.name=b\n').done_key() not in index
+    index.close()
+
+
+def test_torn_last_line_is_dropped(tmp_path):
+    path = str(tmp_path / 'index')
+    index = completed_index.CompletedIndex(path)
+    index.add(1)
+    index.close()
+    with open(path, 'a') as stored:
+        stored.write('12')  # Cut while writing 123
+    index = completed_index.CompletedIndex(path)
+    assert 12 not in index
+    index.add(4)
+    index.close()
+    with open(path) as stored:
+        assert stored.read() == '1\n4\n'
+    index = completed_index.CompletedIndex(path)
+    assert 1 in index and 4 in index and len(index) == 2
+    index.close()
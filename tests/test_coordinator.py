@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import configparser
+import csv
+import json
+import sys
+
+import pytest
+
+import fake_amqp
+# The coordinator publishes to the in-process broker
+sys.modules['amqpstorm'] = fake_amqp
+
+import completed_index  # noqa: E402
+import coordinator  # noqa: E402
+import task  # noqa: E402
+
+
+def make_config(folder, rows=10):
+    csv_file = str(folder / 'params.csv')
+    with open(csv_file, 'w') as params:
+        writer = csv.writer(params)
+        writer.writerow(['Scenario.name', 'Report.reportDir'])
+        for row in range(rows):
+            writer.writerow(['s{0}'.format(row), str(folder)])
+    config = configparser.RawConfigParser()
+    config.read_dict({
+        'general': {'queue_name': 'tasks', 'results_queue_name': 'results'},
+        'coordinator': {'queue_url': 'amqp://test',
+                        'taskcreator': 'SweepCreator', 'csvfile': csv_file,
+                        'task_ids': 'row', 'publish_window': '3',
+                        'checkpoint': str(folder / 'checkpoint')},
+        'task': {'command': '/bin/true', 'arguments': '{edf}',
+                 'external_folder': str(folder)}})
+    return config
+
+
+def published():
+    return [json.loads(message.body)
+            for message in fake_amqp.BROKER.queues.get('tasks', [])]
+
+
+def test_resume_publishes_each_task_once(tmp_path, capsys):
+    fake_amqp.BROKER.reset()
+    config = make_config(tmp_path)
+    config.set('coordinator', 'shard', '0:4')
+    coordinator.start(config)
+    assert len(published()) == 4
+    config.set('coordinator', 'shard', ':')
+    coordinator.start(config, fast=True, resume=True)
+    ids = [work['id'] for work in published()]
+    assert len(ids) == 10 and len(set(ids)) == 10
+    assert '4 tasks were already published' in capsys.readouterr().out
+
+
+def test_missing_publishes_the_tasks_not_done(tmp_path):
+    fake_amqp.BROKER.reset()
+    config = make_config(tmp_path)
+    coordinator.start(config)
+    tasks = published()
+    # A worker completed the first 7 tasks
+    index_file = str(tmp_path / 'index')
+    index = completed_index.CompletedIndex(index_file)
+    for work in tasks[:7]:
+        index.add(task.Task(json.dumps(work)).done_key())
+    index.close()
+
+    fake_amqp.BROKER.reset()
+    config.set('coordinator', 'results_index',
+               index_file + ', ' + str(tmp_path / 'absent'))
+    coordinator.start(config, missing=True)
+    assert sorted(work['id'] for work in published()) == \
+        sorted(work['id'] for work in tasks[7:])
+    # The checkpoint of the first run is kept
+    checkpoint = completed_index.CompletedIndex(str(tmp_path / 'checkpoint'))
+    assert len(checkpoint) == 10
+    checkpoint.close()
+
+
+def test_missing_ignores_another_sweep_with_the_same_ids(tmp_path):
+    fake_amqp.BROKER.reset()
+    config = make_config(tmp_path, rows=3)
+    config.set('coordinator', 'task_ids', 'position')
+    index_file = str(tmp_path / 'index')
+    index = completed_index.CompletedIndex(index_file)
+    for position in range(3):
+        index.add([position, 'key of a task of another sweep'])
+    index.close()
+    config.set('coordinator', 'results_index', index_file)
+    coordinator.start(config, missing=True)
+    assert len(published()) == 3
+
+
+def test_sweep_rejects_other_orders(tmp_path):
+    fake_amqp.BROKER.reset()
+    config = make_config(tmp_path)
+    config.set('coordinator', 'order', 'longest_first')
+    with pytest.raises(ValueError):
+        list(coordinator.SweepCreator(config.get('coordinator', 'csvfile'),
+                                      config).iter_tasks())
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import csv
+
+import pytest
+
+import ordering
+
+
+def write_csv(filename, header, rows):
+    with open(filename, 'w') as the_file:
+        writer = csv.writer(the_file)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def test_cost_model_fits_quadratic_runtimes():
+    names = ['scenario', 'nodes', 'time']
+    rows = [['s', str(nodes), str(time)] for nodes in range(1, 6)
+            for time in (10, 20, 30)]
+    runtimes = [2 * float(row[1]) ** 2 + 0.5 * float(row[2]) + 3
+                for row in rows]
+    model = ordering.CostModel(names)
+    model.fit(rows, runtimes)
+    assert model.predict(['s', '4', '20']) == pytest.approx(45, rel=1e-3)
+    assert model.predict(['other', '8', '40']) == \
+        pytest.approx(151, rel=1e-2)
+    # A missing value takes the mean of the history
+    assert model.predict(['s', '', '20']) == \
+        model.predict(['s', '3', '20'])
+
+
+def test_cost_model_from_history(tmp_path):
+    params_file = str(tmp_path / 'params.csv')
+    write_csv(params_file, ['name', 'nodes'],
+              [['a', '1'], ['b', '2'], ['c', '3'], ['d', '4']])
+    results_file = str(tmp_path / 'results.csv')
+    write_csv(results_file,
+              ['task_id', 'execution_started', 'execution_finished'],
+              [[str(index), '2024-01-01T00:00:00',
+                '2024-01-01T00:00:{0:02d}'.format(10 * nodes)]
+               for index, nodes in enumerate(range(1, 5))])
+    # The columns are matched by name, the new sweep adds one
+    model = ordering.CostModel.from_history(['extra', 'nodes'],
+                                            [results_file], params_file)
+    assert model.predict(['x', '6']) > model.predict(['x', '2'])
+    # No result belongs to a row of another sweep
+    other_file = str(tmp_path / 'other.csv')
+    write_csv(other_file, ['name', 'nodes'], [])
+    with pytest.raises(ValueError):
+        ordering.CostModel.from_history(['nodes'], [results_file],
+                                        other_file)
+
+
+def test_longest_first(tmp_path):
+    csv_file = str(tmp_path / 'params.csv')
+    rows = [['a', '3'], ['b', '10'], ['c', 'none'], ['d', '3'], ['e', '7']]
+    write_csv(csv_file, ['name', 'cost'], rows)
+    names, ordered = ordering.longest_first(
+        csv_file, lambda names: ordering.column_cost(names, 'cost'))
+    assert names == ['name', 'cost']
+    # Ties keep the order of the file, a cost that isn't a number is 0
+    assert list(ordered) == [(1, rows[1]), (4, rows[4]), (0, rows[0]),
+                             (3, rows[3]), (2, rows[2])]
+    with pytest.raises(ValueError):
+        ordering.column_cost(names, 'absent')
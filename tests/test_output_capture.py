@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import task
+
+
+def test_no_tail_with_limit_zero():
+    capture = task.OutputCapture(0)
+    for _ in range(10):
+        capture.write('stdout', b'x' * 100 + b'\n')
+        capture.write('stderr', b'y' * 100)
+    capture.close()
+    assert capture.stdout() == b''
+    assert capture.stderr() == b''
+    assert len(capture._tails['stdout']) == 0
+
+
+def test_tail_keeps_the_last_bytes():
+    capture = task.OutputCapture(10)
+    for number in range(100):
+        capture.write('stderr', str(number).encode('ascii'))
+    assert capture.stderr() == b'9596979899'
+    assert len(capture._tails['stderr']) <= 20
+
+
+def test_reports_split_across_reads_with_a_small_tail():
+    capture = task.OutputCapture(0)
+    for chunk in (b"Running sim", b"ulation 'a'\nRunning simulation 'b", b"'"):
+        capture.write('stdout', chunk)
+    capture.close()
+    assert capture.reports == ['a_MetricsReport.txt', 'b_MetricsReport.txt']
+
+
+def test_long_lines_are_not_reports():
+    capture = task.OutputCapture(16)
+    capture.write('stdout', b"Running simulation '" + b'x' * task.MAX_LINE)
+    capture.write('stdout', b"'\nRunning simulation 'c'\n")
+    capture.close()
+    assert capture.reports == ['c_MetricsReport.txt']
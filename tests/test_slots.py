@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import slots
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_parse_cpulist():
+    assert slots.parse_cpulist('0-3,8,10-11\n') == [0, 1, 2, 3, 8, 10, 11]
+    assert slots.parse_cpulist('') == []
+
+
+def test_cores_of_a_single_numa_node():
+    nodes = {cpu: cpu // 4 for cpu in range(8)}
+    pool = slots.CoreSlots(cpus=list(range(8)), nodes=nodes)
+    assert pool.acquire(2) == [0, 1]
+    # Node 0 can't hold 3 cores any more
+    assert pool.acquire(3) == [4, 5, 6]
+    # The node with fewer free cores is used first
+    assert pool.acquire(2) == [2, 3]
+    pool.release([0, 1])
+    # Spread over the nodes when none can hold them all
+    assert sorted(pool.acquire(3)) == [0, 1, 7]
+
+
+def test_count_limits_the_pool():
+    pool = slots.CoreSlots(2, cpus=[4, 5, 6], nodes={})
+    assert len(pool) == 2
+    # A task larger than the pool takes all of it
+    assert pool.acquire(5) == [4, 5]
+
+
+def test_requests_are_served_in_arrival_order():
+    pool = slots.CoreSlots(cpus=list(range(4)), nodes={})
+    taken = pool.acquire(3)
+    served = []
+
+    def request(name, count):
+        cpus = pool.acquire(count)
+        served.append(name)
+        if name == 'large':
+            time.sleep(0.1)
+            pool.release(cpus)
+
+    large = threading.Thread(target=request, args=('large', 4),
+                             daemon=True)
+    large.start()
+    wait_for(lambda: len(pool._waiting) == 1)
+    small = threading.Thread(target=request, args=('small', 1),
+                             daemon=True)
+    small.start()
+    wait_for(lambda: len(pool._waiting) == 2)
+    # A core is free, but the small task waits behind the large one
+    time.sleep(0.1)
+    assert served == []
+    pool.release(taken)
+    large.join(5)
+    small.join(5)
+    assert served == ['large', 'small']
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+
+import spool
+
+
+class Broker(object):
+    """Collects the published results, failing while it's down"""
+
+    def __init__(self, down=False):
+        self.down = down
+        self.results = []
+        self.published = threading.Event()
+
+    def publish(self, results):
+        if self.down:
+            raise IOError('down')
+        self.results.extend(results)
+        self.published.set()
+
+
+def test_torn_tail_is_dropped_and_pending_entries_republished(tmp_path):
+    path = str(tmp_path / 'spool')
+    broker = Broker(down=True)
+    results = spool.ResultSpool(path, broker.publish, retry_wait=60)
+    results.append(1, ['{"task_id": 1}'])
+    results.append(2, ['{"task_id": 2}'])
+    results.close()
+    # A crash while the third entry was written
+    with open(path, 'a') as stored:
+        stored.write('{"seq": 3, "task": 3, "res')
+
+    broker = Broker(down=True)
+    results = spool.ResultSpool(path, broker.publish, retry_wait=60)
+    results.append(4, ['{"task_id": 4}'])
+    results.close()
+    with open(path) as stored:
+        records = [json.loads(line) for line in stored]
+    assert [record['task'] for record in records] == [1, 2, 4]
+    assert records[-1]['seq'] == 4
+
+    broker = Broker()
+    results = spool.ResultSpool(path, broker.publish)
+    assert broker.published.wait(5)
+    results.close()
+    assert sorted(broker.results) == ['{"task_id": 1}', '{"task_id": 2}',
+                                      '{"task_id": 4}']
+    assert len(results) == 0
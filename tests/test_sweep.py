@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import itertools
+
+import pytest
+
+import sweep
+
+
+def test_cells_lists_and_ranges():
+    assert list(sweep.parse_cell('{a; b;c}')) == ['a', 'b', 'c']
+    # The stop is included
+    assert list(sweep.parse_cell('{1:7:3}')) == ['1', '4', '7']
+    assert list(sweep.parse_cell('{0:0.3:0.1}')) == ['0.0', '0.1', '0.2',
+                                                     '0.3']
+    # Not a sweep: a plain value and the ONE syntax for the runs of a batch
+    assert list(sweep.parse_cell('1:7')) == ['1:7']
+    assert list(sweep.parse_cell('{[1;2]}')) == ['[1;2]']
+    with pytest.raises(ValueError):
+        sweep.parse_cell('{1:7:0}')
+
+
+def test_expand_in_product_order():
+    rows = [['{a;b}', '{1:3}'], ['c', 'x']]
+    expected = [list(values) for values in
+                itertools.product(['a', 'b'], ['1', '2', '3'])]
+    expected.append(['c', 'x'])
+    assert list(sweep.expand(rows)) == list(enumerate(expected))
+    extra = [sweep.Axis.parse('p;q')]
+    assert [values for _, values in sweep.expand([['{a;b}']], extra)] == \
+        [['a', 'p'], ['a', 'q'], ['b', 'p'], ['b', 'q']]
+
+
+def test_shards_are_slices_of_the_expansion():
+    rows = [['{a;b;c}', '{0:4}'], ['d', '{1;2}'], ['{e;f}', '{0:2}']]
+    full = list(sweep.expand(rows))
+    assert len(full) == 15 + 2 + 6
+    for first in range(len(full) + 1):
+        for last in range(first, len(full) + 2):
+            assert list(sweep.expand(rows, first=first, last=last)) == \
+                full[first:last]
+    # Shards that cover the sweep publish every combination once
+    shards = [sweep.parse_shard(text) for text in ('0:7', '7:16', '16:')]
+    assert list(itertools.chain.from_iterable(
+        sweep.expand(rows, first=first, last=last)
+        for first, last in shards)) == full
+
+
+def test_parse_shard():
+    assert sweep.parse_shard('10:20') == (10, 20)
+    assert sweep.parse_shard('10:') == (10, None)
+    assert sweep.parse_shard(':20') == (0, 20)
+    assert sweep.parse_shard(':') == (0, None)
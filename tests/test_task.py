@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import os
+
+import pytest
+
+import task
+
+
+def make_task(folder):
+    return task.Task(json.dumps({'id': 0,
+                                 'command': str(folder / 'missing'),
+                                 'arguments': '{edf}',
+                                 'external_data_folder': str(folder),
+                                 'external_data': 'Scenario.name=a\n'}))
+
+
+def open_fds():
+    return set(os.listdir('/proc/self/fd'))
+
+
+@pytest.mark.skipif(not hasattr(os, 'memfd_create'), reason='needs memfd')
+def test_memfd_is_closed_when_the_command_cannot_start(tmp_path):
+    work = make_task(tmp_path)
+    before = open_fds()
+    with pytest.raises(OSError):
+        work.run(delivery='memfd')
+    assert work._config_fd is None
+    assert open_fds() == before
+
+
+@pytest.mark.skipif(not hasattr(os, 'memfd_create'), reason='needs memfd')
+def test_memfd_is_closed_when_the_async_command_cannot_start(tmp_path):
+    work = make_task(tmp_path)
+    with pytest.raises(OSError):
+        asyncio.run(work.run_async(delivery='memfd'))
+    assert work._config_fd is None
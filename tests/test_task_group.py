@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import json
+
+import task
+
+
+def make_task(task_id, external_data, batch_arguments='{edf_list}'):
+    return task.Task(json.dumps({'id': task_id, 'command': '/bin/true',
+                                 'arguments': '{edf}',
+                                 'batch_arguments': batch_arguments,
+                                 'external_data_folder': '',
+                                 'external_data': external_data}))
+
+
+def report(name):
+    return name + '_MetricsReport.txt'
+
+
+def test_split_one_report_per_task():
+    group = task.TaskGroup([
+        make_task(0, 'Scenario.name=a_%%Group.router%%\nGroup.router=Epi\n'),
+        make_task(1, 'Scenario.name=a_%%Group.router%%\nGroup.router=Pro\n')])
+    assert group.split_reports([report('a_Epi'), report('a_Pro')]) == \
+        [[report('a_Epi')], [report('a_Pro')]]
+
+
+def test_split_batch_runs_of_a_task():
+    group = task.TaskGroup([
+        make_task(0, 'Scenario.name=s_%%Group.ttl%%\nGroup.ttl=[60;120]\n'),
+        make_task(1, 'Scenario.name=t\n')])
+    assert group.split_reports([report('s_60'), report('s_120'),
+                                report('t')]) == \
+        [[report('s_60'), report('s_120')], [report('t')]]
+
+
+def test_split_fails_without_scenario_name():
+    group = task.TaskGroup([make_task(i, 'Group.router=Epi\n')
+                            for i in range(3)])
+    assert group.split_reports([report('x')] * 3) is None
+
+
+def test_split_fails_with_unmatched_report():
+    group = task.TaskGroup([make_task(0, 'Scenario.name=a\n'),
+                            make_task(1, 'Scenario.name=b\n')])
+    assert group.split_reports([report('a'), report('b'),
+                                report('c')]) is None
+
+
+def test_split_fails_with_ambiguous_report():
+    group = task.TaskGroup([make_task(0, 'Scenario.name=a\n'),
+                            make_task(1, 'Scenario.name=a\n')])
+    assert group.split_reports([report('a'), report('a')]) is None
+
+
+def test_split_fails_when_a_task_gets_no_report():
+    group = task.TaskGroup([make_task(0, 'Scenario.name=a\n'),
+                            make_task(1, 'Scenario.name=b\n')])
+    assert group.split_reports([report('a')]) is None
+
+
+def test_no_group_key_without_scenario_name():
+    assert make_task(0, 'Group.router=Epi\n').group_key() is None
+    assert make_task(0, 'Scenario.name=a\n').group_key() is not None
+    assert make_task(0, 'Scenario.name=a\n', '').group_key() is None
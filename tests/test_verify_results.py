@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import itertools
+import re
+import sys
+
+import fake_amqp
+# verify_results reads the results through broker
+sys.modules['amqpstorm'] = fake_amqp
+
+import verify_results  # noqa: E402
+
+TEMPLATE = 'run_%%Group.a%%_%%Group.b%%_%%Group.seed%%'
+
+
+def old_finished(exp, results, ignorelist):
+    """The results of an experiment found by the matcher that scanned every
+    result with a regex per experiment, before ResultsIndex
+    """
+    scenario = verify_results.get_scenario_name(exp, ignorelist)
+    pattern = re.compile(scenario.replace('[', r'\[').replace(']', r'\]'))
+    return [res for res in results
+            if 'id' in res and pattern.match(res['id'])]
+
+
+def make_experiments():
+    experiments = [{'Scenario.name': TEMPLATE, 'Group.a': a, 'Group.b': b,
+                    'Group.seed': seed}
+                   for a, b, seed in itertools.product(
+                       ['1', '2', '12', '[3]'], ['x', 'y'], ['1', '2'])]
+    experiments.append({'Scenario.name': 'batch_%%Group.a%%', 'Group.a': '7',
+                        'Group.b': 'x', 'Group.seed': '1'})
+    return experiments
+
+
+def make_results():
+    ids = ['run_1_x_1', 'run_1_x_2', 'run_1_y_1', 'run_12_y_1',
+           'run_12_y_1', 'run_2_x_2', 'run_[3]_x_1', 'run_4_x_1',
+           'batch_7', 'batch_8', 'unrelated']
+    results = [{'id': name, 'n': n} for n, name in enumerate(ids)]
+    results.append({'n': len(ids)})
+    return results
+
+
+def check_same_matches(ignorelist, tmp_path, monkeypatch):
+    # A repeated experiment is written to a file named after it
+    monkeypatch.chdir(tmp_path)
+    experiments = make_experiments()
+    results = make_results()
+    index = verify_results.ResultsIndex(experiments, ignorelist)
+    for result in results:
+        index.add(result)
+    found = 0
+    for exp in experiments:
+        expected = old_finished(exp, results, ignorelist or [])
+        assert index.finished(exp) == expected
+        for executions in (1, 2):
+            assert verify_results.check_experiment_in_results(
+                exp, index, executions, ignorelist) == \
+                (len(expected) == executions, len(expected) / executions)
+        found += len(expected)
+    return found
+
+
+def test_index_matches_like_the_scan(tmp_path, monkeypatch):
+    assert check_same_matches(None, tmp_path, monkeypatch) == 8
+
+
+def test_index_matches_like_the_scan_with_ignored(tmp_path, monkeypatch):
+    # Both seeds of an experiment get all its repetitions
+    assert check_same_matches(['Group.seed'], tmp_path, monkeypatch) == 15
+
+
+def test_list_of_results_is_still_accepted(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    exp = make_experiments()[0]
+    assert verify_results.check_experiment_in_results(
+        exp, make_results(), 2, ['Group.seed']) == (True, 1.0)
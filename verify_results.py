@@ -3,7 +3,7 @@
 # @Date:   2018-03-20 13:50:24
 # @Last Modified by:   Jairo Sánchez
 # @Last Modified time: 2018-05-03 23:47:02
-import amqpstorm
+import broker
 import configparser
 import argparse
 import os
@@ -16,32 +16,17 @@ DEFAULT_CONFIG_FILE = './disexec.config'
 
 
 def load_results(queue_url, queue_name):
-    """Load the JSON objects that represent a result in the provided queue
+    """Load the JSON objects that represent a result in the provided queue,
+    the queue is left as it was
 
     Args:
         queue_url (str): The URI for the results queue
         queue_name (str): The name of the queue
 
     Returns:
-        list: Returns a list of dicts, where each one contains the results
+        iterator: Yields a dict with each result, as they are read
     """
-    connection = amqpstorm.UriConnection(queue_url)
-    channel = connection.channel()
-    channel.queue.declare(queue_name, durable=True)
-    received_ids = []
-    data = []
-    while True:
-        message = channel.basic.get(queue=queue_name, no_ack=False)
-        if message is None:
-            break
-        result = json.loads(message.body)
-        if any(result):
-            received_ids.append(message)
-            data.append(result)
-    for m in received_ids:
-        m.nack()
-    connection.close()
-    return data
+    return broker.iter_results(queue_url, queue_name, delete=False)
 
 
 def load_experiments(csvfile):
@@ -181,12 +166,140 @@ def write_to_file(name, contents):
         output.writelines(contents)
 
 
+def _trie_pattern(values):
+    """Builds a regex that matches exactly any of the given strings. The
+    alternatives are factored by their common prefixes, so matching takes
+    time proportional to the length of the string, not to the number of
+    values
+
+    Args:
+        values (iterable): The strings to match
+
+    Returns:
+        str: The regular expression
+    """
+    trie = {}
+    for value in values:
+        node = trie
+        for char in value:
+            node = node.setdefault(char, {})
+        node[''] = None
+
+    def build(node):
+        branches = [re.escape(char) + build(child)
+                    for char, child in sorted(node.items()) if char != '']
+        if not branches:
+            return ''
+        if len(branches) == 1 and '' not in node:
+            return branches[0]
+        pattern = '(?:{0})'.format('|'.join(branches))
+        if '' in node:
+            pattern += '?'
+        return pattern
+
+    return build(trie)
+
+
+class ResultsIndex(object):
+    """Groups the results by the experiment they belong to. The id of each
+    result is matched once against each Scenario.name template and the
+    values of the parameters found in it are used as a key, so looking for
+    the results of an experiment is a dict lookup instead of a scan of every
+    result. The parameters in the ignore list (e.g. a seed) are left out of
+    the key, grouping the repetitions of an experiment together
+    """
+
+    def __init__(self, experiments, ignorelist):
+        """Constructor
+
+        Args:
+            experiments (list): The dicts with the experiments to verify
+            ignorelist (list): The list of parameters to ignore in the
+            repetition pattern
+        """
+        self._ignore = ignorelist or []
+        self._templates = {}
+        self._groups = {}
+        values = {}
+        for exp in experiments:
+            template = exp['Scenario.name']
+            names = self._template_vars(template)
+            for var in names:
+                values.setdefault((template, var), set()).add(exp[var])
+            self._templates[template] = names
+        self._patterns = [(template,
+                           self._compile(template, names, values))
+                          for template, names in self._templates.items()]
+
+    def _template_vars(self, template):
+        """Returns the parameters of the template that identify an experiment
+        in the order they first appear
+        """
+        names = []
+        for var in re.findall('%%(.*?)%%', template):
+            if var not in self._ignore and var not in names:
+                names.append(var)
+        return names
+
+    def _compile(self, template, names, values):
+        """Translates a Scenario.name template into a regex with a group for
+        each parameter in names and a wildcard for the ignored ones
+        """
+        pattern = ''
+        position = 0
+        captured = set()
+        for match in re.finditer('%%(.*?)%%', template):
+            pattern += re.escape(template[position:match.start()])
+            var = match.groups()[0]
+            if var in self._ignore:
+                pattern += '.*'
+            elif var in captured:
+                # Repeated parameter, it must have the same value
+                pattern += '(?P=g{0})'.format(names.index(var))
+            else:
+                pattern += '(?P<g{0}>{1})'.format(
+                    names.index(var), _trie_pattern(values[(template, var)]))
+                captured.add(var)
+            position = match.end()
+        pattern += re.escape(template[position:])
+        return re.compile(pattern)
+
+    def add(self, result):
+        """Adds a result to the index
+
+        Args:
+            result (dict): A result from the queue, ignored if it has no id
+        """
+        if 'id' not in result:
+            return
+        for template, pattern in self._patterns:
+            match = pattern.match(result['id'])
+            if match:
+                key = (template,) + match.groups()
+                self._groups.setdefault(key, []).append(result)
+
+    def finished(self, exp):
+        """Returns the results of an experiment
+
+        Args:
+            exp (dict): The description of the experiment
+
+        Returns:
+            list: The results (with every repetition) of the experiment
+        """
+        template = exp['Scenario.name']
+        key = (template,) + tuple(exp[var]
+                                  for var in self._templates[template])
+        return self._groups.get(key, [])
+
+
 def check_experiment_in_results(exp, results, executions, ignorelist):
     """Validates that the experiment has complete results
 
     Args:
         exp (dict): The description of the experiment
-        results (list): List of dict containing all the results
+        results (ResultsIndex): The index with all the results, a list of
+        dicts is also accepted (and indexed for this experiment only)
         executions (int): Expected number of individual results
         ignorelist (list): The list of parameters to ignore in the repetition
         pattern
@@ -196,16 +309,13 @@ def check_experiment_in_results(exp, results, executions, ignorelist):
         found, the ratio between the results that match the scenario name
         with the expected results
     """
-    scenario = get_scenario_name(exp, ignorelist)
-    # Escape characters in name to form a valid regex
-    pattern = re.compile(scenario.replace('[', '\[')
-                                 .replace(']', '\]'))
-    finished = []
-    for res in results:
-        if 'id' not in res:
-            continue
-        if pattern.match(res['id']):
-            finished.append(res)
+    if not isinstance(results, ResultsIndex):
+        index = ResultsIndex([exp], ignorelist)
+        for res in results:
+            index.add(res)
+        results = index
+    scenario = get_scenario_name(exp, ignorelist or [])
+    finished = results.finished(exp)
     complete = len(finished) == executions
     progress = float(len(finished)) / float(executions)
     if not complete:
@@ -261,11 +371,14 @@ def main():
 
     res = load_results(cfg.get('worker', 'queue_url'),
                        cfg.get('general', 'results_queue_name'))
+    index = ResultsIndex(experiments, args.ignore)
+    for result in res:
+        index.add(result)
 
     valid_exp = []
     rerun = []
     for experiment in experiments:
-        complete, progress = check_experiment_in_results(experiment, res,
+        complete, progress = check_experiment_in_results(experiment, index,
                                                          args.results,
                                                          args.ignore)
         if complete:
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Worker that supervises all its simulations from a single asyncio event
+loop. The subprocesses and the broker I/O are multiplexed in one thread, so
+a node can run hundreds of simultaneous tasks without one OS thread per
+task. Requires aio-pika.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import configparser
+import logging
+import os
+import time
+
+import aio_pika
+# Local files
+import cache
+import codec
+import completed_index
+import task
+
+DEFAULT_CONFIG_FILE = './disexec.config'
+LOG_FILE = './worker_async.log'
+LOG_FORMAT = '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
+IDLE_CHECK = 1
+
+log = logging.getLogger()
+logging.basicConfig(filename=LOG_FILE, level=logging.DEBUG, format=LOG_FORMAT)
+
+console = logging.StreamHandler()
+console.setLevel(logging.DEBUG)
+formatter = logging.Formatter(LOG_FORMAT)
+console.setFormatter(formatter)
+logging.getLogger('').addHandler(console)
+
+logging.getLogger('aio_pika').setLevel(logging.INFO)
+logging.getLogger('aiormq').setLevel(logging.INFO)
+
+
+class Engine(object):
+    """Consumes the tasks queue and runs every delivered task as a coroutine.
+    The number of simultaneous tasks is bounded by the prefetch count
+    """
+
+    def __init__(self, url, queue_name, results_queue, concurrency,
+                 idle_timeout=None, index=None, pool=None, log_folder=None,
+                 capture_limit=task.DEFAULT_CAPTURE_LIMIT, result_cache=None,
+                 delivery='file', result_encoding='json'):
+        """Constructor
+
+        Args:
+            url (str): The URL for the broker, including user/password
+            queue_name (str): The name of the tasks queue
+            results_queue (str): The name of the queue for the results
+            concurrency (int): Maximum number of simultaneous tasks
+            idle_timeout (float): Stop after this many seconds without tasks,
+            None to wait forever
+            index (CompletedIndex): The tasks whose results were published,
+            a new one in memory if None
+            pool (Executor): If given, the results are parsed in it instead
+            of the default thread pool of the loop
+            log_folder (str): Where the complete output of each task is
+            written, compressed. Not written if None
+            capture_limit (int): Bytes of output kept in memory per task,
+            none if 0
+            result_cache (ResultCache): If given, the tasks already computed
+            are answered from it and the new results are stored in it
+            delivery (str): How the external data is given to the tasks,
+            see task.DELIVERIES
+            result_encoding (str): How the results are published, see
+            codec.RESULT_ENCODINGS
+
+        Raises:
+            ValueError: If capture_limit is negative, or delivery or
+            result_encoding are unknown
+        """
+        if capture_limit < 0:
+            raise ValueError('capture_limit must be 0 or more')
+        if delivery not in task.DELIVERIES:
+            raise ValueError('Unknown config_delivery: {0}'.format(delivery))
+        self._url = url
+        self._queue = queue_name
+        self._results_queue = results_queue
+        self._concurrency = concurrency
+        self._idle_timeout = idle_timeout
+        self._index = index or completed_index.CompletedIndex()
+        self._pool = pool
+        self._log_folder = log_folder
+        self._capture_limit = capture_limit
+        self._result_cache = result_cache
+        self._delivery = delivery
+        self._encode = codec.result_encoder(result_encoding)
+        # Filled from the templates queue when a compact message needs it
+        self._templates = codec.TemplateCache()
+        self._templates_lock = asyncio.Lock()
+        self._connection = None
+        self._channel = None
+        self._running = set()
+        self._last = time.time()
+
+    async def run(self):
+        """Runs until the idle timeout expires (or forever)
+        """
+        connection = await aio_pika.connect_robust(self._url)
+        self._connection = connection
+        async with connection:
+            self._channel = await connection.channel(publisher_confirms=True)
+            await self._channel.set_qos(prefetch_count=self._concurrency)
+            await self._channel.declare_queue(self._results_queue,
+                                              durable=True)
+            tasks_queue = await self._channel.declare_queue(self._queue,
+                                                            durable=True)
+            tag = await tasks_queue.consume(self._on_message)
+            log.info('Waiting for tasks (up to %d at once)',
+                     self._concurrency)
+            while not self._is_idle():
+                await asyncio.sleep(IDLE_CHECK)
+            log.info('Idle for %s seconds. Nothing else to do.',
+                     self._idle_timeout)
+            await tasks_queue.cancel(tag)
+            if self._running:
+                await asyncio.wait(list(self._running))
+
+    async def _load_templates(self, template_id):
+        """Reads the templates queue. The messages are taken without ack and
+        requeued, so they stay there for the other workers
+
+        Args:
+            template_id (str): The template that was missing
+        """
+        async with self._templates_lock:
+            if template_id in self._templates:
+                # Loaded by another task while this one waited for the lock
+                return
+            channel = await self._connection.channel()
+            try:
+                templates = await channel.declare_queue(
+                    codec.template_queue(self._queue), durable=True)
+                received = []
+                while True:
+                    message = await templates.get(no_ack=False, fail=False)
+                    if message is None:
+                        break
+                    self._templates.add(message.body)
+                    received.append(message)
+                for message in received:
+                    await message.nack(requeue=True)
+            finally:
+                await channel.close()
+
+    async def _decode(self, message):
+        """Deserializes the task in a message, reading the templates queue
+        if it refers to an unknown template
+        """
+        for attempt in range(codec.TEMPLATE_RETRIES + 1):
+            try:
+                return task.Task(message.body, self._templates)
+            except codec.UnknownTemplate as ex:
+                if attempt == codec.TEMPLATE_RETRIES:
+                    raise
+                if attempt:
+                    # Another worker may be reading the templates queue
+                    await asyncio.sleep(codec.TEMPLATE_RETRY_WAIT)
+                await self._load_templates(ex.args[0])
+
+    def _is_idle(self):
+        if not self._idle_timeout or self._running:
+            return False
+        return time.time() - self._last > self._idle_timeout
+
+    async def _on_message(self, message):
+        """Consumer callback, the task is supervised in its own coroutine so
+        the deliveries are never blocked by a running simulation
+        """
+        self._last = time.time()
+        future = asyncio.ensure_future(self._process(message))
+        self._running.add(future)
+        future.add_done_callback(self._running.discard)
+
+    async def _process(self, message):
+        """Runs the task in a message, settles it and publishes the results
+
+        Args:
+            message (IncomingMessage): The message with the serialized task
+        """
+        try:
+            try:
+                work = await self._decode(message)
+            except codec.UnknownTemplate as ex:
+                log.error('Unknown template %s, requeueing the task', ex)
+                await message.nack()
+                return
+            log.info('Got a task %s', work.get_id())
+            if work.done_key() in self._index:
+                log.warning('Task ID already done. Skipping')
+                await message.ack()
+                return
+            if self._result_cache is not None:
+                cached = self._result_cache.get(work.cache_key(),
+                                                work.get_id())
+                if cached is not None:
+                    log.info('Results found in the cache')
+                    await self._publish_all(work, cached)
+                    await message.ack()
+                    return
+            ret_code = await work.run_async(self._log_folder,
+                                            self._capture_limit,
+                                            delivery=self._delivery)
+            if ret_code != 0:
+                log.warning('Unexpected exit code: %d', ret_code)
+                stdout = work.get_stdout()
+                stderr = work.get_stderr()
+                if stdout is not None:
+                    log.error('STDOUT: %s', stdout)
+                if stderr is not None:
+                    log.error('STDERR: %s', stderr)
+                await message.nack()
+                return
+
+            log.debug('Task execution finished')
+            # Reading the report files is blocking I/O, keep it off the loop
+            if self._pool is not None:
+                results = await asyncio.wrap_future(work.result(self._pool))
+            else:
+                loop = asyncio.get_event_loop()
+                results = await loop.run_in_executor(None, work.result)
+            # Acknowledged once the broker confirms the results
+            await self._publish_all(work, results)
+            await message.ack()
+            if self._result_cache is not None and results:
+                self._result_cache.put(work.cache_key(), results)
+            log.debug('Task and result processing completed')
+        except Exception as ex:
+            log.exception(ex)
+            # An unsettled message would hold its prefetch slot forever
+            if not message.processed:
+                try:
+                    await message.nack()
+                except Exception as ex:
+                    log.error('Unable to requeue the task: %s', ex)
+        finally:
+            self._last = time.time()
+
+    async def _publish_all(self, work, results):
+        """Publishes all the results of a task and marks it completed
+        """
+        await asyncio.gather(*[self._publish(body)
+                               for body in self._encode(results)])
+        self._index.add(work.done_key())
+
+    async def _publish(self, body):
+        """Publishes a message of results, waiting for the publisher
+        confirm. Concurrent calls keep several confirms in flight
+        """
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        message = aio_pika.Message(body=body,
+                                   delivery_mode=aio_pika.DeliveryMode.
+                                   PERSISTENT)
+        await self._channel.default_exchange.publish(
+            message, routing_key=self._results_queue)
+
+
+def exit_with_error(msg, code=1):
+    print(msg)
+    exit(code)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', help='Configuration file', type=str)
+    args = parser.parse_args()
+
+    config_file = DEFAULT_CONFIG_FILE
+    if args.config:
+        config_file = args.config
+
+    cfg = configparser.RawConfigParser()
+    try:
+        if not os.path.isfile(config_file):
+            raise FileNotFoundError('Unable to locate the config file')
+        cfg.read(config_file)
+    except Exception as e:
+        exit_with_error(e)
+
+    log.debug('Reading configuration file at %s', config_file)
+    concurrency = cfg.getint('worker', 'concurrency',
+                             fallback=cfg.getint('worker', 'cores'))
+    idle_timeout = cfg.getfloat('worker', 'idle_timeout', fallback=0)
+    pool = None
+    processes = cfg.getint('worker', 'parse_processes', fallback=0)
+    if processes > 0:
+        pool = concurrent.futures.ProcessPoolExecutor(processes)
+    index = completed_index.CompletedIndex(
+        cfg.get('worker', 'index_file', fallback=None))
+    log_folder = cfg.get('worker', 'output_folder', fallback=None)
+    if log_folder:
+        os.makedirs(log_folder, exist_ok=True)
+    capture_limit = cfg.getint('worker', 'capture_kb',
+                               fallback=task.DEFAULT_CAPTURE_LIMIT // 1024)
+    engine = Engine(cfg.get('worker', 'queue_url'),
+                    cfg.get('general', 'queue_name'),
+                    cfg.get('general', 'results_queue_name'),
+                    concurrency, idle_timeout or None, index, pool,
+                    log_folder, capture_limit * 1024,
+                    cache.ResultCache.from_config(cfg),
+                    task.config_delivery(cfg),
+                    cfg.get('general', 'result_encoding', fallback='json'))
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(engine.run())
+    if pool is not None:
+        pool.shutdown(wait=True)
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -7,12 +7,10 @@ Attributes:
     DEFAULT_CONFIG_FILE (str): Description
     DEFAULT_NBR_OF_THREADS (int): Description
     formatter (TYPE): Description
-    IDS_DONE (list): Description
-    JOBS_DONE (dict): Description
     log (TYPE): Description
     LOG_FILE (str): Description
     LOG_FORMAT (str): Description
-    QUEUE (TYPE): Description
+    TASKS_PER_THREAD (int): Description
 """
 # @Author: Jairo Sánchez
 # @Date:   2018-06-27 01:45:02
@@ -35,9 +33,8 @@ DEFAULT_CONFIG_FILE = './disexec.config'
 DEFAULT_NBR_OF_THREADS = 6
 LOG_FILE = './worker_csv.log'
 LOG_FORMAT = '%(asctime)s %(name)-12s %(threadName)s %(levelname)-8s %(message)s'
-IDS_DONE = []
-JOBS_DONE = {}
-QUEUE = queue.Queue()
+# Tasks read ahead from the CSV file for each worker thread
+TASKS_PER_THREAD = 2
 
 log = logging.getLogger()
 logging.basicConfig(filename=LOG_FILE, level=logging.DEBUG, format=LOG_FORMAT)
@@ -90,34 +87,36 @@ class ParamsInExternalFileCreator(TaskCreator):
         Returns:
             list: List of JSON formatted strings
         """
-        json_tasks = []
-        names, values = self.read_csv_parameters(self._csv)
-        index = 0
-        for datatask in values:
+        return list(self.iter_tasks())
+
+    def iter_tasks(self):
+        """Creates the tasks one at a time while the CSV file is read
+
+        Yields:
+            str: The JSON formatted task for each row of the CSV file
+        """
+        # Folder where all the external_data files will be written, if not
+        # present, then it will use a temp folder
+        folder = self._config.get('task', 'external_folder')
+        # The command to execute in each worker, be aware of the $PATH
+        # in all of the workers
+        command = self._config.get('task', 'command')
+        # Extra arguments or flags in the command
+        arguments = self._config.get('task', 'arguments')
+        names, values = self.iter_csv_parameters(self._csv)
+        for index, datatask in enumerate(values):
             task = {}
             # A unique id, it'll be used as a filename (if external_data)
             task['id'] = index
             # The contents of this var will be written to a file and passed
             # to the command
-            sim_config = ''
-            for idx in range(len(datatask)):
-                sim_config = sim_config + '{0}={1}\n'.format(names[idx],
-                                                             datatask[idx])
-            task['external_data'] = sim_config
-            # Folder where all the external_data files will be written, if not
-            # present, then it will use a temp folder
-            task['external_data_folder'] = self._config.get('task',
-                                                            'external_folder')
-            # The command to execute in each worker, be aware of the $PATH
-            # in all of the workers
-            task['command'] = self._config.get('task', 'command')
-            # Extra arguments or flags in the command
-            task['arguments'] = self._config.get('task', 'arguments')
-
-            json_tasks.append(json.dumps(task))
-            index = index + 1
-
-        return json_tasks
+            task['external_data'] = ''.join('{0}={1}\n'.format(name, value)
+                                            for name, value in zip(names,
+                                                                   datatask))
+            task['external_data_folder'] = folder
+            task['command'] = command
+            task['arguments'] = arguments
+            yield json.dumps(task)
 
     def read_csv_parameters(self, csvfile):
         """Parses a csv file into two lists, one with the parameter names and
@@ -142,18 +141,84 @@ class ParamsInExternalFileCreator(TaskCreator):
         values = fields[1:]
         return col_names, values
 
+    def iter_csv_parameters(self, csvfile):
+        """Streaming version of read_csv_parameters, the rows are read from
+        the file only when they are requested
+
+        Args:
+            csvfile (str): The path to the CSV file to be parsed
+
+        Returns:
+            tuple: List with the names of columns in the first field, followed
+            by an iterator over the lists for each row
+        """
+        the_file = open(csvfile, 'r')
+        param_reader = csv.reader(the_file)
+        col_names = next(param_reader)
+
+        def rows():
+            with the_file:
+                for row in param_reader:
+                    yield row
+
+        return col_names, rows()
+
+
+class Counter(object):
+    """Thread safe count of the completed tasks
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def increment(self):
+        with self._lock:
+            self.value += 1
+
+
+def next_job(the_queue, retries, finished):
+    """Takes the next task for a worker thread, the failed ones first
 
-def worker_thread(the_queue):
-    """Worker thread, for each instance
+    Args:
+        the_queue (Queue): The tasks read from the CSV file, None at the end
+        retries (Queue): The tasks to be executed again
+        finished (bool): True once this thread got the None from the_queue
+
+    Returns:
+        str: The JSON formatted task, None when there are no more
+    """
+    try:
+        return retries.get_nowait()
+    except queue.Empty:
+        if finished:
+            return None
+    return the_queue.get()
+
+
+def worker_thread(the_queue, retries, done):
+    """Worker thread, for each instance. The Task objects are created only
+    when the thread is ready to run them
+
+    Args:
+        the_queue (Queue): The JSON formatted tasks read from the CSV file,
+        followed by a None for each thread
+        retries (Queue): Where the failed tasks are put to be executed again
+        done (Counter): Counts the completed tasks
     """
     global log
     log.info('Waiting for tasks')
+    finished = False
     while True:
-        try:
-            job = the_queue.get_nowait()
-        except queue.Empty:
-            log.info('Nothing else to do. Exiting')
-            break
+        jsondesc = next_job(the_queue, retries, finished)
+        if jsondesc is None:
+            if finished:
+                log.info('Nothing else to do. Exiting')
+                break
+            # Still has to run the tasks that fail from now on
+            finished = True
+            continue
+        job = task.Task(jsondesc)
         log.info('Got a task %s', job.get_id())
 
         ret_code = job.run()
@@ -165,16 +230,13 @@ def worker_thread(the_queue):
                 log.error('STDOUT: %s', stdout)
             if stderr is not None:
                 log.error('STDERR: %s', stderr)
-            # Notify the queue that this job has ended, but reenqueue it
-            the_queue.task_done()
-            the_queue.put(job)
+            # Reenqueue it, the retries don't count in the bounded queue
+            retries.put(jsondesc)
             continue
 
         log.debug('Task execution finished')
 
-        IDS_DONE.append(job.get_id())
-
-        the_queue.task_done()
+        done.increment()
         log.debug('Task succesfully completed')
 
     log.info('Thread exiting.')
@@ -191,12 +253,16 @@ def exit_with_error(msg, code):
     exit(code)
 
 
-def read_csv_into_queue(config, the_queue):
-    """Reads a given csv file into a queue of Task objects
+def read_csv_into_queue(config, the_queue, workers=1):
+    """Reads a given csv file into a queue of JSON formatted tasks. With a
+    bounded queue it blocks while the queue is full, so it's meant to run in
+    its own thread while the workers take the tasks
 
     Args:
-        csvfile (str): The path to the desired csv file to load
+        config (RawConfigParser): The configuration reader
         the_queue (Queue): A queue from the queue module
+        workers (int): Number of worker threads, a None is put for each one
+        at the end
     """
     log.info('Populating queue')
     task_creator = config.get('coordinator', 'taskcreator')
@@ -204,11 +270,15 @@ def read_csv_into_queue(config, the_queue):
     log.debug('The file will be: {}'.format(csv_file))
     creator_class = getattr(sys.modules[__name__], task_creator)
     creator = creator_class(csv_file, config)
-    tasks = creator.create_tasks()
-    log.debug('Pushing {} tasks into queue'.format(len(tasks)))
-    for jsondesc in tasks:
-        t = task.Task(jsondesc)
-        the_queue.put(t)
+    count = 0
+    try:
+        for jsondesc in creator.iter_tasks():
+            the_queue.put(jsondesc)
+            count += 1
+    finally:
+        for _ in range(workers):
+            the_queue.put(None)
+    log.debug('Pushed {} tasks into queue'.format(count))
 
 
 def main():
@@ -235,18 +305,26 @@ def main():
 
     log.debug('Reading configuration file at %s', config_file)
     threads = []
-    workers = cfg.get('worker', 'cores')
-    read_csv_into_queue(cfg, QUEUE)
-    for i in range(int(workers)):
-        thread = threading.Thread(target=worker_thread, args=(QUEUE,))
+    workers = int(cfg.get('worker', 'cores'))
+    # Only a few tasks per thread exist at any time
+    pending = queue.Queue(maxsize=workers * TASKS_PER_THREAD)
+    retries = queue.Queue()
+    done = Counter()
+    producer = threading.Thread(target=read_csv_into_queue,
+                                args=(cfg, pending, workers))
+    producer.setName('producer')
+    producer.daemon = True
+    producer.start()
+    for i in range(workers):
+        thread = threading.Thread(target=worker_thread,
+                                  args=(pending, retries, done))
         thread.setName('worker-{}'.format(i))
         thread.start()
         threads.append(thread)
 
-    QUEUE.join()
-    log.info('List of ids done: {}'.format(IDS_DONE))
     for t in threads:
         t.join()
+    log.info('Tasks done: {}'.format(done.value))
 
 
 if __name__ == '__main__':
@@ -6,22 +6,40 @@
 # @Last Modified time: 2018-05-08 23:55:33
 
 import amqpstorm
+import broker
+import cache
+import codec
+import completed_index
+import metrics
+import slots
+import spool
 import task
 import argparse
+import concurrent.futures
 import configparser
+import cProfile
+import functools
 import os
 import threading
 import logging
+import queue
+import time
 
 
 DEFAULT_CONFIG_FILE = './disexec.config'
 DEFAULT_NBR_OF_THREADS = 4
 LOG_FILE = './worker.log'
+# Seconds before requeueing a task whose template isn't found
+TEMPLATE_RETRY_WAIT = 1
+SPOOL_FILE = './worker.spool'
 LOG_FORMAT = '%(asctime)s %(name)-12s %(threadName)s %(levelname)-8s %(message)s'
-IDS_DONE = []
-JOBS_DONE = {}
+CONSUME_WAIT = 0.05
+RECONNECT_WAIT = 5
 
 log = logging.getLogger()
+# Held by the thread being profiled, since Python 3.12 only one profiler can
+# be active in a process
+_PROFILER = threading.Lock()
 logging.basicConfig(filename=LOG_FILE, level=logging.DEBUG, format=LOG_FORMAT)
 
 console = logging.StreamHandler()
@@ -33,8 +51,500 @@ logging.getLogger('').addHandler(console)
 logging.getLogger('amqpstorm').setLevel(logging.INFO)
 
 
-def worker_thread(url, queue_name, results_queue):
+class Context(object):
+    """Everything the worker threads of this process share: the spool for
+    the results, the connection manager, the index of completed tasks and the
+    optional helpers enabled in the configuration
+    """
+
+    def __init__(self, results, manager, index, pool=None,
+                 log_folder=None, capture_limit=task.DEFAULT_CAPTURE_LIMIT,
+                 result_cache=None, phases=None, profile_folder=None,
+                 cores=None, pin=False, delivery='file', templates=None,
+                 group_size=1):
+        """Constructor
+
+        Args:
+            results (ResultSpool): Where the results are stored until they're
+            published
+            manager (ConnectionManager): Shared connection to the broker
+            index (CompletedIndex): The tasks whose results were stored, see
+            Task.done_key
+            pool (Executor): If given, the results are parsed in it while
+            the thread takes the next task, see Completions
+            log_folder (str): Where the complete output of each task is
+            written, compressed. Not written if None
+            capture_limit (int): Bytes of output kept in memory per task,
+            none if 0
+            result_cache (ResultCache): If given, the tasks already computed
+            are answered from it and the new results are stored in it
+            phases (PhaseMetrics): The histograms of the duration of each
+            phase of the tasks, kept only in memory if None
+            profile_folder (str): If given, the processing of each task is
+            profiled with cProfile and the stats written there as <id>.prof
+            cores (CoreSlots): The cores shared by the tasks, each one takes
+            as many as it declares. One per thread if None
+            pin (bool): Pin the subprocess of each task to its cores
+            delivery (str): How the external data is given to the tasks,
+            see task.DELIVERIES
+            templates (TemplateCache): The templates of the compact task
+            messages, only the legacy JSON ones are understood if None
+        """
+        self.results = results
+        self.manager = manager
+        self.index = index
+        self.pool = pool
+        self.log_folder = log_folder
+        self.capture_limit = capture_limit
+        self.result_cache = result_cache
+        self.phases = phases or metrics.PhaseMetrics()
+        self.profile_folder = profile_folder
+        self.cores = cores
+        self.pin = pin
+        self.delivery = delivery
+        self.templates = templates
+        self.group_size = group_size
+
+    @staticmethod
+    def from_config(cfg):
+        """Creates the context described in the configuration file
+
+        Args:
+            cfg (RawConfigParser): The configuration reader
+
+        Returns:
+            Context: A new instance
+        """
+        manager = broker.ConnectionManager(cfg.get('worker', 'queue_url'))
+        index = completed_index.CompletedIndex(
+            cfg.get('worker', 'index_file', fallback=None))
+        pool = None
+        processes = cfg.getint('worker', 'parse_processes', fallback=0)
+        if processes > 0:
+            pool = concurrent.futures.ProcessPoolExecutor(processes)
+        log_folder = cfg.get('worker', 'output_folder', fallback=None)
+        if log_folder:
+            os.makedirs(log_folder, exist_ok=True)
+        capture_limit = cfg.getint('worker', 'capture_kb',
+                                   fallback=task.DEFAULT_CAPTURE_LIMIT // 1024)
+        if capture_limit < 0:
+            raise ValueError('capture_kb must be 0 or more')
+        results_queue = cfg.get('general', 'results_queue_name')
+        phases = metrics.PhaseMetrics(
+            cfg.get('worker', 'metrics_file', fallback=None),
+            cfg.getfloat('worker', 'metrics_interval',
+                         fallback=metrics.DEFAULT_INTERVAL))
+        profile_folder = cfg.get('worker', 'profile_folder', fallback=None)
+        if profile_folder:
+            os.makedirs(profile_folder, exist_ok=True)
+        count = cfg.getint('worker', 'cores')
+        pin = cfg.getboolean('worker', 'pin_cores', fallback=False)
+        if pin:
+            cores = slots.CoreSlots(count)
+        else:
+            # Just a count, the cores may be more than the CPUs
+            cores = slots.CoreSlots(cpus=list(range(count)), nodes={})
+        delivery = task.config_delivery(cfg)
+        templates = codec.TemplateCache(functools.partial(
+            broker.peek_messages, cfg.get('worker', 'queue_url'),
+            codec.template_queue(cfg.get('general', 'queue_name'))))
+        encode = codec.result_encoder(cfg.get('general', 'result_encoding',
+                                              fallback='json'))
+
+        def publish(results):
+            begin = time.perf_counter()
+            manager.publisher(results_queue).publish(encode(results))
+            phases.observe('publish', time.perf_counter() - begin)
+        results = spool.ResultSpool(
+            cfg.get('worker', 'spool_file', fallback=SPOOL_FILE), publish,
+            cfg.getint('worker', 'spool_batch', fallback=spool.DEFAULT_BATCH))
+        return Context(results, manager, index, pool, log_folder,
+                       capture_limit * 1024,
+                       cache.ResultCache.from_config(cfg), phases,
+                       profile_folder or None, cores, pin, delivery,
+                       templates, cfg.getint('worker', 'group_size',
+                                             fallback=1))
+
+    def save_results(self, work, results):
+        """Stores the results of a task in the spool, which publishes them in
+        the background, and marks the task completed
+
+        Args:
+            work (Task): The task
+            results (list): The JSON formatted results
+        """
+        self.results.append(work.get_id(), results)
+        self.index.add(work.done_key())
+
+    def close(self):
+        """Waits for the pending results and closes the connections
+        """
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+        self.results.close()
+        self.phases.close()
+        self.manager.close()
+        self.index.close()
+
+
+class Completions(object):
+    """Settles the messages of the tasks whose results are parsed in the
+    pool. The callbacks of the futures run in a thread of the pool, but a
+    message is only settled by the thread that owns its channel: the
+    callbacks queue the settlement and that thread runs it with settle
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._outstanding = 0
+
+    def begin(self):
+        """Counts a task whose results are being parsed
+        """
+        with self._lock:
+            self._outstanding += 1
+
+    def put(self, settle):
+        """Queues the settlement of a task counted with begin
+
+        Args:
+            settle (callable): Settles the message, returns False if its
+            channel is no longer usable
+        """
+        self._queue.put(settle)
+
+    def __len__(self):
+        """Number of tasks being parsed or waiting to be settled
+        """
+        with self._lock:
+            return self._outstanding
+
+    def settle(self, wait=False):
+        """Runs the queued settlements, from the thread of the channel
+
+        Args:
+            wait (bool): Also wait for the tasks still being parsed
+
+        Returns:
+            bool: False if any message couldn't be settled
+        """
+        settled = True
+        while True:
+            try:
+                settle = self._queue.get(wait and len(self) > 0)
+            except queue.Empty:
+                break
+            settled = settle() and settled
+            with self._lock:
+                self._outstanding -= 1
+        return settled
+
+
+def process_message(message, context, completions=None):
+    """Runs the task contained in a message, stores the results and settles
+    the message with the broker
+
+    Args:
+        message (Message): The message with the serialized task
+        context (Context): Shared by all the threads
+        completions (Completions): With a pool, the message is settled
+        through it once the results are parsed, and the thread doesn't wait
+        for them. Without it, the thread waits
+
+    Returns:
+        bool: False if the message couldn't be settled, i.e. the channel
+        where it came from is no longer usable
+    """
+    return process_messages([message], context, completions)
+
+
+def process_messages(messages, context, completions=None):
+    """Same as process_message for several messages. The tasks with the
+    same group_key are run together by a TaskGroup, up to group_size of them
+
+    Args:
+        messages (list): The messages with the serialized tasks
+        context (Context): Shared by all the threads
+        completions (Completions): See process_message
+
+    Returns:
+        bool: False if any message couldn't be settled
+    """
+    settled = True
+    batches = []
+    groups = {}
+    for message in messages:
+        try:
+            work = task.Task(message.body, context.templates)
+        except codec.UnknownTemplate as ex:
+            # Its template is published before it, it may not be visible yet
+            log.error('Unknown template %s, requeueing the task', ex)
+            time.sleep(TEMPLATE_RETRY_WAIT)
+            try:
+                message.nack()
+            except amqpstorm.AMQPError:
+                settled = False
+            continue
+        log.info('Got a task %s', work.get_id())
+        key = work.group_key()
+        if key is None or context.group_size <= 1:
+            batches.append([(work, message)])
+            continue
+        if key not in groups or len(groups[key]) >= context.group_size:
+            groups[key] = []
+            batches.append(groups[key])
+        groups[key].append((work, message))
+    for batch in batches:
+        settled = _profiled(batch, context, completions) and settled
+    return settled
+
+
+def _profiled(batch, context, completions=None):
+    """Executes a batch of tasks, profiling it if enabled
+    """
+    if len(batch) == 1:
+        work, message = batch[0]
+        execute = functools.partial(_execute, work, message, context,
+                                    completions)
+        name = work.get_id()
+    else:
+        execute = functools.partial(_execute_group, batch, context,
+                                    completions)
+        name = '{0}-{1}'.format(batch[0][0].get_id(), batch[-1][0].get_id())
+    if context.profile_folder is None or \
+            not _PROFILER.acquire(blocking=False):
+        # Another thread is being profiled
+        return execute()
+    try:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiling tool is active, e.g. a debugger
+            return execute()
+        try:
+            return execute()
+        finally:
+            profile.disable()
+            profile.dump_stats(os.path.join(context.profile_folder,
+                                            '{0}.prof'.format(name)))
+    finally:
+        _PROFILER.release()
+
+
+def _execute(work, message, context, completions=None):
+    """Body of process_message, once the task is deserialized
+    """
+    settled = _answer(work, message, context)
+    if settled is not None:
+        return settled
+    ret_code = _run(work, context)
+    context.phases.observe_all(work.timings())
+    return _complete(work, message, context, ret_code, completions)
+
+
+def _execute_group(batch, context, completions=None):
+    """Runs the tasks of a batch in a single invocation. If it fails, or its
+    reports can't be split between the tasks, each task is run alone, so a
+    bad one doesn't fail the others
+
+    Args:
+        batch (list): The tasks and their messages, with the same group_key
+        context (Context): Shared by all the threads
+        completions (Completions): See process_message
+
+    Returns:
+        bool: False if any message couldn't be settled
+    """
+    settled = True
+    pending = []
+    for work, message in batch:
+        answered = _answer(work, message, context)
+        if answered is None:
+            pending.append((work, message))
+        else:
+            settled = answered and settled
+    if len(pending) == 1:
+        return _execute(*pending[0], context=context,
+                        completions=completions) and settled
+    if not pending:
+        return settled
+
+    group = task.TaskGroup(work for work, _ in pending)
+    log.info('Running %d tasks in one invocation', len(pending))
+    ret_code = _run(group, context)
+    context.phases.observe_all(group.timings())
+    failed = ret_code != 0 or group.assigned is None
+    if ret_code != 0:
+        log.warning('Unexpected exit code of the group: %d, running its '
+                    'tasks one by one', ret_code)
+    elif group.assigned is None:
+        log.warning('The reports of the group do not match one task each, '
+                    'running its tasks one by one')
+    for work, message in pending:
+        if failed:
+            code = _run(work, context)
+            context.phases.observe_all(work.timings())
+        else:
+            code = 0
+        settled = _complete(work, message, context, code,
+                            completions) and settled
+    return settled
+
+
+def _answer(work, message, context):
+    """Settles the task without running it if its results are already
+    stored, or found in the cache
+
+    Returns:
+        bool: Whether the message was settled (see process_message), None if
+        the task must be run
+    """
+    if work.done_key() in context.index:
+        # Its results were already stored, e.g. the ack was lost
+        log.warning('Task ID already done. Skipping')
+        try:
+            message.ack()
+        except amqpstorm.AMQPError as ex:
+            log.error('Unable to acknowledge the task: %s', ex)
+            return False
+        return True
+
+    if context.result_cache is None:
+        return None
+    cached = context.result_cache.get(work.cache_key(), work.get_id())
+    if cached is None:
+        return None
+    log.info('Results found in the cache')
+    context.save_results(work, cached)
+    try:
+        message.ack()
+    except amqpstorm.AMQPError as ex:
+        # The index will skip the task when the broker delivers it again
+        log.error('Unable to acknowledge the task: %s', ex)
+        return False
+    return True
+
+
+def _requeue(message):
+    """Nacks a message so the task is delivered again
+
+    Returns:
+        bool: If the broker got the nack
+    """
+    try:
+        message.nack()
+    except amqpstorm.AMQPError as ex:
+        log.error('Unable to requeue the task: %s', ex)
+        return False
+    return True
+
+
+def _acknowledge(message):
+    """Acks a message whose results are stored
+
+    Returns:
+        bool: If the broker got the ack
+    """
+    try:
+        message.ack()
+    except amqpstorm.AMQPConnectionError:
+        # The results are kept anyway, the index will skip the task when
+        # the broker delivers it again
+        log.error('Connection to server died before the ack')
+        return False
+    except Exception as ex:
+        log.exception(ex)
+        return False
+    log.debug('Task and result processing completed')
+    return True
+
+
+def _store(work, context, results, begin):
+    """Stores the parsed results of a task, before its message is acked so
+    a crash can't lose them
+    """
+    context.phases.observe('parse', time.perf_counter() - begin)
+    context.save_results(work, results)
+    if context.result_cache is not None and results:
+        context.result_cache.put(work.cache_key(), results)
+    log.debug('Task execution finished')
+
+
+def _parsed(work, message, context, completions, begin, future):
+    """Done callback of the parsing of the results in the pool, stores them
+    and queues the settlement of the message
+    """
+    try:
+        _store(work, context, future.result(), begin)
+    except Exception as ex:
+        log.error('Unable to parse the results: %s', ex)
+        completions.put(functools.partial(_requeue, message))
+        return
+    completions.put(functools.partial(_acknowledge, message))
+
+
+def _complete(work, message, context, ret_code, completions=None):
+    """Stores the results of a task that was run and settles its message.
+    With a pool and completions, the results are parsed and the message
+    settled after this returns
+    """
+    if ret_code != 0:
+        log.warning('Unexpected exit code: %d', ret_code)
+        stdout = work.get_stdout()
+        stderr = work.get_stderr()
+        if stdout is not None:
+            log.error('STDOUT: %s', stdout)
+        if stderr is not None:
+            log.error('STDERR: %s', stderr)
+        # Never stored as done, even if the nack didn't reach the broker
+        return _requeue(message)
+
+    begin = time.perf_counter()
+    if context.pool is not None and completions is not None:
+        # Parsed in another process while this thread takes the next task
+        completions.begin()
+        work.result(context.pool).add_done_callback(functools.partial(
+            _parsed, work, message, context, completions, begin))
+        return True
+    try:
+        if context.pool is not None:
+            results = work.result(context.pool).result()
+        else:
+            results = work.result()
+        _store(work, context, results, begin)
+    except Exception as ex:
+        log.error('Unable to parse the results: %s', ex)
+        return _requeue(message)
+    return _acknowledge(message)
+
+
+def _run(work, context):
+    """Runs a task once the cores it needs are free
+
+    Returns:
+        int: The exit code of the task
+    """
+    if context.cores is None:
+        return work.run(context.log_folder, context.capture_limit,
+                        delivery=context.delivery)
+    cpus = context.cores.acquire(work.cores())
+    try:
+        log.debug('Running on cores %s', cpus)
+        return work.run(context.log_folder, context.capture_limit,
+                        cpus if context.pin else None, context.delivery)
+    finally:
+        context.cores.release(cpus)
+
+
+def worker_thread(url, queue_name, context):
     """Worker thread, for each instance
+
+    Args:
+        url (str): The URL for the tasks queue
+        queue_name (str): The name of the tasks queue
+        context (Context): Shared by all the threads
     """
     global log
     empty_queue = False
@@ -43,67 +553,174 @@ def worker_thread(url, queue_name, results_queue):
         channel = connection.channel(rpc_timeout=120)
         channel.queue.declare(queue_name, durable=True)
         channel.basic.qos(1)  # Fetch one message at a time
+        # The tasks parsed in the pool are settled on this channel
+        completions = Completions()
         log.info('Waiting for tasks')
         while True:
+            if not completions.settle():
+                break
             message = channel.basic.get(queue=queue_name, no_ack=False)
             # If the queue is empty, task_data will contain only None
             if message is None:
                 log.info('Nothing else to do.')
+                completions.settle(wait=True)
                 connection.close()
                 empty_queue = True
                 break
 
-            work = task.Task(message.body)
-            log.info('Got a task %s', work.get_id())
+            messages = [message]
+            while len(messages) < context.group_size:
+                # Only what is already queued, a group never waits
+                message = channel.basic.get(queue=queue_name, no_ack=False)
+                if message is None:
+                    break
+                messages.append(message)
+            if not process_messages(messages, context, completions):
+                break
+
+        connection.close()
+
+    log.info('Thread exiting. (empty queue? %s)',
+             repr(empty_queue))
+
+
+class Activity(object):
+    """Thread safe record of the tasks being executed and of the last moment
+    something happened, used to detect an idle worker
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.busy = 0
+        self.last = time.time()
 
-            ret_code = 0
-            if work.get_id() in IDS_DONE:
-                log.warning('Task ID already done. Skipping')
-                work = JOBS_DONE[work.get_id()]
-            else:
-                ret_code = work.run()
-                JOBS_DONE[work.get_id()] = work
+    def touch(self):
+        with self._lock:
+            self.last = time.time()
 
+    def begin(self):
+        with self._lock:
+            self.busy += 1
+            self.last = time.time()
+
+    def end(self):
+        with self._lock:
+            self.busy -= 1
+            self.last = time.time()
+
+    def idle_for(self):
+        """Returns the seconds without any task running, 0 if one is running
+        """
+        with self._lock:
+            if self.busy:
+                return 0
+            return time.time() - self.last
+
+
+def consumer_thread(pending, context, activity, completions=None):
+    """Executes the messages delivered by consume, one at a time or in
+    groups (see process_messages) with the ones already delivered
+
+    Args:
+        pending (Queue): The delivered messages, None means stop
+        context (Context): Shared by all the threads
+        activity (Activity): Tracks the busy threads and the last activity
+        completions (Completions): Drained by the consuming thread, see
+        process_message
+    """
+    stop = False
+    while not stop:
+        message = pending.get()
+        if message is None:
+            break
+        messages = [message]
+        while len(messages) < context.group_size:
             try:
-                if ret_code != 0:
-                    log.warning('Unexpected exit code: %d', ret_code)
-                    stdout = work.get_stdout()
-                    stderr = work.get_stderr()
-                    if stdout is not None:
-                        log.error('STDOUT: %s', stdout)
-                    if stderr is not None:
-                        log.error('STDERR: %s', stderr)
-                    message.nack()
-                    continue
-
-                log.debug('Task execution finished')
-
-                message.ack()
-            except amqpstorm.AMQPConnectionError as conn_error:
-                log.error('Connection to server died before publish')
-                IDS_DONE.append(work.get_id())
+                message = pending.get_nowait()
+            except queue.Empty:
                 break
-            except Exception as ex:
-                log.exception(ex)
+            if message is None:
+                stop = True
                 break
+            messages.append(message)
+        activity.begin()
+        try:
+            process_messages(messages, context, completions)
+        except Exception as ex:
+            log.exception(ex)
+        finally:
+            activity.end()
+    log.info('Thread exiting.')
 
-            with amqpstorm.UriConnection(url) as res_conn:
-                with res_conn.channel() as res_channel:
-                    res_channel.queue.declare(results_queue, durable=True)
-                    for result in work.result():
-                        props = {
-                            'delivery_mode': 2
-                        }
-                        res = amqpstorm.Message.create(res_channel,
-                                                       result,
-                                                       props)
-                        res.publish(results_queue, exchange='')
-            log.debug('Task and result processing completed')
 
-        connection.close()
+def consume(url, queue_name, context, cores, idle_timeout=None):
+    """Push based execution. The broker delivers up to `cores` unacknowledged
+    messages to a single consumer, and they're executed by `cores` threads.
+    Unlike worker_thread, this keeps waiting when the queue is temporarily
+    empty, so tasks published later are picked up too
 
-    log.info('Thread exiting. (empty queue? %s)',
-             repr(empty_queue))
+    Args:
+        url (str): The URL for the tasks queue
+        queue_name (str): The name of the tasks queue
+        context (Context): Shared by all the threads
+        cores (int): Number of simultaneous tasks, also the prefetch count
+        (plus group_size - 1 when grouping)
+        idle_timeout (float): Stop after this many seconds without tasks,
+        None to wait forever
+    """
+    pending = queue.Queue()
+    activity = Activity()
+    # Settlements of a lost channel fail and are logged, the broker delivers
+    # those tasks again and the index skips them
+    completions = Completions()
+    threads = []
+    for i in range(cores):
+        thread = threading.Thread(target=consumer_thread,
+                                  args=(pending, context, activity,
+                                        completions))
+        thread.setName('worker-{}'.format(i))
+        thread.start()
+        threads.append(thread)
+
+    def on_message(message):
+        activity.touch()
+        pending.put(message)
+
+    idle = False
+    while not idle:
+        try:
+            connection = amqpstorm.UriConnection(url)
+            channel = connection.channel(rpc_timeout=120)
+            channel.queue.declare(queue_name, durable=True)
+            # A task for each thread, plus room for one of them to fill a
+            # group; tasks that can't be grouped are never held much longer
+            channel.basic.qos(cores + context.group_size - 1)
+            channel.basic.consume(on_message, queue_name, no_ack=False)
+            log.info('Waiting for tasks')
+            while True:
+                channel.process_data_events()
+                completions.settle()
+                if idle_timeout and pending.empty() and \
+                        not len(completions) and \
+                        activity.idle_for() > idle_timeout:
+                    log.info('Idle for %s seconds. Nothing else to do.',
+                             idle_timeout)
+                    idle = True
+                    break
+                time.sleep(CONSUME_WAIT)
+            connection.close()
+        except amqpstorm.AMQPError as error:
+            # Deliveries from the dead channel can't be acknowledged anymore,
+            # the broker will send them again
+            log.error('Lost the connection to the server: %s', error)
+            while not pending.empty():
+                pending.get_nowait()
+            time.sleep(RECONNECT_WAIT)
+
+    for _ in threads:
+        pending.put(None)
+    for t in threads:
+        t.join()
 
 
 def exit_with_error(msg, code):
@@ -132,8 +749,15 @@ def main():
     log.debug('Reading configuration file at %s', config_file)
     threads = []
     workers = cfg.get('worker', 'cores')
+    context = Context.from_config(cfg)
     args = (cfg.get('worker', 'queue_url'), cfg.get('general', 'queue_name'),
-            cfg.get('general', 'results_queue_name'))
+            context)
+    if cfg.getboolean('worker', 'consume', fallback=False):
+        idle_timeout = cfg.getfloat('worker', 'idle_timeout', fallback=0)
+        consume(*args, cores=int(workers), idle_timeout=idle_timeout or None)
+        context.close()
+        return
+
     for i in range(int(workers)):
         thread = threading.Thread(target=worker_thread, args=args)
         thread.setName('worker-{}'.format(i))
@@ -142,6 +766,7 @@ def main():
 
     for t in threads:
         t.join()
+    context.close()
 
 
 if __name__ == '__main__':